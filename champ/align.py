@@ -1,114 +1,384 @@
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
 from champ.grid import GridImages
-from champ import plotting, fastqimagealigner, stats, error
+from champ import diagnostics, fastqimagealigner, instrument, stats, error, readrcs
+from champ import chipmodel
+from champ.tilestore import TileStore
+from champ.scheduler import Scheduler
+from champ.ledger import AlignmentLedger
 from collections import Counter, defaultdict
+from contextlib import contextmanager
 import functools
 import h5py
+import json
 import logging
 import multiprocessing
 from multiprocessing import Manager
+from multiprocessing.pool import ThreadPool
 import os
 import sys
 import re
-from copy import deepcopy
 import math
-import gc
+import time
 
 log = logging.getLogger(__name__)
-stats_regex = re.compile(r'''^(\w+)_(?P<row>\d+)_(?P<column>\d+)_stats\.txt$''')
+stats_regex = re.compile(r'''^(?P<channel>\w+)_(?P<row>\d+)_(?P<column>\d+)_stats\.txt$''')
+# When reusing an alignment from another concentration, reads are only matched to clusters this close (in pixels),
+# since the stage only drifts a little between concentrations
+seed_search_radius = 5.0
+# If a reused alignment scores less than this fraction of the original, the image gets a full alignment instead
+seed_min_score_fraction = 0.5
 
+# Each worker process attaches to the tile stores once, when the pool starts. The stores are memory-mapped
+# from disk, so all workers share the same pages, and only the directory names are ever sent to them.
+# One pool is started by the controller and used for every HDF5 file and channel.
+worker_tile_stores = {}
+# Each process opens the alignment ledger once, the first time it needs it
+ledgers = {}
+# When an image can't be aligned because of an error, a timeout or a crash, it's tried once more with the other strategy
+retry_precision_strategies = {'lstsq': 'ransac', 'ransac': 'lstsq'}
 
-def run(cluster_strategy, rotation_adjustment, h5_filenames, path_info, snr, min_hits, fia, end_tiles, alignment_channel, all_tile_data, metadata, make_pdfs, sequencing_chip, process_limit):
-    image_count = count_images(h5_filenames, alignment_channel)
-    num_processes, chunksize = calculate_process_count(image_count)
-    if process_limit > 0:
-        num_processes = min(process_limit, num_processes)
-    log.debug("Aligning alignment images with %d cores with chunksize %d" % (num_processes, chunksize))
 
-    # Iterate over images that are probably inside an Illumina tile, attempt to align them, and if they
-    # align, do a precision alignment and write the mapped FastQ reads to disk
-    alignment_func = functools.partial(perform_alignment, cluster_strategy, rotation_adjustment, path_info, snr, min_hits, metadata['microns_per_pixel'],
-                                       sequencing_chip, all_tile_data, make_pdfs, fia)
+def init_worker(tile_store_directories):
+    for name, directory in tile_store_directories.items():
+        worker_tile_stores[name] = TileStore().attach(directory)
 
-    for h5_filename in h5_filenames:
-        pool = multiprocessing.Pool(num_processes)
-        pool.map_async(alignment_func,
-                       iterate_all_images([h5_filename], end_tiles, alignment_channel, path_info), chunksize=chunksize).get(timeout=sys.maxint)
+
+def make_pool(num_processes, tile_store_directories):
+    return multiprocessing.Pool(num_processes, initializer=init_worker, initargs=(tile_store_directories,))
+
+
+@contextmanager
+def worker_pool(num_processes, tile_store_directories):
+    """ A pool of workers that's stopped when the block is over, so its processes don't sit idle through later stages. """
+    pool = make_pool(num_processes, tile_store_directories)
+    try:
+        yield pool
+    finally:
         pool.close()
         pool.join()
 
+
+def make_scheduler(num_processes, tile_store_directories, image_timeout):
+    return Scheduler(num_processes, initializer=init_worker, initargs=(tile_store_directories,), timeout=image_timeout)
+
+
+def load_ledger(path_info):
+    path = path_info.alignment_ledger_filepath
+    if path not in ledgers:
+        ledgers[path] = AlignmentLedger(path)
+    return ledgers[path]
+
+
+def save_read_names(path_info, tile_store_directories):
+    """ Saves the names of all the reads, which the read IDs in the results refer to. """
+    read_names = TileStore().attach(tile_store_directories['all']).names
+    try:
+        if readrcs.save_read_names(path_info.read_names_filepath, read_names):
+            log.debug("Saved the names of %d reads" % len(read_names))
+    except ValueError as e:
+        error.fail(str(e))
+
+
+def save_tile_stores(path_info, tile_data_given_name):
+    """ Saves a TileStore for each non-empty set of reads, and returns the directories they were saved to. """
+    tile_store_directories = {}
+    for name, tile_data in tile_data_given_name.items():
+        if not tile_data:
+            continue
+        directory = os.path.join(path_info.tile_store_directory, name)
+        TileStore(tile_data).save(directory)
+        tile_store_directories[name] = directory
+    return tile_store_directories
+
+
+def run(cluster_strategies, rotation_adjustment, h5_filenames, path_info, snr, min_hits, end_tiles, alignment_channel, metadata, make_pdfs, sequencing_chip, precision_strategy, reuse_alignments, use_chip_model, scheduler, renderer=None):
+    image_count = count_images(h5_filenames, alignment_channel)
+    _, chunksize = calculate_process_count(image_count)
+
+    # Iterate over images that are probably inside an Illumina tile, attempt to align them, and if they
+    # align, do a precision alignment and write the mapped FastQ reads to disk
+    base_alignment_funcs = functools.partial(alignment_funcs, cluster_strategies, rotation_adjustment, path_info, snr, min_hits,
+                                             metadata['microns_per_pixel'], sequencing_chip, make_pdfs, precision_strategy)
+    if not reuse_alignments:
+        h5_filename_groups = [h5_filenames]
+    else:
+        # The stage returns to the same positions for every concentration, so once a field of view has been aligned
+        # in one file, its transform is a very good starting point in the next one. We have to go one file at a time
+        # so those alignments exist, and the most recently aligned file is tried first since it has drifted the least.
+        h5_filename_groups = [[h5_filename] for h5_filename in sorted(h5_filenames)]
+    # diagnostics are rendered in the background as soon as each image is done
+    finished = functools.partial(queue_diagnostics, renderer, path_info) if renderer is not None else None
+    records = []
+    seed_base_names = []
+    for group in h5_filename_groups:
+        group_alignment_funcs = functools.partial(base_alignment_funcs, list(reversed(seed_base_names)))
+        images = list(iterate_all_images(group, end_tiles, alignment_channel, path_info))
+        if use_chip_model:
+            records.extend(run_with_chip_models(group_alignment_funcs, group, images, alignment_channel, path_info, chunksize, scheduler, finished))
+        else:
+            records.extend(align_images(scheduler, group_alignment_funcs({}), images, finished))
+        seed_base_names.extend(os.path.splitext(h5_filename)[0] for h5_filename in group)
+    write_alignment_records(path_info, records)
+    report_failures(records)
+    if reuse_alignments or use_chip_model:
+        report_time_saved(records)
     log.debug("Done aligning!")
 
 
-def run_data_channel(cluster_strategy, h5_filenames, channel_name, path_info, alignment_tile_data, all_tile_data, metadata, clargs, process_limit):
-    image_count = count_images(h5_filenames, channel_name)
-    num_processes, chunksize = calculate_process_count(image_count)
-    if process_limit > 0:
-        num_processes = min(process_limit, num_processes)
-    log.debug("Aligning data images with %d cores with chunksize %d" % (num_processes, chunksize))
-
-    log.debug("Loading reads into FASTQ Image Aligner.")
-    fastq_image_aligner = fastqimagealigner.FastqImageAligner(metadata['microns_per_pixel'])
-    fastq_image_aligner.load_reads(alignment_tile_data)
-    log.debug("Reads loaded.")
-    second_processor = functools.partial(process_data_image, cluster_strategy, path_info, all_tile_data,
-                                         clargs.microns_per_pixel, clargs.make_pdfs,
-                                         channel_name, fastq_image_aligner, clargs.min_hits)
+def alignment_funcs(cluster_strategies, rotation_adjustment, path_info, snr, min_hits, um_per_pixel, sequencing_chip,
+                    make_pdfs, precision_strategy, seed_base_names, chip_models):
+    """ The functions the scheduler tries, in order, to align each image. Retries use the other precision strategy. """
+    return [functools.partial(perform_alignment, cluster_strategies, rotation_adjustment, path_info, snr, min_hits, um_per_pixel,
+                              sequencing_chip, make_pdfs, strategy, seed_base_names, chip_models)
+            for strategy in (precision_strategy, retry_precision_strategies[precision_strategy])]
+
+
+def align_images(scheduler, alignment_funcs, images, finished=None):
+    """
+    Aligns each image with the scheduler, and returns a record of what happened to each one. If finished is given,
+    it's called with each image's record as soon as the image is done.
+
+    """
+    def complete_record(index, record):
+        row, column, channel, h5_filename, _, _ = images[index]
+        method, aligned, cluster_strategy, strategy_diagnostics = record.pop('result') or (None, False, None, {})
+        record.update({'h5_filename': h5_filename, 'channel': channel, 'row': row, 'column': column,
+                       'method': method, 'aligned': aligned, 'cluster_strategy': cluster_strategy,
+                       'cluster_strategies': strategy_diagnostics})
+        if finished is not None:
+            finished(record)
+
+    return scheduler.run(alignment_funcs, [(image_data,) for image_data in images], complete_record)
+
+
+def queue_diagnostics(renderer, path_info, record):
+    if record['aligned'] and record['method'] != 'skipped':
+        base_name = os.path.splitext(record['h5_filename'])[0]
+        renderer.render([diagnostics.filepath(path_info.figure_directory, base_name, record['channel'], record['row'], record['column'])])
+
+
+def write_alignment_records(path_info, records):
+    # One JSON object per line, appended to by every run
+    with open(path_info.alignment_records_filepath, 'a') as f:
+        for record in records:
+            f.write(json.dumps(record, sort_keys=True) + '\n')
+
+
+def report_failures(records):
+    statuses = Counter(record['status'] for record in records)
+    log.info("Aligned %d of %d images. %d raised an error, %d timed out and %d crashed their worker, after retries."
+             % (sum(record['aligned'] for record in records), len(records),
+                statuses['error'], statuses['timeout'], statuses['crashed']))
+    for record in records:
+        if record['status'] != 'ok':
+            log.warn("Could not align %s row %d column %d: %s" % (record['h5_filename'], record['row'], record['column'], record['error']))
+
+
+def run_with_chip_models(alignment_funcs, h5_filenames, images, alignment_channel, path_info, chunksize, scheduler, finished=None):
+    """
+    Aligns images in waves that double in size. After each wave, the chip models are refitted with every image
+    aligned so far, so later images are more likely to be placed by the model instead of needing a full alignment.
+    The first wave is spread over the whole chip, so the model sees as many tiles as possible.
+
+    """
+    wave_size = max(chunksize, chipmodel.min_images)
+    stride = max(1, len(images) / wave_size)
+    images = images[::stride] + [image for index, image in enumerate(images) if index % stride]
+    records = []
+    while images:
+        chip_models = fit_chip_models(h5_filenames, alignment_channel, path_info)
+        wave, images = images[:wave_size], images[wave_size:]
+        records.extend(align_images(scheduler, alignment_funcs(chip_models), wave, finished))
+        wave_size *= 2
+    return records
+
+
+def fit_chip_models(h5_filenames, alignment_channel, path_info):
+    """ Fits a ChipModel to each HDF5 file from the images that have been aligned so far. """
+    ledger = load_ledger(path_info)
+    chip_models = {}
     for h5_filename in h5_filenames:
-        pool = multiprocessing.Pool(num_processes)
-        log.debug("Doing second channel alignment of all images with %d cores" % num_processes)
-        pool.map_async(second_processor,
-                       load_aligned_stats_files([h5_filename], metadata['alignment_channel'], path_info),
-                       chunksize=chunksize).get(sys.maxint)
-        pool.close()
-        pool.join()
-        gc.collect()
+        base_name = os.path.splitext(h5_filename)[0]
+        chip_model = chipmodel.ChipModel()
+        for row, column, alignment_stats in ledger.aligned(base_name, alignment_channel):
+            chip_model.add(row, column, alignment_stats)
+        if chip_model.fit().fitted:
+            chip_models[base_name] = chip_model
+    return chip_models
+
+
+def report_time_saved(records):
+    """
+    Estimates how much work was saved by reusing alignments and predicting them with the chip model, from the
+    method and seconds of each image's record.
+
+    """
+    seconds_given_method = defaultdict(list)
+    for record in records:
+        if record['status'] == 'ok':
+            seconds_given_method[record['method']].append(record['seconds'])
+    reused, predicted, full = seconds_given_method['reused'], seconds_given_method['predicted'], seconds_given_method['full']
+    log.info("Reused alignments for %d images and predicted them for %d, %d needed a full alignment after trying one of those, "
+             "%d had nothing to start from" % (len(reused), len(predicted), len(seconds_given_method['fallback']), len(full)))
+    if not (reused or predicted) or not full:
+        return
+    mean_full = sum(full) / len(full)
+    mean_shortcut = sum(reused + predicted) / len(reused + predicted)
+    # images that had to fall back wasted the time spent trying the shortcut
+    wasted = sum(seconds - mean_full for seconds in seconds_given_method['fallback'])
+    saved = len(reused + predicted) * (mean_full - mean_shortcut) - wasted
+    log.info("Full alignments took %.2f seconds on average and reused or predicted ones took %.2f. Time saved: %.0f seconds of worker time."
+             % (mean_full, mean_shortcut, saved))
 
+
+def run_data_channel(cluster_strategies, h5_filenames, channel_name, path_info, tile_store_name, metadata, clargs, pool, renderer=None):
+    image_count = count_images(h5_filenames, channel_name)
+    _, chunksize = calculate_process_count(image_count)
+    log.debug("Aligning data images with chunksize %d" % chunksize)
+
+    second_processor = functools.partial(process_data_image, cluster_strategies, path_info,
+                                         clargs.microns_per_pixel, clargs.make_pdfs,
+                                         channel_name, clargs.min_hits, clargs.precision_strategy, tile_store_name)
+    log.debug("Doing second channel alignment of all images")
+    images = list(load_aligned_images(h5_filenames, metadata['alignment_channel'], path_info))
+    pool.map_async(second_processor, images, chunksize=chunksize).get(sys.maxint)
+    if renderer is not None:
+        renderer.render([diagnostics.filepath(path_info.figure_directory, base_name, channel_name, row, column)
+                         for _, base_name, _, row, column in images])
     log.debug("Done aligning!")
 
 
-def alignment_is_complete(stats_file_path):
-    existing_score = load_existing_score(stats_file_path)
-    if existing_score > 0:
-        return True
-    return False
+def alignment_is_complete(path_info, base_name, channel, row, column):
+    return load_ledger(path_info).score(base_name, channel, row, column) > 0
 
 
-def perform_alignment(cluster_strategy, rotation_adjustment, path_info, snr, min_hits, um_per_pixel, sequencing_chip, all_tile_data,
-                      make_pdfs, prefia, image_data):
+@instrument.timed('align_image')
+def perform_alignment(cluster_strategies, rotation_adjustment, path_info, snr, min_hits, um_per_pixel, sequencing_chip,
+                      make_pdfs, precision_strategy, seed_base_names, chip_models, image_data):
     # Does a rough alignment, and if that works, does a precision alignment and writes the corrected
-    # FastQ reads to disk
-    try:
-        row, column, channel, h5_filename, possible_tile_keys, base_name = image_data
+    # FastQ reads to disk. If the same field of view was already aligned in one of the files in seed_base_names,
+    # that alignment is refined instead. Otherwise, if the chip model for this file can predict the alignment,
+    # the prediction is refined. The precision alignment is done with the clusters of each cluster strategy, and
+    # the best one is kept. Returns how the image was aligned, whether it aligned, the cluster strategy that was
+    # used and the score of each cluster strategy.
+    start_time = time.time()
+    row, column, channel, h5_filename, possible_tile_keys, base_name = image_data
 
-        image = load_image(h5_filename, channel, row, column)
-        stats_file_path = os.path.join(path_info.results_directory, base_name, '{}_stats.txt'.format(image.index))
-        if alignment_is_complete(stats_file_path):
-            log.debug("Already aligned %s from %s" % (image.index, h5_filename))
-            return
-
-        log.debug("Aligning image from %s. Row: %d, Column: %d " % (base_name, image.row, image.column))
-        # first get the correlation to random tiles, so we can distinguish signal from noise
-        fia = process_alignment_image(cluster_strategy, rotation_adjustment, snr, sequencing_chip, base_name, um_per_pixel, image, possible_tile_keys, deepcopy(prefia))
+    image = load_image(h5_filename, channel, row, column)
+    if alignment_is_complete(path_info, base_name, channel, row, column):
+        log.debug("Already aligned %s from %s" % (image.index, h5_filename))
+        return 'skipped', True, None, {}
+
+    method = 'full'
+    seed_stats = load_seed_stats(path_info, seed_base_names, channel, row, column)
+    if seed_stats is not None:
+        cluster_strategy, fia, strategy_diagnostics = reuse_alignment(cluster_strategies, min_hits, base_name, um_per_pixel, image, seed_stats,
+                                                                      seed_min_score_fraction * seed_stats.score, seed_search_radius)
+        if fia is not None:
+            result = write_output(image, base_name, cluster_strategy, fia, path_info, worker_tile_stores['all'], make_pdfs, um_per_pixel,
+                                  'reused', time.time() - start_time)
+            log.debug("Wrote reused alignment for %s: %s" % (image.index, result))
+            return 'reused', True, cluster_strategy, strategy_diagnostics
+        log.debug("Could not reuse alignment for %s, doing a full alignment" % image.index)
+        method = 'fallback'
+
+    chip_model = chip_models.get(base_name)
+    predicted_stats = None
+    if chip_model is not None and method == 'full':
+        predicted_stats = chip_model.predict(image.row, image.column, possible_tile_keys, image.shape, worker_tile_stores['alignment'])
+    if predicted_stats is not None:
+        cluster_strategy, fia, strategy_diagnostics = reuse_alignment(cluster_strategies, min_hits, base_name, um_per_pixel, image, predicted_stats,
+                                                                      seed_min_score_fraction * chip_model.score,
+                                                                      max(seed_search_radius, chip_model.search_radius))
+        if fia is not None:
+            result = write_output(image, base_name, cluster_strategy, fia, path_info, worker_tile_stores['all'], make_pdfs, um_per_pixel,
+                                  'predicted', time.time() - start_time)
+            log.debug("Wrote predicted alignment for %s: %s" % (image.index, result))
+            return 'predicted', True, cluster_strategy, strategy_diagnostics
+        log.debug("Could not use predicted alignment for %s, doing a full alignment" % image.index)
+        method = 'fallback'
+
+    log.debug("Aligning image from %s. Row: %d, Column: %d " % (base_name, image.row, image.column))
+    # first get the correlation to random tiles, so we can distinguish signal from noise
+    fia = fastqimagealigner.FastqImageAligner(um_per_pixel, worker_tile_stores['alignment'])
+    fia = process_alignment_image(cluster_strategies, rotation_adjustment, snr, sequencing_chip, base_name, um_per_pixel, image, possible_tile_keys, fia)
 
-        if fia.hitting_tiles:
-            # The image data aligned with FastQ reads!
-            try:
-                fia.precision_align_only(min_hits=min_hits)
-            except ValueError:
-                log.debug("Too few hits to perform precision alignment. Image: %s Row: %d Column: %d " % (base_name, image.row, image.column))
-            else:
-                result = write_output(stats_file_path, image.index, base_name, fia, path_info, all_tile_data, make_pdfs, um_per_pixel)
-                print("Write alignment for %s: %s" % (image.index, result))
-        # Force the GC to run, since otherwise memory usage blows up
-        del fia
-        del image
-        gc.collect()
-    except IndexError:
-        # This happens and we don't know why. We'll just throw out the data since it's very rare
-        pass
+    if fia.hitting_tiles:
+        # The image data aligned with FastQ reads!
+        cluster_strategy, fia, strategy_diagnostics = refine_alignment(cluster_strategies, min_hits, precision_strategy, base_name, image, fia)
+        if fia is not None:
+            result = write_output(image, base_name, cluster_strategy, fia, path_info, worker_tile_stores['all'], make_pdfs, um_per_pixel,
+                                  method, time.time() - start_time)
+            print("Write alignment for %s: %s" % (image.index, result))
+            return method, True, cluster_strategy, strategy_diagnostics
+        log.debug("Too few hits to perform precision alignment. Image: %s Row: %d Column: %d " % (base_name, image.row, image.column))
+        return method, False, None, strategy_diagnostics
+    return method, False, None, {}
+
+
+def clusters_filepath(base_name, image_index, cluster_strategy):
+    return os.path.join(base_name, '%s.clusters.%s' % (image_index, cluster_strategy))
+
+
+def refine_alignment(cluster_strategies, min_hits, precision_strategy, base_name, image, fia, **mapping_kwargs):
+    """
+    Does a precision alignment of a copy of the aligner with the clusters of each cluster strategy, starting from
+    the aligner's current alignment. The rough alignment only depends on the image, so it's done once no matter how
+    many strategies there are. Returns the strategy that scored best and its aligner (or None for both if no
+    strategy worked), and the score and hits of each strategy, or why it failed.
+
+    """
+    best_strategy, best_fia, best_score = None, None, 0
+    strategy_diagnostics = {}
+    for cluster_strategy in cluster_strategies:
+        sexcat_fpath = clusters_filepath(base_name, image.index, cluster_strategy)
+        if not os.path.exists(sexcat_fpath):
+            strategy_diagnostics[cluster_strategy] = {'score': 0, 'error': "No clusters file"}
+            continue
+        strategy_fia = fia.copy_alignment()
+        strategy_fia.set_sexcat_from_file(sexcat_fpath, cluster_strategy)
+        try:
+            strategy_fia.precision_align_only(min_hits, precision_strategy, **mapping_kwargs)
+        except (KeyError, ValueError) as e:
+            strategy_diagnostics[cluster_strategy] = {'score': 0, 'error': str(e)}
+            continue
+        alignment_stats = strategy_fia.alignment_stats
+        strategy_diagnostics[cluster_strategy] = {'score': alignment_stats.score, 'hits': alignment_stats.hits,
+                                                  'clusters': len(strategy_fia.clusters.point_rcs)}
+        log.debug("Cluster strategy %s scored %d for %s" % (cluster_strategy, alignment_stats.score, image.index))
+        if best_fia is None or alignment_stats.score > best_score:
+            best_strategy, best_fia, best_score = cluster_strategy, strategy_fia, alignment_stats.score
+    return best_strategy, best_fia, strategy_diagnostics
+
+
+def load_seed_stats(path_info, seed_base_names, channel, row, column):
+    # Finds the alignment of the same field of view in another file, if there is one
+    ledger = load_ledger(path_info)
+    for seed_base_name in seed_base_names:
+        seed_stats = ledger.stats(seed_base_name, channel, row, column)
+        if seed_stats is not None and seed_stats.score > 0:
+            return seed_stats
+    return None
+
+
+def reuse_alignment(cluster_strategies, min_hits, base_name, um_per_pixel, image, seed_stats, min_score, search_radius):
+    """
+    Skips the rough alignment and goes straight to a precision alignment, starting from the transform of the same
+    field of view in another concentration, or the one predicted by the chip model. Returns the same as
+    refine_alignment, except that there's no aligner if the best strategy scores less than min_score.
+
+    """
+    fia = fastqimagealigner.FastqImageAligner(um_per_pixel, worker_tile_stores['alignment'])
+    fia.set_image_data(image, um_per_pixel)
+    try:
+        fia.alignment_from_alignment_stats(seed_stats)
+    except KeyError:
+        return None, None, {}
+    cluster_strategy, fia, strategy_diagnostics = refine_alignment(cluster_strategies, min_hits, 'ransac', base_name, image, fia,
+                                                                   search_radius=search_radius)
+    if fia is None or fia.alignment_stats.score < min_score:
+        # the drift was too large, the prediction was wrong, or something changed, so the hits dropped off
+        return None, None, strategy_diagnostics
+    return cluster_strategy, fia, strategy_diagnostics
 
 
 def make_output_directories(h5_filenames, path_info):
@@ -120,22 +390,49 @@ def make_output_directories(h5_filenames, path_info):
                 os.makedirs(full_directory)
 
 
-def get_end_tiles(cluster_strategies, rotation_adjustment, h5_filenames, alignment_channel, snr, metadata, sequencing_chip, fia):
-    right_end_tiles = {}
-    left_end_tiles = {}
-    for cluster_strategy in cluster_strategies:
-        with h5py.File(h5_filenames[0]) as first_file:
-            grid = GridImages(first_file, alignment_channel)
-            # no reason to use all cores yet, since we're IO bound?
-            num_processes = len(h5_filenames)
-            pool = multiprocessing.Pool(num_processes)
-            base_column_checker = functools.partial(check_column_for_alignment, cluster_strategy, rotation_adjustment, alignment_channel, snr, sequencing_chip, metadata['microns_per_pixel'], fia)
-            left_end_tiles = dict(find_bounds(pool, h5_filenames, base_column_checker, grid.columns, sequencing_chip.left_side_tiles))
-            right_end_tiles = dict(find_bounds(pool, h5_filenames, base_column_checker, reversed(grid.columns), sequencing_chip.right_side_tiles))
-            pool.close()
-            pool.join()
-            if left_end_tiles and right_end_tiles:
-                break
+def merge_results(h5_filenames, path_info):
+    """
+    Merges the images that have been written into each concentration's results file. This must only be done while no
+    images are being aligned. If a results file was corrupt, the images that were lost with it are removed from the
+    ledger so that they'll be aligned again, and this returns True.
+
+    """
+    ledger = load_ledger(path_info)
+    lost_images = False
+    for h5_filename in h5_filenames:
+        base_name = os.path.splitext(h5_filename)[0]
+        path = path_info.read_rcs_filepath(base_name)
+        corrupt = readrcs.recover(path)
+        merged = readrcs.merge(path)
+        if merged:
+            log.debug("Merged %d images into %s" % (merged, path))
+        if not corrupt:
+            continue
+        image_indexes = set(readrcs.image_indexes(os.path.dirname(path)))
+        for channel, row, column in ledger.images(base_name):
+            if "%s_%.3d_%.3d" % (channel, row, column) not in image_indexes:
+                ledger.forget(base_name, channel, row, column)
+                lost_images = True
+    return lost_images
+
+
+@instrument.timed('end_tile_search')
+def get_end_tiles(cluster_strategies, rotation_adjustment, h5_filenames, alignment_channel, snr, metadata, sequencing_chip, pool, num_processes):
+    # The left and right sides are searched at the same time, and each gets half of the workers
+    probes_per_round = max(1, num_processes / (2 * len(h5_filenames)))
+    searches = ThreadPool(2)
+    with h5py.File(h5_filenames[0]) as first_file:
+        grid = GridImages(first_file, alignment_channel)
+    # The rough alignment only depends on the image, so every cluster strategy is covered by one search
+    base_column_checker = functools.partial(check_column_for_alignment, cluster_strategies, rotation_adjustment, alignment_channel, snr, sequencing_chip, metadata['microns_per_pixel'])
+    left_search = searches.apply_async(find_bounds, (pool, h5_filenames, base_column_checker, grid.columns,
+                                                     sequencing_chip.left_side_tiles, probes_per_round))
+    right_search = searches.apply_async(find_bounds, (pool, h5_filenames, base_column_checker, list(reversed(grid.columns)),
+                                                      sequencing_chip.right_side_tiles, probes_per_round))
+    left_end_tiles = dict(left_search.get(sys.maxint))
+    right_end_tiles = dict(right_search.get(sys.maxint))
+    searches.close()
+    searches.join()
     if not left_end_tiles and not right_end_tiles:
         error.fail("End tiles could not be found! Try adjusting the rotation or look at the raw images.")
     default_left_tile, default_left_column = decide_default_tiles_and_columns(left_end_tiles)
@@ -179,56 +476,75 @@ def calculate_process_count(image_count):
 def extract_rc_info(stats_file):
     match = stats_regex.match(stats_file)
     if match:
-        return int(match.group('row')), int(match.group('column'))
+        return match.group('channel'), int(match.group('row')), int(match.group('column'))
     raise ValueError("Invalid stats file: %s" % str(stats_file))
 
 
-def load_aligned_stats_files(h5_filenames, alignment_channel, path_info):
+def import_stats_files(h5_filenames, cluster_strategy, path_info):
+    """ Adds the alignments in stats files written by older versions to the ledger, so that they can be resumed. """
+    ledger = load_ledger(path_info)
+    count = 0
+    for h5_filename in h5_filenames:
+        base_name = os.path.splitext(h5_filename)[0]
+        results_directory = os.path.join(path_info.results_directory, base_name)
+        if not os.path.isdir(results_directory):
+            continue
+        for filename in os.listdir(results_directory):
+            if not filename.endswith('_stats.txt'):
+                continue
+            try:
+                channel, row, column = extract_rc_info(filename)
+                with open(os.path.join(results_directory, filename)) as f:
+                    alignment_stats = stats.AlignmentStats().from_file(f)
+            except (TypeError, ValueError):
+                log.warn("Invalid stats file: %s" % str(filename))
+                continue
+            if not os.path.exists(os.path.join(results_directory, '{}_all_read_rcs.txt'.format(filename[:-len('_stats.txt')]))):
+                # the alignment was interrupted before the reads were written
+                continue
+            ledger.record(base_name, channel, row, column, cluster_strategy, alignment_stats, 'imported')
+            count += 1
+    log.debug("Imported %d alignments from stats files" % count)
+
+
+def load_aligned_images(h5_filenames, alignment_channel, path_info):
+    ledger = load_ledger(path_info)
     for h5_filename in h5_filenames:
         base_name = os.path.splitext(h5_filename)[0]
-        for filename in os.listdir(os.path.join(path_info.results_directory, base_name)):
-            if filename.endswith('_stats.txt') and alignment_channel in filename:
-                try:
-                    row, column = extract_rc_info(filename)
-                except ValueError:
-                    log.warn("Invalid stats file: %s" % str(filename))
-                    continue
-                else:
-                    yield h5_filename, base_name, filename, row, column
-
-
-def process_data_image(cluster_strategy, path_info, all_tile_data, um_per_pixel, make_pdfs, channel,
-                       fastq_image_aligner, min_hits, (h5_filename, base_name, stats_filepath, row, column)):
+        for row, column in sorted(ledger.completed(base_name, alignment_channel), key=lambda (row, column): (column, row)):
+            yield h5_filename, base_name, alignment_channel, row, column
+
+
+def process_data_image(cluster_strategies, path_info, um_per_pixel, make_pdfs, channel,
+                       min_hits, precision_strategy, tile_store_name, (h5_filename, base_name, alignment_channel, row, column)):
+    start_time = time.time()
     image = load_image(h5_filename, channel, row, column)
-    alignment_stats_file_path = os.path.join(path_info.results_directory, base_name, stats_filepath)
-    data_stats_file_path = os.path.join(path_info.results_directory, base_name, '{}_stats.txt'.format(image.index))
-    if alignment_is_complete(data_stats_file_path):
+    if alignment_is_complete(path_info, base_name, channel, row, column):
         log.debug("Already aligned %s from %s" % (image.index, h5_filename))
-        del image
-        gc.collect()
         return
-    sexcat_filepath = os.path.join(base_name, '%s.clusters.%s' % (image.index, cluster_strategy))
-    local_fia = deepcopy(fastq_image_aligner)
+    alignment_stats = load_ledger(path_info).stats(base_name, alignment_channel, row, column)
+    local_fia = fastqimagealigner.FastqImageAligner(um_per_pixel, worker_tile_stores[tile_store_name])
     local_fia.set_image_data(image, um_per_pixel)
-    local_fia.set_sexcat_from_file(sexcat_filepath, cluster_strategy)
-    local_fia.alignment_from_alignment_file(alignment_stats_file_path)
+    local_fia.alignment_from_alignment_stats(alignment_stats)
     try:
-        local_fia.precision_align_only(min_hits)
-    except (IndexError, ValueError):
+        cluster_strategy, local_fia, _ = refine_alignment(cluster_strategies, min_hits, precision_strategy, base_name, image, local_fia)
+    except IndexError:
+        local_fia = None
+    if local_fia is None:
         log.debug("Could not precision align %s" % image.index)
     else:
-        log.debug("Processed data channel for %s" % image.index)
-        write_output(data_stats_file_path, image.index, base_name, local_fia, path_info, all_tile_data, make_pdfs, um_per_pixel)
-    finally:
-        del local_fia
-        del image
-    gc.collect()
+        log.debug("Processed data channel for %s with cluster strategy %s" % (image.index, cluster_strategy))
+        write_output(image, base_name, cluster_strategy, local_fia, path_info, worker_tile_stores['all'], make_pdfs, um_per_pixel,
+                     'data', time.time() - start_time)
 
 
 def load_image(h5_filename, channel, row, column):
-    with h5py.File(h5_filename) as h5:
+    with h5py.File(h5_filename, 'r') as h5:
         grid = GridImages(h5, channel)
-        return grid.get(row, column)
+        image = grid.get(row, column)
+    if image is not None:
+        instrument.count('image_bytes_read', image.nbytes)
+    return image
 
 
 def decide_default_tiles_and_columns(end_tiles):
@@ -242,20 +558,77 @@ def decide_default_tiles_and_columns(end_tiles):
     return best_tile, best_column
 
 
-def find_bounds(pool, h5_filenames, base_column_checker, columns, possible_tile_keys):
-    end_tiles = Manager().dict()
-    for column in columns:
-        column_checker = functools.partial(base_column_checker, end_tiles, column, possible_tile_keys)
-        pool.map_async(column_checker, h5_filenames).get(sys.maxint)
-        if end_tiles:
-            return end_tiles
-    return {}
+def find_bounds(pool, h5_filenames, base_column_checker, columns, possible_tile_keys, probes_per_round=1):
+    """
+    Finds the outermost column (the first one in `columns`) with an image that aligns in any of the HDF5 files,
+    and returns the tiles and column of the image that aligned in each file.
+
+    The lane runs continuously across the chip, so every column between its two ends should align, and the
+    columns that don't are all at the edges. So rather than checking one column at a time, we check several at
+    once: first galloping in from the edge (columns 0, 1, 3, 7, ...) until one aligns, and then narrowing down
+    on the first column that aligns between it and the last one that didn't. If the galloping finds nothing, the
+    columns it jumped over are checked in order, just as before. Once a column aligns, workers skip
+    any columns further in that haven't been started yet.
+
+    """
+    # the manager's server process is only needed for this search
+    with Manager() as manager:
+        return search_bounds(pool, h5_filenames, base_column_checker, list(columns), possible_tile_keys, probes_per_round,
+                             manager.dict())
+
+
+def search_bounds(pool, h5_filenames, base_column_checker, columns, possible_tile_keys, probes_per_round, found):
+    """ Does the search for find_bounds. found is a dict shared with the workers. """
+    end_tiles_given_position = {}
+
+    def check(positions):
+        async_results = []
+        for position in positions:
+            column_checker = functools.partial(base_column_checker, found, position, columns[position], possible_tile_keys)
+            async_results.extend((position, pool.apply_async(column_checker, (h5_filename,))) for h5_filename in h5_filenames)
+        for position, async_result in async_results:
+            result = async_result.get(sys.maxint)
+            end_tiles = end_tiles_given_position.setdefault(position, {})
+            if result is not None:
+                h5_filename, tile_keys, column = result
+                end_tiles[h5_filename] = tile_keys, column
+        return [position for position in positions if end_tiles_given_position[position]]
+
+    # gallop in from the edge until some column aligns
+    low, high = 0, None
+    while high is None and low < len(columns):
+        probes = sorted(set(min(low + 2 ** i - 1, len(columns) - 1) for i in range(probes_per_round)))
+        aligned = check(probes)
+        if aligned:
+            high = min(aligned)
+            low = max([low - 1] + [position for position in probes if position < high]) + 1
+        else:
+            low = probes[-1] + 1
+    if high is None:
+        # the galloping may have jumped over a narrow band of aligning columns, so check the ones it skipped
+        unchecked = [position for position in range(len(columns)) if position not in end_tiles_given_position]
+        for start in range(0, len(unchecked), probes_per_round):
+            aligned = check(unchecked[start:start + probes_per_round])
+            if aligned:
+                return end_tiles_given_position[min(aligned)]
+        return {}
 
+    # everything before low failed, and high aligned, so narrow down on the first column in between that aligns
+    while low < high:
+        probes = sorted(set(low + (high - low) * i / probes_per_round for i in range(probes_per_round)))
+        aligned = check(probes)
+        if aligned:
+            high = min(aligned)
+        low = max([low - 1] + [position for position in probes if position < high]) + 1
+    return end_tiles_given_position[high]
 
-def check_column_for_alignment(cluster_strategy, rotation_adjustment, channel, snr, sequencing_chip, um_per_pixel, fia,
-                               end_tiles, column, possible_tile_keys, h5_filename):
+
+def check_column_for_alignment(cluster_strategies, rotation_adjustment, channel, snr, sequencing_chip, um_per_pixel,
+                               found, position, column, possible_tile_keys, h5_filename):
+    # `found` is shared by all the workers searching from one side, and holds the position of the outermost column
+    # known to align. Any column further in than that can't be the answer, so we don't bother checking it.
     base_name = os.path.splitext(h5_filename)[0]
-    with h5py.File(h5_filename) as h5:
+    with h5py.File(h5_filename, 'r') as h5:
         grid = GridImages(h5, channel)
         # we assume odd numbers of rows, and good enough for now
         if grid.height > 2:
@@ -265,45 +638,43 @@ def check_column_for_alignment(cluster_strategy, rotation_adjustment, channel, s
             # just one or two rows, might as well try them all
             rows_to_check = tuple([i for i in range(grid.height)])
         for row in rows_to_check:
+            if found.get('position', len(grid.columns)) < position:
+                log.debug("Skipping %s Column %d since a column further out already aligned" % (base_name, column))
+                return
             image = grid.get(row, column)
             if image is None:
                 log.warn("Could not find an image for %s Row %d Column %d" % (base_name, row, column))
                 return
             log.debug("Aligning %s Row %d Column %d against PhiX" % (base_name, row, column))
-            fia = process_alignment_image(cluster_strategy, rotation_adjustment, snr, sequencing_chip, base_name, um_per_pixel, image, possible_tile_keys, deepcopy(fia))
+            fia = fastqimagealigner.FastqImageAligner(um_per_pixel, worker_tile_stores['alignment'])
+            fia = process_alignment_image(cluster_strategies, rotation_adjustment, snr, sequencing_chip, base_name, um_per_pixel, image, possible_tile_keys, fia)
             if fia.hitting_tiles:
                 log.debug("%s aligned to at least one tile!" % image.index)
-                # because of the way we iterate through the images, if we find one that aligns,
-                # we can just stop because that gives us the outermost column of images and the
-                # outermost FastQ tile
-                end_tiles[h5_filename] = [tile.key for tile in fia.hitting_tiles], image.column
-                break
-    del fia
-    gc.collect()
+                if found.get('position', position) >= position:
+                    found['position'] = position
+                return h5_filename, [tile.key for tile in fia.hitting_tiles], image.column
 
 
 def iterate_all_images(h5_filenames, end_tiles, channel, path_info):
     # We need an iterator over all images to feed the parallel processes. Since each image is
     # processed independently and in no particular order, we need to return information in addition
     # to the image itself that allow files to be written in the correct place and such
+    ledger = load_ledger(path_info)
     for h5_filename in h5_filenames:
         base_name = os.path.splitext(h5_filename)[0]
-        with h5py.File(h5_filename) as h5:
+        # the ledger entry is written last, so an image in it has all of its output
+        completed = ledger.completed(base_name, channel)
+        with h5py.File(h5_filename, 'r') as h5:
             grid = GridImages(h5, channel)
             min_column, max_column, tile_map = end_tiles[h5_filename]
             for column in range(min_column, max_column):
                 for row in range(grid._height):
+                    if (row, column) in completed:
+                        log.debug("Image already aligned/checkpointed: {}/{} {} {}".format(h5_filename, channel, row, column))
+                        continue
                     image = grid.get(row, column)
                     if image is None:
                         continue
-                    stats_path = os.path.join(path_info.results_directory, base_name,
-                                              '{}_stats.txt'.format(image.index))
-                    alignment_path = os.path.join(path_info.results_directory, base_name,
-                                                  '{}_all_read_rcs.txt'.format(image.index))
-                    already_aligned = alignment_is_complete(stats_path) and os.path.exists(alignment_path)
-                    if already_aligned:
-                        log.debug("Image already aligned/checkpointed: {}/{}".format(h5_filename, image.index))
-                        continue
                     yield row, column, channel, h5_filename, tile_map[image.column], base_name
 
 
@@ -327,66 +698,51 @@ def load_read_names(file_path):
     return {key: list(values) for key, values in tiles.items()}
 
 
-def process_alignment_image(cluster_strategy, rotation_adjustment, snr, sequencing_chip, base_name, um_per_pixel, image, possible_tile_keys, fia):
+def process_alignment_image(cluster_strategies, rotation_adjustment, snr, sequencing_chip, base_name, um_per_pixel, image, possible_tile_keys, fia):
     fia.set_image_data(image, um_per_pixel)
-    sexcat_fpath = os.path.join(base_name, '%s.clusters.%s' % (image.index, cluster_strategy))
-    if not os.path.exists(sexcat_fpath):
+    # the rough alignment doesn't use the clusters, but there's no point in doing it if we can't precision align
+    if not any(os.path.exists(clusters_filepath(base_name, image.index, cluster_strategy)) for cluster_strategy in cluster_strategies):
         return fia
-    fia.set_sexcat_from_file(sexcat_fpath, cluster_strategy)
     fia.rough_align(possible_tile_keys,
                     sequencing_chip.rotation_estimate + rotation_adjustment,
                     sequencing_chip.tile_width,
                     snr_thresh=snr)
     if fia.hitting_tiles:
-        log.debug("Rough aligned %s with cluster strategy: %s" % (image.index, cluster_strategy))
+        log.debug("Rough aligned %s" % image.index)
         return fia
     # return the fastq image aligner, even if nothing aligned.
     # the empty fia.hitting_tiles will be recognized and the field of view will be skipped
     return fia
 
 
-def load_existing_score(stats_file_path):
-    if os.path.isfile(stats_file_path):
-        with open(stats_file_path) as f:
-            try:
-                return stats.AlignmentStats().from_file(f).score
-            except (TypeError, ValueError):
-                return 0
-    return 0
-
-
-def write_output(stats_file_path, image_index, base_name, fastq_image_aligner, path_info, all_tile_data, make_pdfs, um_per_pixel):
-    all_read_rcs_filepath = os.path.join(path_info.results_directory, base_name, '{}_all_read_rcs.txt'.format(image_index))
+@instrument.timed('write_output')
+def write_output(image, base_name, cluster_strategy, fastq_image_aligner, path_info, all_tile_store, make_pdfs, um_per_pixel,
+                 method=None, seconds=None):
+    image_index = image.index
 
     # if we've already aligned this channel with a different strategy, the current alignment may or may not be better
     # here we load some data so we can make that comparison
-    existing_score = load_existing_score(stats_file_path)
+    ledger = load_ledger(path_info)
+    existing_score = ledger.score(base_name, image.channel, image.row, image.column)
 
     new_stats = fastq_image_aligner.alignment_stats
     if existing_score > 0:
         log.debug("Alignment already exists for %s/%s, skipping. Score difference: %d." % (base_name, image_index, (new_stats.score - existing_score)))
         return False
 
-    # save information about how to align the images
     log.info("Saving alignment with score of %s\t\t%s" % (new_stats.score, base_name))
-    with open(stats_file_path, 'w') as f:
-        f.write(new_stats.serialized)
-
     # save the corrected location of each read
-    all_fastq_image_aligner = fastqimagealigner.FastqImageAligner(um_per_pixel)
-    all_fastq_image_aligner.all_reads_fic_from_aligned_fic(fastq_image_aligner, all_tile_data)
-    with open(all_read_rcs_filepath, 'w') as f:
-        for line in all_fastq_image_aligner.read_names_rcs:
-            f.write(line)
+    read_ids, rcs = fastq_image_aligner.reads_in_frame(all_tile_store)
+    readrcs.write_image(path_info.read_rcs_filepath(base_name), path_info.read_names_filepath, image_index, read_ids, rcs)
+    instrument.count('images_aligned')
+    instrument.count('reads_written', len(read_ids))
 
-    # save some diagnostic PDFs that give a nice visualization of the alignment
+    # save what's needed for some diagnostic plots that give a nice visualization of the alignment. They're drawn
+    # by a separate pool of processes, so we don't wait on them here
     if make_pdfs:
-        ax = plotting.plot_all_hits(fastq_image_aligner)
-        ax.figure.savefig(os.path.join(path_info.figure_directory, base_name, '{}_all_hits.pdf'.format(image_index)))
-        plt.close()
-        ax = plotting.plot_hit_hists(fastq_image_aligner)
-        ax.figure.savefig(os.path.join(path_info.figure_directory, base_name, '{}_hit_hists.pdf'.format(image_index)))
-        plt.close()
-    del all_fastq_image_aligner
-    del fastq_image_aligner
+        diagnostics.save(diagnostics.filepath(path_info.figure_directory, base_name, image.channel, image.row, image.column),
+                         base_name + '.h5', image, fastq_image_aligner)
+
+    # save information about how to align the images. This is done last, since it marks the image as finished
+    ledger.record(base_name, image.channel, image.row, image.column, cluster_strategy, new_stats, method, seconds)
     return True
@@ -122,12 +122,12 @@ class Analysis(object):
                 for path in self.h5_paths]
 
 
-def get_int_scores(sorted_h5_filepaths, results_directories, lda_path):
+def get_int_scores(sorted_h5_filepaths, results_directories, lda_path, processes=1, incremental=False):
     int_scores = intensity.IntensityScores(sorted_h5_filepaths)
-    int_scores.get_LDA_scores(results_directories, lda_path)
+    int_scores.get_LDA_scores(results_directories, lda_path, processes=processes, incremental=incremental)
     with warnings.catch_warnings():
         warnings.filterwarnings("ignore", category=DeprecationWarning)
-        int_scores.normalize_scores()
+        int_scores.normalize_scores(processes=processes)
     return int_scores
 
 
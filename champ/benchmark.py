@@ -0,0 +1,191 @@
+"""
+Times the alignment of synthetic images whose true alignment is known.
+
+A synthetic chip has tiles of randomly placed reads. Each image is a field of view at a random position in one
+tile, with a transform close to the rough estimates the real pipeline uses. The clusters are a random subset of
+the reads in the frame, drawn with a Gaussian point spread function and noise. Each image gets a catalog of
+clusters in the format SExtractor writes, with some position error and some spurious clusters. The stages of
+the alignment are timed, and the transform that was found is compared against the true one.
+
+"""
+import json
+import logging
+import os
+import platform
+import shutil
+import tempfile
+import time
+import numpy as np
+from scipy import ndimage
+from champ import align, misc, readrcs
+from champ.config import PathInfo
+from champ.constants import VERSION
+from champ.fastqimagealigner import FastqImageAligner
+from champ.grid import Image
+from champ.tilestore import TileStore
+
+log = logging.getLogger(__name__)
+stages = ('rough_align', 'precision_align_only', 'find_hits', 'write_output')
+# Raw coordinates of reads in a tile range roughly over these values
+raw_min, raw_max = 1000, 30000
+image_shape = (512, 512)
+um_per_pixel = 0.266666666
+# Only some reads form clusters that are bright enough to be found
+detected_fraction = 0.7
+spurious_fraction = 0.05
+psf_sigma = 1.0
+position_error = 0.3
+background = 1000.0
+noise = 20.0
+# How far off the true transform can be from the rough estimates
+scale_error = 0.002
+rotation_error = 0.2
+# An alignment is correct if it puts every corner of the image within this many pixels of the truth
+tolerance = 1.0
+
+
+def synthetic_tiles(tile_keys, reads_per_tile, random_state):
+    """ Read names in the format of MiSeq and HiSeq reads, which end with the lane, tile, x and y of the cluster. """
+    tile_data = {}
+    for tile_key in tile_keys:
+        lane, tile = tile_key[len('lane'):].split('tile')
+        rcs = random_state.randint(raw_min, raw_max, (reads_per_tile, 2))
+        tile_data[tile_key] = ['SYNTHETIC:1:000000000-BENCH:%s:%s:%d:%d' % (lane, tile, x, y) for x, y in rcs]
+    return tile_data
+
+
+def true_transform(sequencing_chip, tile_store, tile_key, random_state):
+    """ A scale, rotation and offset that place the image entirely inside the tile. """
+    scale = sequencing_chip.tile_width / (raw_max - raw_min) / um_per_pixel * (1.0 + random_state.normal(0, scale_error))
+    rotation = np.deg2rad(sequencing_chip.rotation_estimate + random_state.normal(0, rotation_error))
+    tile_min, tile_max = tile_store.bounds(tile_key)
+    # leave enough room for the image whichever way it's rotated
+    margin = np.hypot(*image_shape) / scale
+    center = random_state.uniform(tile_min + margin, tile_max - margin)
+    offset = np.array(image_shape) / 2.0 - misc.apply_similarity_transform(center, scale, rotation, 0)
+    return scale, rotation, offset
+
+
+def render(tile_store, tile_key, scale, rotation, offset, random_state):
+    """ Returns the image and the lines of its cluster catalog. """
+    aligned_rcs = misc.apply_similarity_transform(tile_store.rcs[tile_key].astype(np.float), scale, rotation, offset)
+    in_frame = ((aligned_rcs >= 0) & (aligned_rcs < np.array(image_shape) - 1)).all(axis=1)
+    cluster_rcs = aligned_rcs[in_frame]
+    cluster_rcs = cluster_rcs[random_state.rand(len(cluster_rcs)) < detected_fraction]
+    brightness = random_state.lognormal(np.log(2000.0), 0.3, len(cluster_rcs))
+    image = np.zeros(image_shape)
+    # spread each cluster over its four nearest pixels so the centers aren't rounded
+    low = np.floor(cluster_rcs).astype(np.int)
+    fraction = cluster_rcs - low
+    for dr in (0, 1):
+        for dc in (0, 1):
+            weight = np.abs(1 - dr - fraction[:, 0]) * np.abs(1 - dc - fraction[:, 1])
+            np.add.at(image, (low[:, 0] + dr, low[:, 1] + dc), brightness * weight)
+    image = ndimage.gaussian_filter(image, psf_sigma) * 2 * np.pi * psf_sigma ** 2
+    image += background + random_state.normal(0, noise, image_shape)
+    found_rcs = cluster_rcs + random_state.normal(0, position_error, cluster_rcs.shape)
+    spurious_rcs = random_state.uniform(0, image_shape[0] - 1, (int(spurious_fraction * len(found_rcs)), 2))
+    lines = ['#   1 X_IMAGE\n', '#   2 Y_IMAGE\n']
+    for (r, c), flux in zip(np.concatenate([found_rcs, spurious_rcs]), np.concatenate([brightness, np.full(len(spurious_rcs), 500.0)])):
+        # SExtractor coordinates are 1-based, and x is the column
+        lines.append('%.3f %.3f %.1f %.1f 0 %.2f %.2f 0.0\n' % (c + 1, r + 1, flux, np.sqrt(flux), 2 * psf_sigma, 2 * psf_sigma))
+    return np.clip(image, 1, None).astype(np.uint16), lines
+
+
+def transform_error(tile, scale, rotation, offset):
+    """ How far apart, in pixels, the found and true transforms put the corners of the image. """
+    corners = np.array([[0, 0], [0, image_shape[1]], [image_shape[0], 0], image_shape], dtype=np.float)
+    raw_corners = misc.invert_similarity_transform(corners, scale, rotation, offset)
+    found_corners = misc.apply_similarity_transform(raw_corners, tile.scale, tile.rotation, tile.offset)
+    return float(np.sqrt(((found_corners - corners) ** 2).sum(axis=1)).max())
+
+
+def time_image(sequencing_chip, tile_store, tile_key, possible_tile_keys, directory, path_info, index, random_state, min_hits,
+               precision_strategy):
+    """ Aligns one synthetic image, and returns how long each stage took and how far off the alignment was. """
+    scale, rotation, offset = true_transform(sequencing_chip, tile_store, tile_key, random_state)
+    pixels, lines = render(tile_store, tile_key, scale, rotation, offset, random_state)
+    image = Image(pixels, index, 0, 'synthetic')
+    base_name = 'synthetic'
+    sexcat_fpath = align.clusters_filepath(os.path.join(directory, base_name), image.index, 'se')
+    with open(sexcat_fpath, 'w') as f:
+        f.writelines(lines)
+    seconds = {}
+    fia = FastqImageAligner(um_per_pixel, tile_store)
+    fia.set_image_data(image, um_per_pixel)
+    fia.set_sexcat_from_file(sexcat_fpath, 'se')
+    start_time = time.time()
+    fia.rough_align(possible_tile_keys, sequencing_chip.rotation_estimate, sequencing_chip.tile_width)
+    seconds['rough_align'] = time.time() - start_time
+    result = {'clusters': len(fia.clusters.point_rcs), 'seconds': seconds, 'aligned': False, 'error': None,
+              'rough_tiles': [tile.key for tile in fia.hitting_tiles]}
+    if tile_key not in result['rough_tiles']:
+        return result
+    start_time = time.time()
+    try:
+        fia.precision_align_only(min_hits, precision_strategy)
+    except ValueError:
+        return result
+    seconds['precision_align_only'] = time.time() - start_time
+    start_time = time.time()
+    fia.find_hits()
+    seconds['find_hits'] = time.time() - start_time
+    start_time = time.time()
+    align.write_output(image, base_name, 'se', fia, path_info, tile_store, False, um_per_pixel)
+    seconds['write_output'] = time.time() - start_time
+    tile = [tile for tile in fia.hitting_tiles if tile.key == tile_key][0]
+    result['error'] = transform_error(tile, scale, rotation, offset)
+    result['aligned'] = result['error'] <= tolerance
+    result['score'] = fia.alignment_stats.score
+    return result
+
+
+def summarize(values):
+    if not values:
+        return None
+    return {'mean': float(np.mean(values)), 'min': float(np.min(values)), 'max': float(np.max(values)), 'count': len(values)}
+
+
+def run(sequencing_chip, densities, images_per_density, min_hits=50, precision_strategy='lstsq', seed=0):
+    """
+    Aligns images_per_density synthetic images for each density, in clusters per image, and returns a report of
+    the timings and how many images were aligned correctly.
+
+    """
+    random_state = np.random.RandomState(seed)
+    # the tile the images are in, a neighbor that's also checked, and two more for the control correlation
+    tile_keys = sorted(sequencing_chip.left_side_tiles)[:4]
+    tile_pixels = sequencing_chip.tile_width / um_per_pixel
+    report = {'version': VERSION, 'chip': str(sequencing_chip), 'min_hits': min_hits, 'precision_strategy': precision_strategy, 'seed': seed,
+              'python': platform.python_version(), 'numpy': np.__version__, 'machine': platform.machine(),
+              'tolerance': tolerance, 'densities': []}
+    for density in densities:
+        reads_per_tile = int(density / detected_fraction * tile_pixels ** 2 / (image_shape[0] * image_shape[1]))
+        log.info("Benchmarking %d images with %d clusters each (%d reads per tile)" % (images_per_density, density, reads_per_tile))
+        tile_store = TileStore(synthetic_tiles(tile_keys, reads_per_tile, random_state))
+        directory = tempfile.mkdtemp(prefix='champ-benchmark-')
+        try:
+            path_info = PathInfo(directory, directory, None)
+            os.makedirs(os.path.join(directory, 'synthetic'))
+            os.makedirs(os.path.join(path_info.results_directory, 'synthetic'))
+            readrcs.save_read_names(path_info.read_names_filepath, tile_store.names)
+            results = [time_image(sequencing_chip, tile_store, tile_keys[0], tile_keys[:2], directory, path_info, index,
+                                  random_state, min_hits, precision_strategy) for index in range(images_per_density)]
+        finally:
+            shutil.rmtree(directory)
+            align.ledgers.clear()
+        errors = [result['error'] for result in results if result['error'] is not None]
+        report['densities'].append({'clusters_per_image': density,
+                                    'reads_per_tile': reads_per_tile,
+                                    'images': len(results),
+                                    'aligned': sum(result['aligned'] for result in results),
+                                    'max_error': max(errors) if errors else None,
+                                    'seconds': {stage: summarize([result['seconds'][stage] for result in results
+                                                                  if stage in result['seconds']]) for stage in stages},
+                                    'results': results})
+    return report
+
+
+def save(report, path):
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
@@ -0,0 +1,97 @@
+import logging
+import numpy as np
+from champ import misc, stats
+
+log = logging.getLogger(__name__)
+# The model isn't trusted until it has seen this many images
+min_images = 4
+# If the model can't explain the images it was fitted from to within this many pixels, it isn't used
+max_residual = 10.0
+# Predictions are refined by matching reads to clusters within this many multiples of the model's residual
+search_radius_factor = 3.0
+
+
+class ChipModel(object):
+    """
+    Predicts where an image is on the chip from the alignments of the other images in the same HDF5 file.
+
+    The stage moves the same distance between any two neighboring fields of view, so the offset of a tile
+    in an image is linear in the image's row and column, and every tile shifts by the same amount. Once a
+    handful of images have aligned, a least squares fit of that relationship places every other image that
+    lands on one of the tiles already seen, to within a few pixels. Tiles are rigid and don't overlap, so only
+    the tile that the image falls entirely inside of needs to be checked.
+
+    """
+    def __init__(self):
+        self._observations = []
+        self._scores = []
+        self._fitted = False
+
+    def add(self, row, column, alignment_stats):
+        for tile_key, scaling, tile_width, rotation, rc_offset, _ in alignment_stats:
+            self._observations.append((row, column, tile_key, scaling, tile_width, rotation, rc_offset))
+        self._scores.append(alignment_stats.score)
+        self._fitted = False
+        return self
+
+    def fit(self):
+        self._fitted = False
+        image_count = len(set((row, column) for row, column, _, _, _, _, _ in self._observations))
+        if image_count < min_images:
+            return self
+        rows, columns, tile_keys, scalings, tile_widths, rotations, rc_offsets = zip(*self._observations)
+        self.tile_keys = sorted(set(tile_keys))
+        design = self._design_matrix(rows, columns, tile_keys)
+        if np.linalg.matrix_rank(design) < design.shape[1]:
+            # e.g. every image so far is in the same column, so we can't tell how the offset changes between columns
+            return self
+        rc_offsets = np.array(rc_offsets, dtype=np.float)
+        self._coefficients = np.linalg.lstsq(design, rc_offsets, rcond=-1)[0]
+        self.residual = float(np.sqrt(((np.dot(design, self._coefficients) - rc_offsets) ** 2).sum(axis=1).mean()))
+        self.scaling = float(np.median(scalings))
+        self.tile_width = float(np.median(tile_widths))
+        self.rotation = float(np.angle(np.exp(1j * np.array(rotations)).mean()))
+        self.score = float(np.median(self._scores))
+        self._fitted = self.residual <= max_residual
+        log.debug("Chip model fitted from %d images with a residual of %.2f pixels" % (image_count, self.residual))
+        return self
+
+    @property
+    def fitted(self):
+        return self._fitted
+
+    @property
+    def search_radius(self):
+        return search_radius_factor * self.residual
+
+    def _design_matrix(self, rows, columns, tile_keys):
+        tile_indexes = [self.tile_keys.index(tile_key) for tile_key in tile_keys]
+        design = np.zeros((len(rows), 2 + len(self.tile_keys)))
+        design[:, 0] = rows
+        design[:, 1] = columns
+        design[np.arange(len(rows)), 2 + np.array(tile_indexes)] = 1.0
+        return design
+
+    def predict(self, row, column, possible_tile_keys, image_shape, tile_store):
+        """
+        Returns the predicted alignment of the image as AlignmentStats, or None if the model can't place the
+        image entirely inside one of the possible tiles.
+
+        """
+        if not self._fitted:
+            return None
+        corners = np.array([[0, 0], [0, image_shape[1]], [image_shape[0], 0], image_shape], dtype=np.float)
+        # how far into the tile the image has to be for us to be sure no other tile is in it
+        margin = self.search_radius / self.scaling
+        for tile_key in possible_tile_keys:
+            if tile_key not in self.tile_keys or tile_key not in tile_store:
+                continue
+            rc_offset = np.dot(self._design_matrix([row], [column], [tile_key]), self._coefficients)[0]
+            tile_corners = misc.invert_similarity_transform(corners, self.scaling, self.rotation, rc_offset)
+            tile_min, tile_max = tile_store.bounds(tile_key)
+            if (tile_corners >= tile_min + margin).all() and (tile_corners <= tile_max - margin).all():
+                hits = {'exclusive': 0, 'good_mutual': 0, 'bad_mutual': 0, 'non_mutual': 0}
+                return stats.AlignmentStats().from_data([tile_key], [self.scaling], [self.tile_width],
+                                                        [self.rotation * 180.0 / np.pi],
+                                                        [tuple(map(float, rc_offset))], hits)
+        return None
@@ -1,6 +1,7 @@
 import logging
 import os
 from chip import load
+from champ import readrcs
 
 
 class CommandLineArguments(object):
@@ -42,10 +43,17 @@ class CommandLineArguments(object):
                                  'h5',
                                  'align',
                                  'info',
+                                 'migrate',
+                                 'benchmark',
                                  'notebooks'):
             if self._arguments.get(possible_command):
                 return possible_command
 
+    @property
+    def densities(self):
+        # the numbers of clusters per image to benchmark
+        return [int(density) for density in (self._arguments['--densities'] or '500,1000,2000').split(',')]
+
     @property
     def fastq_directory(self):
         return self._arguments['FASTQ_DIRECTORY']
@@ -60,6 +68,11 @@ class CommandLineArguments(object):
         # flip images across the horizontal axis
         return self._arguments['--fliplr']
 
+    @property
+    def export_stats(self):
+        # write a legacy stats file for each aligned image from the alignment ledger
+        return self._arguments['--export-stats']
+
     @property
     def fiducial_only(self):
         return self._arguments['--fiducial-only']
@@ -68,10 +81,20 @@ class CommandLineArguments(object):
     def image_directory(self):
         return self._arguments['IMAGE_DIRECTORY']
 
+    @property
+    def images_per_density(self):
+        return int(self._arguments['--images-per-density'] or 3)
+
     @property
     def include_side_1(self):
         return self._arguments['--include-side-1']
 
+    @property
+    def instrumentation_directory(self):
+        # timings and counters of each run are kept next to the data the command works on, when there is some
+        directory = self._arguments.get('IMAGE_DIRECTORY') or self._arguments.get('OUTPUT_DIRECTORY')
+        return os.path.join(directory, 'instrumentation') if directory else None
+
     @property
     def log_level(self):
         log_level = {0: logging.ERROR,
@@ -85,6 +108,11 @@ class CommandLineArguments(object):
     def log_p_file_path(self):
         return self._arguments['--log-p-file']
 
+    @property
+    def image_timeout(self):
+        # seconds an image can take to align before its worker is killed. 0 indicates unlimited
+        return float(self._arguments['--image-timeout'] or 900)
+
     @property
     def make_pdfs(self):
         return self._arguments['--make-pdfs']
@@ -136,15 +164,40 @@ class CommandLineArguments(object):
         # Whether or not phiX reads should be mapped
         return self._arguments.get('--phix-bowtie')
 
+    @property
+    def png_thumbnails(self):
+        # draw the diagnostic plots as small PNGs instead of PDFs
+        return self._arguments['--png-thumbnails']
+
     @property
     def ports_on_right(self):
         return self._arguments['--ports-on-right']
 
+    @property
+    def precision_strategy(self):
+        # 'lstsq' fits all hits after discarding the longest ones, 'ransac' finds a robust fit and refines it
+        return self._arguments['--precision-strategy'] or 'lstsq'
+
     @property
     def process_limit(self):
         # 0 indicates unlimited
         return int(self._arguments['--process-limit'] or 0)
 
+    @property
+    def profile_stages(self):
+        # the stages to profile with cProfile, separated by commas
+        stages = self._arguments.get('--profile')
+        return [stage.strip() for stage in stages.split(',') if stage.strip()] if stages else []
+
+    @property
+    def report_filepath(self):
+        return self._arguments['REPORT_FILE']
+
+    @property
+    def reuse_alignments(self):
+        # start from the alignment of the same field of view in another concentration, when there is one
+        return self._arguments['--reuse-alignments']
+
     @property
     def rotation_adjustment(self):
         return float(self._arguments['--rotation-adjustment'] or 0.0)
@@ -158,6 +211,11 @@ class CommandLineArguments(object):
     def target_sequence_file(self):
         return self._arguments['--target-sequence-file'] or False
 
+    @property
+    def use_chip_model(self):
+        # predict where images are on the chip from the ones that have already aligned
+        return self._arguments['--chip-model']
+
 
 class PathInfo(object):
     """ Parses user-provided alignment parameters and provides a default in case no value was given. """
@@ -180,6 +238,14 @@ class PathInfo(object):
     def all_read_names_filepath(self):
         return os.path.join(self._mapped_reads, 'all_read_names.txt')
 
+    @property
+    def alignment_records_filepath(self):
+        return os.path.join(self.results_directory, 'alignment_records.txt')
+
+    @property
+    def alignment_ledger_filepath(self):
+        return os.path.join(self.results_directory, 'alignments.db')
+
     @property
     def figure_directory(self):
         return os.path.join(self._image_directory, 'figs')
@@ -200,6 +266,17 @@ class PathInfo(object):
             raise ValueError("This experiment did not have a perfect target set!")
         return os.path.join(self._mapped_reads, 'perfect_target_{}_read_names.txt'.format(self._perfect_target_name.lower()))
 
+    @property
+    def tile_store_directory(self):
+        return os.path.join(self._image_directory, 'tile_stores')
+
+    @property
+    def read_names_filepath(self):
+        return os.path.join(self.results_directory, readrcs.read_names_filename)
+
+    def read_rcs_filepath(self, base_name):
+        return os.path.join(self.results_directory, base_name, readrcs.results_filename)
+
     @property
     def results_directory(self):
         return os.path.join(self._image_directory, 'results')
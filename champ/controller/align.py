@@ -1,16 +1,18 @@
 import logging
 import os
-from champ import align, initialize, error, projectinfo, chip, fastqimagealigner, convert, fits
+from champ import align, initialize, error, projectinfo, chip, convert, fits, diagnostics, instrument
 from champ.config import PathInfo
-import gc
 
 log = logging.getLogger(__name__)
+# Each image is precision aligned with the clusters found by every one of these, and the best alignment is kept
 cluster_strategies = ('se',)
+precision_strategies = ('lstsq', 'ransac')
 
 
 def preprocess(image_directory, cache):
     log.debug("Fitsifying images from HDF5 files.")
-    fits.main(image_directory)
+    with instrument.timer('preprocess'):
+        fits.main(image_directory)
     cache['preprocessed'] = True
     initialize.save_cache(image_directory, cache)
 
@@ -21,6 +23,8 @@ def load_filenames(image_directory):
 
 
 def main(clargs):
+    if clargs.precision_strategy not in precision_strategies:
+        error.fail("Unknown precision strategy: %s. Choose one of: %s" % (clargs.precision_strategy, ", ".join(precision_strategies)))
     metadata = initialize.load_metadata(clargs.image_directory)
     cache = initialize.load_cache(clargs.image_directory)
     if not cache['preprocessed']:
@@ -38,6 +42,15 @@ def main(clargs):
                          metadata['alternate_good_target_reads_filename'])
     # Ensure we have the directories where output will be written
     align.make_output_directories(h5_filenames, path_info)
+    # Experiments started with older versions have a stats file for each image instead of an alignment ledger
+    if len(align.load_ledger(path_info)) == 0:
+        align.import_stats_files(h5_filenames, cluster_strategies[0], path_info)
+    # Images that were written but not merged by a run that was interrupted are merged now. If a results file was
+    # corrupt, the images that were lost with it are aligned again.
+    if align.merge_results(h5_filenames, path_info):
+        cache['phix_aligned'] = False
+        cache['protein_channels_aligned'] = []
+        initialize.save_cache(clargs.image_directory, cache)
 
     log.debug("Loading tile data.")
     sequencing_chip = chip.load(metadata['chip_type'])(metadata['ports_on_right'])
@@ -48,38 +61,66 @@ def main(clargs):
     all_tile_data = align.load_read_names(path_info.all_read_names_filepath)
     log.debug("Tile data loaded.")
 
-    # We use one process per concentration. We could theoretically speed this up since our machine
-    # has significantly more cores than the typical number of concentration points, but since it
-    # usually finds a result in the first image or two, it's not going to deliver any practical benefits
-    log.debug("Loading FastQImageAligner")
-    fia = fastqimagealigner.FastqImageAligner(clargs.microns_per_pixel)
-    fia.load_reads(alignment_tile_data)
-    log.debug("Loaded %s points" % sum([len(v) for v in alignment_tile_data.values()]))
-    log.debug("FastQImageAligner loaded.")
-
+    # The tile stores are saved to disk once here, and every worker process memory-maps them
+    log.debug("Saving tile stores")
+    tile_store_directories = align.save_tile_stores(path_info, {'alignment': alignment_tile_data,
+                                                                'all': all_tile_data,
+                                                                'on_target': on_target_tile_data,
+                                                                'perfect_target': perfect_tile_data})
+    log.debug("Saved %s points" % sum([len(v) for v in alignment_tile_data.values()]))
+    del alignment_tile_data, all_tile_data, on_target_tile_data, perfect_tile_data
+    log.debug("Tile stores saved.")
+    align.save_read_names(path_info, tile_store_directories)
+
+    # Each stage starts its own workers and stops them when it's done, so only one stage's workers run at a time
+    num_processes, _ = align.calculate_process_count(align.count_images(h5_filenames, metadata['alignment_channel']))
+    if clargs.process_limit > 0:
+        num_processes = min(clargs.process_limit, num_processes)
+    # Diagnostic plots are drawn in the background by low priority processes, while alignment carries on. They're
+    # counted against the process limit, and with only one process, the plots are drawn once alignment is done.
+    renderer_processes = num_processes / 2 if clargs.make_pdfs else 0
+    renderer = diagnostics.Renderer(renderer_processes, clargs.png_thumbnails) if clargs.make_pdfs else None
+    num_processes = max(1, num_processes - renderer_processes)
+    log.debug("Using %d worker processes and %d for diagnostic plots" % (num_processes, renderer_processes))
+    try:
+        align_all(clargs, metadata, cache, h5_filenames, path_info, sequencing_chip, tile_store_directories, num_processes, renderer)
+        if clargs.export_stats:
+            align.load_ledger(path_info).export(path_info.results_directory,
+                                                [os.path.splitext(h5_filename)[0] for h5_filename in h5_filenames])
+    finally:
+        if renderer is not None:
+            renderer.close()
+        align.merge_results(h5_filenames, path_info)
+
+
+def align_all(clargs, metadata, cache, h5_filenames, path_info, sequencing_chip, tile_store_directories, num_processes, renderer):
     if 'end_tiles' not in cache:
-        end_tiles = align.get_end_tiles(cluster_strategies, clargs.rotation_adjustment, h5_filenames, metadata['alignment_channel'], clargs.snr, metadata, sequencing_chip, fia)
+        with align.worker_pool(num_processes, tile_store_directories) as pool:
+            end_tiles = align.get_end_tiles(cluster_strategies, clargs.rotation_adjustment, h5_filenames, metadata['alignment_channel'], clargs.snr, metadata, sequencing_chip, pool, num_processes)
         cache['end_tiles'] = end_tiles
         initialize.save_cache(clargs.image_directory, cache)
     else:
         log.debug("End tiles already calculated.")
         end_tiles = cache['end_tiles']
-    gc.collect()
 
     if not cache['phix_aligned']:
-        for cluster_strategy in cluster_strategies:
-            align.run(cluster_strategy, clargs.rotation_adjustment, h5_filenames, path_info, clargs.snr, clargs.min_hits, fia, end_tiles, metadata['alignment_channel'],
-                      all_tile_data, metadata, clargs.make_pdfs, sequencing_chip, clargs.process_limit)
-            cache['phix_aligned'] = True
-            initialize.save_cache(clargs.image_directory, cache)
-        else:
-            log.debug("Phix already aligned.")
+        # Alignment images are handed out one at a time by a scheduler with its own workers, so that slow or crashing
+        # images can be killed and retried
+        scheduler = align.make_scheduler(num_processes, tile_store_directories, clargs.image_timeout)
+        try:
+            align.run(cluster_strategies, clargs.rotation_adjustment, h5_filenames, path_info, clargs.snr, clargs.min_hits, end_tiles, metadata['alignment_channel'],
+                      metadata, clargs.make_pdfs, sequencing_chip, clargs.precision_strategy, clargs.reuse_alignments, clargs.use_chip_model, scheduler, renderer)
+        finally:
+            scheduler.close()
+        cache['phix_aligned'] = True
+        initialize.save_cache(clargs.image_directory, cache)
+    else:
+        log.debug("Phix already aligned.")
 
     if clargs.fiducial_only:
         # the user doesn't want us to align the protein channels
-        exit(0)
+        return
 
-    gc.collect()
     protein_channels = [channel for channel in projectinfo.load_channels(clargs.image_directory) if channel != metadata['alignment_channel']]
     if protein_channels:
         log.debug("Protein channels found: %s" % ", ".join(protein_channels))
@@ -92,21 +133,18 @@ def main(clargs):
         # Attempt to precision align protein channels using the phix channel alignment as a starting point.
         # Not all experiments have "on target" or "perfect target" reads - that only applies to CRISPR systems
         # (at the time of this writing anyway)
-        for cluster_strategy in cluster_strategies:
-            gc.collect()
-            if on_target_tile_data:
-                channel_combo = channel_name + "_on_target"
-                combo_align(cluster_strategy, h5_filenames, channel_combo, channel_name, path_info, on_target_tile_data, all_tile_data, metadata, cache, clargs)
-            gc.collect()
-            if perfect_tile_data:
-                channel_combo = channel_name + "_perfect_target"
-                combo_align(cluster_strategy, h5_filenames, channel_combo, channel_name, path_info, perfect_tile_data, all_tile_data, metadata, cache, clargs)
-            gc.collect()
-
-
-def combo_align(cluster_strategy, h5_filenames, channel_combo, channel_name, path_info, alignment_tile_data, all_tile_data, metadata, cache, clargs):
+        if 'on_target' in tile_store_directories:
+            channel_combo = channel_name + "_on_target"
+            combo_align(cluster_strategies, h5_filenames, channel_combo, channel_name, path_info, 'on_target', metadata, cache, clargs, tile_store_directories, num_processes, renderer)
+        if 'perfect_target' in tile_store_directories:
+            channel_combo = channel_name + "_perfect_target"
+            combo_align(cluster_strategies, h5_filenames, channel_combo, channel_name, path_info, 'perfect_target', metadata, cache, clargs, tile_store_directories, num_processes, renderer)
+
+
+def combo_align(cluster_strategies, h5_filenames, channel_combo, channel_name, path_info, tile_store_name, metadata, cache, clargs, tile_store_directories, num_processes, renderer):
     log.info("Aligning %s" % channel_combo)
     if channel_combo not in cache['protein_channels_aligned']:
-        align.run_data_channel(cluster_strategy, h5_filenames, channel_name, path_info, alignment_tile_data, all_tile_data, metadata, clargs, clargs.process_limit)
+        with align.worker_pool(num_processes, tile_store_directories) as pool:
+            align.run_data_channel(cluster_strategies, h5_filenames, channel_name, path_info, tile_store_name, metadata, clargs, pool, renderer)
         cache['protein_channels_aligned'].append(channel_combo)
         initialize.save_cache(clargs.image_directory, cache)
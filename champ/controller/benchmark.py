@@ -0,0 +1,16 @@
+import logging
+from champ import benchmark
+
+log = logging.getLogger(__name__)
+
+
+def main(clargs):
+    # Aligns synthetic images with a known alignment, and saves how long each stage took
+    report = benchmark.run(clargs.chip, clargs.densities, clargs.images_per_density, clargs.min_hits, clargs.precision_strategy)
+    benchmark.save(report, clargs.report_filepath)
+    for density in report['densities']:
+        log.info("%d clusters per image: %d of %d images aligned correctly" % (density['clusters_per_image'], density['aligned'], density['images']))
+        for stage in benchmark.stages:
+            if density['seconds'][stage] is not None:
+                log.info("    %s: %.3f seconds" % (stage, density['seconds'][stage]['mean']))
+    log.info("Saved the benchmark report to %s" % clargs.report_filepath)
@@ -1,5 +1,5 @@
 import logging
-from champ import error, readmap
+from champ import error, instrument, readmap
 import os
 
 log = logging.getLogger(__name__)
@@ -12,4 +12,5 @@ def main(clargs):
     if not os.path.isdir(clargs.output_directory):
         os.makedirs(clargs.output_directory)
 
-    readmap.main(clargs)
+    with instrument.timer('map'):
+        readmap.main(clargs)
@@ -0,0 +1,32 @@
+import logging
+import os
+from champ import align, error, initialize, readrcs
+from champ.config import PathInfo
+from champ.controller.align import load_filenames
+from champ.tilestore import TileStore
+
+log = logging.getLogger(__name__)
+
+
+def main(clargs):
+    # Converts the text files of aligned reads written by older versions into binary results files
+    metadata = initialize.load_metadata(clargs.image_directory)
+    path_info = PathInfo(clargs.image_directory,
+                         metadata['mapped_reads'],
+                         metadata['perfect_target_name'],
+                         metadata['alternate_fiducial_reads'],
+                         metadata['alternate_perfect_target_reads_filename'],
+                         metadata['alternate_good_target_reads_filename'])
+    if not os.path.exists(path_info.read_names_filepath):
+        log.debug("Loading read names.")
+        read_names = TileStore(align.load_read_names(path_info.all_read_names_filepath)).names
+        readrcs.save_read_names(path_info.read_names_filepath, read_names)
+        del read_names
+    image_count = 0
+    for h5_filename in load_filenames(clargs.image_directory):
+        base_name = os.path.splitext(h5_filename)[0]
+        try:
+            image_count += readrcs.migrate(os.path.join(path_info.results_directory, base_name), path_info.read_names_filepath)
+        except ValueError as e:
+            error.fail(str(e))
+    log.info("Converted %d images. The old _all_read_rcs.txt files can be deleted." % image_count)
@@ -0,0 +1,109 @@
+import functools
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import h5py
+import numpy as np
+from champ import plotting
+from champ.grid import GridImages
+from champ.imagedata import ImageData
+
+log = logging.getLogger(__name__)
+# Rendering only gets the CPU time that alignment doesn't need
+niceness = 19
+# PNG thumbnails are small enough to flip through quickly
+thumbnail_figsize = (8, 8)
+thumbnail_dpi = 50
+suffix = '_diagnostics.npz'
+
+
+def filepath(figure_directory, base_name, channel, row, column):
+    # the same name as Image.index, so the plots are named the way they always have been
+    return os.path.join(figure_directory, base_name, '%s_%.3d_%.3d%s' % (channel, row, column, suffix))
+
+
+def save(path, h5_filename, image, fia):
+    """
+    Saves what's needed to plot an alignment, so that it can be rendered later by another process. The image itself
+    isn't saved since it's already in the HDF5 file.
+
+    """
+    hits = plotting.hits_given_category(fia)
+    metadata = {'h5_filename': h5_filename, 'channel': image.channel, 'row': image.row, 'column': image.column,
+                'image_index': image.index, 'title': plotting.alignment_title(fia)}
+    np.savez_compressed(path, metadata=json.dumps(metadata),
+                        cluster_rcs=fia.clusters.point_rcs.reshape(-1, 2),
+                        aligned_rcs=np.asarray(fia.aligned_rcs_in_frame).reshape(-1, 2),
+                        **{category + '_hits': category_hits for category, category_hits in hits.items()})
+
+
+def render(png_thumbnails, path):
+    """ Plots the alignment saved at path, next to it. Returns the paths of the plots. """
+    data = np.load(path)
+    metadata = json.loads(str(data['metadata']))
+    hits = {category: data[category + '_hits'] for category, _, _ in plotting.hit_categories}
+    with h5py.File(metadata['h5_filename'], 'r') as h5:
+        image = GridImages(h5, metadata['channel']).get(metadata['row'], metadata['column'])
+    # the same normalization that the alignment saw
+    image = ImageData(metadata['image_index'], 1.0, image).image
+    if png_thumbnails:
+        extension, figsize, dpi = 'png', thumbnail_figsize, thumbnail_dpi
+    else:
+        extension, figsize, dpi = 'pdf', (15, 15), None
+    prefix = path[:-len(suffix)]
+    paths = ['{}_all_hits.{}'.format(prefix, extension), '{}_hit_hists.{}'.format(prefix, extension)]
+    ax = plotting.plot_alignment(image, data['cluster_rcs'], data['aligned_rcs'], hits, metadata['title'], figsize=figsize)
+    ax.figure.savefig(paths[0], dpi=dpi)
+    plt.close(ax.figure)
+    ax = plotting.plot_hit_dist_hists(data['cluster_rcs'], data['aligned_rcs'], hits, metadata['image_index'])
+    ax.figure.savefig(paths[1], dpi=dpi)
+    plt.close(ax.figure)
+    return paths
+
+
+def render_safely(png_thumbnails, path):
+    # a plot that can't be drawn shouldn't stop the others
+    try:
+        return render(png_thumbnails, path)
+    except Exception as e:
+        log.warn("Could not render diagnostics for %s: %s" % (path, e))
+        return []
+
+
+def lower_priority():
+    os.nice(niceness)
+
+
+class Renderer(object):
+    """
+    Renders the diagnostic plots of alignments in a pool of low priority processes, so that alignment workers only
+    have to save the data to plot, and don't wait on matplotlib. Plots are queued as soon as their alignments are
+    done, and close() waits for all of them to be drawn. With no processes, the plots are drawn by close() instead.
+
+    """
+    def __init__(self, num_processes, png_thumbnails=False):
+        self._pool = multiprocessing.Pool(num_processes, initializer=lower_priority) if num_processes > 0 else None
+        self._png_thumbnails = png_thumbnails
+        self._results = []
+        self._queued = []
+
+    def render(self, paths):
+        paths = [path for path in paths if os.path.exists(path)]
+        if paths and self._pool is None:
+            self._queued.extend(paths)
+        elif paths:
+            self._results.append(self._pool.map_async(functools.partial(render_safely, self._png_thumbnails), paths))
+        return self
+
+    def close(self):
+        count = sum(len(render_safely(self._png_thumbnails, path)) for path in self._queued)
+        if self._pool is not None:
+            self._pool.close()
+            count += sum(len(paths) for result in self._results for paths in result.get(sys.maxint))
+            self._pool.join()
+        log.debug("Rendered %d diagnostic plots" % count)
@@ -1,21 +1,27 @@
+import copy
 import logging
-import time
-from copy import deepcopy
-from itertools import izip
+from collections import defaultdict
 import numpy as np
-from champ import stats, clusters
+from champ import stats, clusters, instrument, misc
 from fastqtilercs import FastqTileRCs
+from tilestore import TileStore
 from imagedata import ImageData
-from scipy.spatial import KDTree
+from scipy.spatial import KDTree, cKDTree
 
 log = logging.getLogger(__name__)
 
 
 class FastqImageAligner(object):
-    """A class to find the alignment of fastq data and image data."""
-    def __init__(self, microns_per_pixel):
+    """
+    A class to find the alignment of fastq data and image data.
+
+    The reads themselves live in a TileStore, which can be shared between any number of aligners. Each
+    aligner only holds the state for one image, and only creates FastqTileRCs for the tiles it looks at.
+
+    """
+    def __init__(self, microns_per_pixel, tile_store=None):
+        self.tile_store = tile_store if tile_store is not None else TileStore()
         self.fastq_tiles = {}
-        self.fastq_tiles_keys = []
         self.microns_per_pixel = microns_per_pixel
         self.image_data = None
         self.fq_w = 935  # um
@@ -27,49 +33,42 @@ class FastqImageAligner(object):
         self.exclusive_hits = set()
         self.hitting_tiles = []
 
-    def load_reads(self, tile_data, valid_keys=None):
-        for tile_key, read_names in tile_data.items():
-            if valid_keys is None or tile_key in valid_keys:
-                self.fastq_tiles[tile_key] = FastqTileRCs(tile_key, read_names, self.microns_per_pixel)
+    def tile(self, tile_key):
+        """ Gets the per-image state of a tile, creating it if this is the first time it's been needed. """
+        if tile_key not in self.fastq_tiles:
+            self.fastq_tiles[tile_key] = FastqTileRCs(tile_key,
+                                                      self.tile_store.read_names(tile_key),
+                                                      self.microns_per_pixel,
+                                                      rcs=self.tile_store.rcs[tile_key])
+        return self.fastq_tiles[tile_key]
 
     @property
     def fastq_tiles_list(self):
         for _, tile in sorted(self.fastq_tiles.items()):
             yield tile
 
-    def all_reads_fic_from_aligned_fic(self, other_fic, all_reads):
-        self.load_reads(all_reads, valid_keys=[tile.key for tile in other_fic.hitting_tiles])
-        self.image_data = deepcopy(other_fic.image_data)
-        self.fq_w = other_fic.fq_w
-        self.set_fastq_tile_mappings()
-        self.set_all_fastq_image_data()
-        self.hitting_tiles = [self.fastq_tiles[tile.key] for tile in other_fic.hitting_tiles]
-        self.clusters = other_fic.clusters
-        for other_tile in other_fic.hitting_tiles:
-            tile = self.fastq_tiles[other_tile.key]
-            try:
-                tile.set_aligned_rcs_given_transform(other_tile.scale,
-                                                     other_tile.rotation,
-                                                     other_tile.offset)
-            except AttributeError:
-                # I'm not sure why this is happening - tiles aren't getting aligned?
-                # We will make sure tiles are aligned before writing results to disk
-                log.debug("Skipping tile that lacks rotation!")
-                continue
+    def copy_alignment(self):
+        """
+        A copy of this aligner, with the same alignment, that can be refined without changing this one. The image,
+        reads and clusters are shared, since they're never modified.
+
+        """
+        fia = copy.copy(self)
+        fia.fastq_tiles = {key: copy.copy(tile) for key, tile in self.fastq_tiles.items()}
+        fia.hitting_tiles = [fia.fastq_tiles[tile.key] for tile in self.hitting_tiles]
+        return fia
 
     def set_tile_alignment(self, tile_key, scale, fq_w, rotation, rc_offset):
-        if self.fastq_tiles[tile_key] not in self.hitting_tiles:
-            self.hitting_tiles.append(self.fastq_tiles[tile_key])
+        tile = self.tile(tile_key)
+        if tile not in self.hitting_tiles:
+            self.hitting_tiles.append(tile)
         self.fq_w = fq_w
         self.set_fastq_tile_mappings()
         self.set_all_fastq_image_data()
-        tile = self.fastq_tiles[tile_key]
         tile.set_aligned_rcs_given_transform(scale, rotation, rc_offset)
 
-    def alignment_from_alignment_file(self, path):
+    def alignment_from_alignment_stats(self, astats):
         self.hitting_tiles = []
-        with open(path) as f:
-            astats = stats.AlignmentStats().from_file(f)
         for tile_key, scaling, tile_width, rotation, rc_offset, _ in astats:
             self.set_tile_alignment(tile_key, scaling, tile_width, rotation, rc_offset)
 
@@ -88,20 +87,19 @@ class FastqImageAligner(object):
                                       self.fq_w)
 
     def rotate_all_fastq_data(self, degrees):
-        im_shapes = [tile.rotate_data(degrees) for tile in self.fastq_tiles_list]
-        self.fq_im_scaled_dims = np.array(im_shapes).max(axis=0)
+        # The image has to be large enough for any tile, not just the ones we've looked at so far
+        self.fq_im_scaled_dims = self.tile_store.rotated_dims(self.fq_im_offset, self.fq_im_scale, degrees)
         for tile in self.fastq_tiles_list:
+            tile.rotate_data(degrees)
             tile.image_shape = self.fq_im_scaled_dims
 
     def set_fastq_tile_mappings(self):
         """Calculate parameters for mapping fastq tiles for ffts."""
         assert self.image_data is not None, 'No image data loaded.'
-        assert self.fastq_tiles != {}, 'No fastq data loaded.'
+        assert len(self.tile_store) > 0, 'No fastq data loaded.'
 
-        all_data = np.concatenate([tile.rcs for key, tile in self.fastq_tiles.items()])
-
-        x_min, y_min = all_data.min(axis=0)
-        x_max, y_max = all_data.max(axis=0)
+        x_min, y_min = self.tile_store.mins
+        x_max, y_max = self.tile_store.maxes
 
         self.fq_im_offset = np.array([-x_min, -y_min])
         self.fq_im_scale = (float(self.fq_w) / (x_max-x_min)) / self.image_data.um_per_pixel
@@ -109,11 +107,9 @@ class FastqImageAligner(object):
         self.fq_im_scaled_dims = (self.fq_im_scaled_maxes + [1, 1]).astype(np.int)
 
     def find_hitting_tiles(self, possible_tile_keys, snr_thresh=1.2):
-        possible_tiles = [self.fastq_tiles[key] for key in possible_tile_keys
-                          if key in self.fastq_tiles]
-        impossible_tiles = [tile for tile in self.fastq_tiles.values() if tile not in possible_tiles]
-        impossible_tiles.sort(key=lambda tile: -len(tile.read_names))
-        control_tiles = impossible_tiles[:2]
+        possible_tile_keys = [key for key in possible_tile_keys if key in self.tile_store]
+        possible_tiles = [self.fastq_tiles[key] for key in possible_tile_keys]
+        control_tiles = [self.fastq_tiles[key] for key in self.tile_store.control_tile_keys(possible_tile_keys)]
         self.image_data.set_fft(self.fq_im_scaled_dims)
         self.control_corr = 0
 
@@ -207,11 +203,18 @@ class FastqImageAligner(object):
         exclusive_hits = set(hit for hit in exclusive_hits
                              if self.single_hit_dist(hit) <= good_hit_threshold)
 
+        # index the non-mutual hits by each of their points so we don't scan all of them for every mutual hit
+        non_mutual_given_cluster = defaultdict(list)
+        non_mutual_given_aligned = defaultdict(list)
+        for hit in non_mutual_hits:
+            non_mutual_given_cluster[hit[0]].append(hit)
+            non_mutual_given_aligned[hit[1]].append(hit)
+
         good_mutual_hits = set()
         for i, j in (mutual_hits - exclusive_hits):
             if self.hit_dists([(i, j)])[0] > good_hit_threshold:
                 continue
-            third_wheels = [tup for tup in non_mutual_hits if i == tup[0] or j == tup[1]]
+            third_wheels = set(non_mutual_given_cluster[i]) | set(non_mutual_given_aligned[j])
             if min(self.hit_dists(third_wheels)) > second_neighbor_thresh:
                 good_mutual_hits.add((i, j))
         bad_mutual_hits = mutual_hits - exclusive_hits - good_mutual_hits
@@ -245,31 +248,23 @@ class FastqImageAligner(object):
 
         "Output": scaling lambda, rotation theta, x_offset, y_offset, and aligned_rcs
 
-        We here solve the matrix least squares equation Ax = b, where
-
-                [ x0r -y0r 1 0 ]
-                [ y0r  x0r 0 1 ]
-            A = [ x1r -y1r 1 0 ]
-                [ y1r  x1r 0 1 ]
-                      . . .
-                [ xnr -ynr 1 0 ]
-                [ ynr  xnr 0 1 ]
-
-        and
+        We here solve the least squares problem
 
-            b = [ x0s y0s x1s y1s . . . xns yns ]^T
+            min || lambda R(theta) r_i + t - s_i ||^2
 
-        The r and s subscripts indicate rcs and cluster coords.
+        over all hits, where the r and s subscripts indicate rcs and cluster coords. After centering
+        both point sets, this has the closed-form solution
 
-        The interpretation of x is then given by
-
-            x = [ alpha beta x_offset y_offset ]^T
+            alpha = sum(xr xs + yr ys) / sum(xr^2 + yr^2)
+            beta = sum(xr ys - yr xs) / sum(xr^2 + yr^2)
 
         where
             alpha = lambda cos(theta), and
             beta = lambda sin(theta)
 
-        This system of equations is then finally solved for lambda and theta.
+        and t is whatever maps the mean of the rcs onto the mean of the cluster coords. This is the
+        same answer as solving Ax = b with the 2N x 4 design matrix, without having to build it.
+        See misc.similarity_transform.
         """
         def get_hits(hit_type):
             if isinstance(hit_type, str):
@@ -290,47 +285,110 @@ class FastqImageAligner(object):
                 continue
             else:
                 found_good_mapping = True
-            A = np.zeros((2 * len(hits), 4))
-            b = np.zeros((2 * len(hits),))
-            for i, (cluster_index, in_frame_idx) in enumerate(hits):
-                tile_key, (xir, yir) = self.rcs_in_frame[in_frame_idx]
-                A[2*i, :] = [xir, -yir, 1, 0]
-                A[2*i+1, :] = [yir,  xir, 0, 1]
-
-                xis, yis = self.clusters.point_rcs[cluster_index]
-                b[2*i] = xis
-                b[2*i+1] = yis
-
-            alpha, beta, x_offset, y_offset = np.linalg.lstsq(A, b)[0]
-            offset = np.array([x_offset, y_offset])
-            theta = np.arctan2(beta, alpha)
-            lbda = alpha / np.cos(theta)
+            rcs, cluster_rcs = self.hit_coordinates(hits)
+            lbda, theta, offset = misc.similarity_transform(rcs, cluster_rcs)
+            tile.set_aligned_rcs_given_transform(lbda, theta, offset)
+            tile.set_fit_quality(rcs, cluster_rcs, 1)
+            tile.set_correlation(self.image_data.image)
+            if hasattr(self, 'control_corr'):
+                tile.set_snr_with_control_corr(self.control_corr)
+        return found_good_mapping
+
+    def ransac_mapping(self, min_hits=50, search_radius=10.0, inlier_thresh=2.0, ransac_iterations=1000, max_iterations=10,
+                       tolerance=0.05):
+        """
+        A robust alternative to least_squares_mapping for when the rough alignment is slightly off.
+
+        When the rough alignment is off by a few pixels, most nearest neighbor hits are wrong, so instead
+        each cluster is paired with every aligned read within `search_radius` pixels. RANSAC finds the
+        similarity transform that agrees with the most of those pairs, ignoring the wrong ones. That
+        transform is then refined ICP-style: hits are found again with the new transform and refit by
+        least squares, until the aligned reads move by less than `tolerance` pixels or `max_iterations`
+        fits have been done.
+        """
+        found_good_mapping = False
+        for tile in self.hitting_tiles:
+            self.find_points_in_frame(consider_tiles=tile)
+            candidate_hits = self.candidate_hits(search_radius)
+            if len(candidate_hits) < min_hits:
+                continue
+            rcs, cluster_rcs = self.hit_coordinates(candidate_hits)
+            try:
+                lbda, theta, offset, inliers = misc.ransac_similarity_transform(rcs, cluster_rcs, inlier_thresh,
+                                                                                iterations=ransac_iterations,
+                                                                                random_state=0)
+            except ValueError:
+                continue
+            if inliers.sum() < min_hits:
+                continue
+            rcs, cluster_rcs = rcs[inliers], cluster_rcs[inliers]
+
+            iterations = 1
+            while iterations < max_iterations:
+                tile.set_aligned_rcs_given_transform(lbda, theta, offset)
+                self.find_hits(consider_tiles=tile)
+                hits = list(self.exclusive_hits | self.good_mutual_hits)
+                if len(hits) < min_hits:
+                    break
+                new_rcs, new_cluster_rcs = self.hit_coordinates(hits)
+                new_lbda, new_theta, new_offset = misc.similarity_transform(new_rcs, new_cluster_rcs)
+                shift = np.abs(misc.apply_similarity_transform(new_rcs, new_lbda, new_theta, new_offset)
+                               - misc.apply_similarity_transform(new_rcs, lbda, theta, offset)).max()
+                lbda, theta, offset = new_lbda, new_theta, new_offset
+                rcs, cluster_rcs = new_rcs, new_cluster_rcs
+                iterations += 1
+                if shift < tolerance:
+                    break
+            log.debug("RANSAC alignment of %s finished after %d fits" % (tile.key, iterations))
+
+            found_good_mapping = True
             tile.set_aligned_rcs_given_transform(lbda, theta, offset)
+            tile.set_fit_quality(rcs, cluster_rcs, iterations)
             tile.set_correlation(self.image_data.image)
             if hasattr(self, 'control_corr'):
                 tile.set_snr_with_control_corr(self.control_corr)
         return found_good_mapping
 
+    def candidate_hits(self, search_radius, neighbors=4):
+        """ Pairs each cluster with up to `neighbors` aligned reads in frame that are within `search_radius` pixels. """
+        aligned_tree = cKDTree(self.aligned_rcs_in_frame)
+        dists, in_frame_indexes = aligned_tree.query(self.clusters.point_rcs, k=neighbors,
+                                                     distance_upper_bound=search_radius)
+        cluster_indexes = np.repeat(np.arange(len(self.clusters.point_rcs)), neighbors).reshape(dists.shape)
+        found = np.isfinite(dists)
+        return zip(cluster_indexes[found], in_frame_indexes[found])
+
+    def hit_coordinates(self, hits):
+        """ Returns the raw FastQ rcs and the cluster rcs of each (cluster_index, in_frame_idx) hit. """
+        cluster_indexes, in_frame_indexes = zip(*hits)
+        rcs = np.array([self.rcs_in_frame[in_frame_idx][1] for in_frame_idx in in_frame_indexes])
+        cluster_rcs = self.clusters.point_rcs[list(cluster_indexes)]
+        return rcs, cluster_rcs
+
     def rough_align(self, possible_tile_keys, rotation_est, fq_w_est=927, snr_thresh=1.2):
         self.fq_w = fq_w_est
+        # Only the tiles that might be in the image, and the control tiles, need to be mapped
+        possible_tile_keys = [key for key in possible_tile_keys if key in self.tile_store]
+        for tile_key in possible_tile_keys + self.tile_store.control_tile_keys(possible_tile_keys):
+            self.tile(tile_key)
         self.set_fastq_tile_mappings()
         self.set_all_fastq_image_data()
         self.rotate_all_fastq_data(rotation_est)
-        start_time = time.time()
-        self.find_hitting_tiles(possible_tile_keys, snr_thresh)
-        log.debug('Rough alignment time: %.3f seconds' % (time.time() - start_time))
+        with instrument.timer('rough_align'):
+            self.find_hitting_tiles(possible_tile_keys, snr_thresh)
 
-    def precision_align_only(self, min_hits):
-        start_time = time.time()
+    def precision_align_only(self, min_hits, precision_strategy='lstsq', **mapping_kwargs):
         if not self.hitting_tiles:
             raise RuntimeError('Alignment not found')
-        found_good_mapping = self.least_squares_mapping(min_hits=min_hits)
+        mappings = {'lstsq': self.least_squares_mapping,
+                    'ransac': self.ransac_mapping}
+        with instrument.timer('precision_align'):
+            found_good_mapping = mappings[precision_strategy](min_hits=min_hits, **mapping_kwargs)
         if not found_good_mapping:
             raise ValueError("Could not precision align!")
-        log.debug('Precision alignment time: %.3f seconds' % (time.time() - start_time))
-        start_time = time.time()
-        self.find_hits()
-        log.debug('Hit finding time: %.3f seconds' % (time.time() - start_time))
+        with instrument.timer('find_hits'):
+            self.find_hits()
+        instrument.observe('exclusive_hits', len(self.exclusive_hits))
 
     @property
     def alignment_stats(self):
@@ -344,16 +402,31 @@ class FastqImageAligner(object):
                                                 [float(tile.width) for tile in self.hitting_tiles],
                                                 [float(tile.rotation_degrees) for tile in self.hitting_tiles],
                                                 offsets,
-                                                hits)
+                                                hits,
+                                                [getattr(tile, 'residual', None) for tile in self.hitting_tiles],
+                                                [getattr(tile, 'iterations', None) for tile in self.hitting_tiles])
 
-    @property
-    def read_names_rcs(self):
+    def reads_in_frame(self, tile_store=None):
+        """
+        The IDs and aligned rcs of the reads in a tile store (by default, the one used for alignment) that are in the
+        image, placed with the transforms found for the hitting tiles. Only reads in the box that the image covers in
+        each tile's raw coordinates are transformed, so this is fast even for a store with every read in it.
+
+        """
+        tile_store = tile_store if tile_store is not None else self.tile_store
         im_shape = self.image_data.image.shape
+        corners = np.array([[0, 0], [0, im_shape[1]], [im_shape[0], 0], im_shape], dtype=np.float)
+        read_ids, rcs = [np.zeros(0, dtype=np.int32)], [np.zeros((0, 2))]
         for tile in self.hitting_tiles:
-            if not hasattr(tile, 'rotation'):
-                # hack because I don't understand why tiles aren't getting rotations
-                # not having rotations implies they aren't getting aligned at all, which is very bad
+            if not hasattr(tile, 'rotation') or tile.key not in tile_store:
+                # tiles that weren't aligned have no transform
                 continue
-            for read_name, pt in izip(tile.read_names, tile.aligned_rcs):
-                if 0 <= pt[0] < im_shape[0] and 0 <= pt[1] < im_shape[1]:
-                    yield '%s\t%f\t%f\n' % (read_name, pt[0], pt[1])
+            tile_corners = misc.invert_similarity_transform(corners, tile.scale, tile.rotation, tile.offset)
+            # raw coordinates are integers, so round the box outwards
+            indexes = tile_store.reads_in_box(tile.key, np.floor(tile_corners.min(axis=0)), np.ceil(tile_corners.max(axis=0)))
+            aligned_rcs = misc.apply_similarity_transform(tile_store.rcs[tile.key][indexes], tile.scale, tile.rotation, tile.offset)
+            in_frame = ((aligned_rcs[:, 0] >= 0) & (aligned_rcs[:, 0] < im_shape[0]) &
+                        (aligned_rcs[:, 1] >= 0) & (aligned_rcs[:, 1] < im_shape[1]))
+            read_ids.append(tile_store.read_ids[tile.key][indexes[in_frame]])
+            rcs.append(aligned_rcs[in_frame])
+        return np.concatenate(read_ids), np.concatenate(rcs)
@@ -1,19 +1,22 @@
 from copy import deepcopy
 import numpy as np
 import misc
+from champ import instrument
 import logging
 from scipy import ndimage
+from tilestore import parse_rcs
 
 log = logging.getLogger(__name__)
 
 
 class FastqTileRCs(object):
     """A class for fastq tile coordinates."""
-    def __init__(self, key, read_names, microns_per_pixel):
+    def __init__(self, key, read_names, microns_per_pixel, rcs=None):
         self.key = key
         self.microns_per_pixel = microns_per_pixel
+        # read_names and rcs are usually shared with a TileStore and must not be modified
         self.read_names = read_names
-        self.rcs = np.array([map(int, name.split(':')[-2:]) for name in self.read_names])
+        self.rcs = rcs if rcs is not None else parse_rcs(read_names)
 
     def set_fastq_image_data(self, offset, scale, scaled_dims, width):
         self.offset = offset
@@ -50,6 +53,7 @@ class FastqTileRCs(object):
                                                                                                              fq_im_fft.shape[0],
                                                                                                              fq_im_fft.shape[1]))
         cross_corr = abs(np.fft.ifft2(np.conj(fq_im_fft) * im_data_fft))
+        instrument.count('ffts', 2)
         max_corr = cross_corr.max()
         max_idx = misc.max_2d_idx(cross_corr)
         align_tr = np.array(max_idx) - fq_image.shape
@@ -63,24 +67,19 @@ class FastqTileRCs(object):
 
     def set_aligned_rcs_given_transform(self, lbda, theta, offset):
         """Performs transform calculated in FastqImageCorrelator.least_squares_mapping."""
-        A = np.zeros((2*len(self.rcs), 4))
-        for i, pt in enumerate(self.rcs):
-            xir, yir = pt
-            A[2*i, :] = [xir, -yir, 1, 0]
-            A[2*i+1, :] = [yir,  xir, 0, 1]
-
-        x = np.array([lbda * np.cos(theta),
-                      lbda * np.sin(theta),
-                      offset[0],
-                      offset[1]])
-
         # First update w since it depends on previous scale setting
         self.width = lbda * float(self.width) / self.scale
         self.scale = lbda
         self.rotation = theta
         self.rotation_degrees = theta * 180.0 / np.pi
         self.offset = offset
-        self.aligned_rcs = np.dot(A, x).reshape((len(self.rcs), 2))
+        self.aligned_rcs = misc.apply_similarity_transform(self.rcs, lbda, theta, offset)
+
+    def set_fit_quality(self, rcs, cluster_rcs, iterations):
+        """Records the RMS distance in pixels between the hits used for the precision alignment."""
+        aligned = misc.apply_similarity_transform(rcs, self.scale, self.rotation, self.offset)
+        self.residual = float(np.sqrt(((aligned - cluster_rcs) ** 2).sum(axis=1).mean()))
+        self.iterations = iterations
 
     def set_correlation(self, im):
         """Sets alignment correlation. Only works when image need not be flipped or rotated."""
@@ -14,13 +14,13 @@ def get_image_key(column, row):
 
 
 def load_channel_names(h5_path):
-    with h5py.File(h5_path) as f:
+    with h5py.File(h5_path, 'r') as f:
         return f.keys()
 
 
 def get_all_image_positions(h5_path):
     all_columns, all_rows = set(), set()
-    with h5py.File(h5_path) as f:
+    with h5py.File(h5_path, 'r') as f:
         for channel in f.keys():
             for position_key in f[channel].keys():
                 column, row = parse_coordinates(position_key)
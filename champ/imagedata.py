@@ -1,5 +1,5 @@
 import numpy as np
-from champ import misc
+from champ import instrument, misc
 
 
 class ImageData(object):
@@ -28,4 +28,5 @@ class ImageData(object):
                            mode='constant')
         if padded_im.shape != (dimension, dimension):
             raise ValueError("FFT of microscope image is not a power of 2, this will cause the program to stall.")
-        self.fft = np.fft.fft2(padded_im)
\ No newline at end of file
+        self.fft = np.fft.fft2(padded_im)
+        instrument.count('ffts')
\ No newline at end of file
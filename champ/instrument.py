@@ -0,0 +1,171 @@
+import cProfile
+import functools
+import glob
+import json
+import logging
+import multiprocessing.util
+import os
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+import numpy as np
+
+log = logging.getLogger(__name__)
+# Each process keeps its own timers, counters and histograms. Worker processes save theirs to the run directory when
+# they exit, and the process that started the run merges them into a summary when it finishes.
+summary_filename = 'summary.json'
+_run_directory = None
+_command = None
+_start_time = None
+_profile_stages = frozenset()
+_pid = None
+_timers = defaultdict(list)
+_counters = Counter()
+_histograms = defaultdict(list)
+_profilers = {}
+_profiling = []
+
+
+def _current():
+    # forked workers start with a copy of their parent's measurements, which they mustn't save again
+    global _pid
+    if _pid != os.getpid():
+        _pid = os.getpid()
+        _timers.clear()
+        _counters.clear()
+        _histograms.clear()
+        _profilers.clear()
+        del _profiling[:]
+        if _run_directory is not None:
+            multiprocessing.util.Finalize(None, save, exitpriority=0)
+
+
+def start(directory, command, profile_stages=()):
+    """
+    Starts a run, whose measurements are saved in a new directory under `directory`. Stages in profile_stages are
+    also profiled with cProfile, in every process.
+
+    """
+    global _run_directory, _command, _start_time, _profile_stages, _pid
+    _command = command
+    _start_time = time.time()
+    _run_directory = os.path.join(directory, '%s-%s-%d' % (command, time.strftime('%Y%m%d-%H%M%S'), os.getpid()))
+    os.makedirs(_run_directory)
+    _profile_stages = frozenset(profile_stages)
+    _pid = os.getpid()
+    _timers.clear()
+    _counters.clear()
+    _histograms.clear()
+    _profilers.clear()
+    return _run_directory
+
+
+@contextmanager
+def timer(name):
+    """ Times a stage. Stages that are being profiled are profiled, unless another profiled stage is running. """
+    _current()
+    profiler = None
+    if name in _profile_stages and not _profiling:
+        profiler = _profilers.setdefault(name, cProfile.Profile())
+        _profiling.append(name)
+        profiler.enable()
+    start_time = time.time()
+    try:
+        yield
+    finally:
+        seconds = time.time() - start_time
+        if profiler is not None:
+            profiler.disable()
+            _profiling.pop()
+        _timers[name].append(seconds)
+        log.debug("%s took %.3f seconds" % (name, seconds))
+
+
+def timed(name):
+    """ Decorates a function so that every call is timed as the stage `name`. """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with timer(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count(name, amount=1):
+    _current()
+    _counters[name] += amount
+
+
+def observe(name, value):
+    """ Adds a value to a histogram. """
+    _current()
+    _histograms[name].append(float(value))
+
+
+def measurements():
+    """ Everything this process has measured since the run started (or since it was forked). """
+    _current()
+    return {'pid': os.getpid(),
+            'timers': dict(_timers),
+            'counters': dict(_counters),
+            'histograms': dict(_histograms)}
+
+
+def save():
+    """ Saves this process's measurements and profiles to the run directory. """
+    if _run_directory is None or not os.path.isdir(_run_directory):
+        return
+    with open(os.path.join(_run_directory, '%d.json' % os.getpid()), 'w') as f:
+        json.dump(measurements(), f)
+    for name, profiler in _profilers.items():
+        profiler.dump_stats(os.path.join(_run_directory, '%s.%d.prof' % (name, os.getpid())))
+
+
+def describe(values):
+    values = np.array(values, dtype=np.float)
+    counts, edges = np.histogram(values, bins=10)
+    return {'count': len(values), 'total': float(values.sum()), 'mean': float(values.mean()), 'min': float(values.min()),
+            'max': float(values.max()), 'median': float(np.median(values)), 'p95': float(np.percentile(values, 95)),
+            'histogram': {'counts': counts.tolist(), 'edges': edges.tolist()}}
+
+
+def summarize(all_measurements, wall_seconds):
+    """ Merges the measurements of every process. Counters also get a rate per second of wall time. """
+    timers, counters, histograms = defaultdict(list), Counter(), defaultdict(list)
+    for process_measurements in all_measurements:
+        for name, seconds in process_measurements['timers'].items():
+            timers[name].extend(seconds)
+        counters.update(process_measurements['counters'])
+        for name, values in process_measurements['histograms'].items():
+            histograms[name].extend(values)
+    return {'command': _command,
+            'wall_seconds': wall_seconds,
+            'processes': len(all_measurements),
+            'timers': {name: describe(seconds) for name, seconds in timers.items()},
+            'counters': {name: {'total': total, 'per_second': total / wall_seconds if wall_seconds else None}
+                         for name, total in counters.items()},
+            'histograms': {name: describe(values) for name, values in histograms.items() if values}}
+
+
+def finish():
+    """ Merges the measurements of every process in the run into a summary file, and returns the summary. """
+    global _run_directory
+    if _run_directory is None:
+        return None
+    save()
+    paths = glob.glob(os.path.join(_run_directory, '*.json'))
+    all_measurements = []
+    for path in paths:
+        with open(path) as f:
+            all_measurements.append(json.load(f))
+    summary = summarize(all_measurements, time.time() - _start_time)
+    with open(os.path.join(_run_directory, summary_filename), 'w') as f:
+        json.dump(summary, f, indent=2, sort_keys=True)
+    for path in paths:
+        os.remove(path)
+    for name, stats in sorted(summary['timers'].items()):
+        log.info("%s: %d calls, %.1f seconds in total, %.3f seconds on average" % (name, stats['count'], stats['total'], stats['mean']))
+    log.info("Saved a summary of the run to %s" % os.path.join(_run_directory, summary_filename))
+    _run_directory = None
+    return summary
@@ -1,201 +1,388 @@
+from collections import defaultdict
+import functools
+import itertools
+import multiprocessing
 import os
-import glob
 import re
 import h5py
 import misc
-from champ import hdf5tools
+from champ import hdf5tools, instrument, intensity_array, readrcs, scorecache, scorestore
 import matplotlib.pyplot as plt
 import numpy as np
-from collections import defaultdict
+from scipy import ndimage
 import logging
 
 log = logging.getLogger(__name__)
+im_loc_re = re.compile('Channel_(.+)_Pos_(\d+)_(\d+)(_|$)')
+image_parsing_regex = re.compile(r'^(?P<channel>.+)_(?P<minor>\d+)_(?P<major>\d+)(_|$)')
+# Worker processes keep each HDF5 file open for all the images they're given from it
+_open_h5_files = {}
+# and get the table of read names, if they need it, when they start
+_all_read_names = None
+
+
+def parse_image_index(image_index):
+    """ The channel and (major, minor) position of an image, from its index in the results. """
+    m = im_loc_re.match(image_index)
+    if m is not None:
+        return m.group(1), (int(m.group(3)), int(m.group(2)))
+    m = image_parsing_regex.match(image_index)
+    if m is None:
+        raise ValueError("Could not find the channel and position of image %s" % image_index)
+    return m.group('channel'), (int(m.group('major')), int(m.group('minor')))
+
+
+def lda_scores(im, rcs, lda_weights, side_px=3, kernels=None):
+    """
+    Scores the reads at rcs all at once, by weighting the pixels around each read. Reads are scored at the nearest
+    pixel, and reads too close to the edge of the image are skipped. Returns the indexes of the reads that were
+    scored, and their scores.
+
+    If kernels is a bank made by kernel_bank, each read is scored at its sub-pixel position instead, with the kernel
+    shifted by the nearest fraction of a pixel.
+
+    """
+    rcs = np.asarray(rcs, dtype=np.float).reshape(-1, 2)
+    # rounded half away from zero, like round()
+    nearest_rcs = np.trunc(rcs + np.copysign(0.5, rcs)).astype(np.int64)
+    # shifted kernels have a border of one pixel
+    side_px = side_px if kernels is None else side_px + 1
+    in_bounds = ((nearest_rcs >= side_px) & (nearest_rcs < np.array(im.shape) - side_px - 1)).all(axis=1)
+    indexes = np.flatnonzero(in_bounds)
+    # a view of every patch in the image, without copying anything
+    width = 2 * side_px + 1
+    im = np.ascontiguousarray(im, dtype=np.float)
+    patches = np.lib.stride_tricks.as_strided(im,
+                                              shape=(im.shape[0] - width + 1, im.shape[1] - width + 1, width, width),
+                                              strides=im.strides * 2)
+    patches = patches[nearest_rcs[indexes, 0] - side_px, nearest_rcs[indexes, 1] - side_px]
+    if kernels is not None:
+        bins = kernels.shape[0] - 1
+        shift_bins = np.clip(np.rint((rcs[indexes] - nearest_rcs[indexes]) * bins).astype(np.int64) + bins // 2, 0, bins)
+        lda_weights = kernels[shift_bins[:, 0], shift_bins[:, 1]]
+    # each patch is summed on its own, in the same order as a single patch would be
+    scores = (patches * lda_weights).reshape(len(indexes), width * width).sum(axis=1)
+    return indexes, scores
+
+
+def kernel_bank(lda_weights, bins=8):
+    """
+    The LDA weights shifted by every multiple of 1 / bins of a pixel, from -1/2 to 1/2 in each direction, with cubic
+    spline interpolation, which blurs the weights much less than linear interpolation. Each kernel has a border of
+    zeros one pixel wide, so that weights aren't shifted out of it.
+    kernels[i, j] is shifted by (i - bins // 2) / bins rows and (j - bins // 2) / bins columns.
+
+    """
+    padded = np.pad(np.asarray(lda_weights, dtype=np.float), 1, mode='constant')
+    shifts = (np.arange(bins + 1) - bins // 2) / float(bins)
+    kernels = np.empty((bins + 1, bins + 1) + padded.shape)
+    for i, row_shift in enumerate(shifts):
+        for j, column_shift in enumerate(shifts):
+            kernels[i, j] = ndimage.shift(padded, (row_shift, column_shift), order=3, mode='constant')
+    return kernels
+
+
+def mode_in_image(im):
+    w = 200
+    hw = w / 2
+    rmid, cmid = int(im.shape[0] / 2), int(im.shape[1] / 2)
+    vmin, vmax = im.min(), im.max()
+    # remove saturation
+    pct95 = vmin + 0.95 * (vmax - vmin)
+    patch = im[rmid - hw:rmid + hw, cmid - hw:cmid + hw]
+    return misc.get_mode(patch[patch < pct95])
+
+
+def format_scores(scores):
+    """
+    Formats each row of scores as a line of tab-separated values with '-' for NaN. Values are formatted with str(),
+    as they always were, and converting the whole matrix with tolist() first keeps that fast.
+    """
+    scores = np.asarray(scores, dtype=np.float)
+    return ['\t'.join([str(value) if value == value else '-' for value in row]) for row in scores.tolist()]
+
+
+def _load_image(h5_fpath, channel, pos_tup):
+    key = (os.getpid(), h5_fpath)
+    if key not in _open_h5_files:
+        _open_h5_files[key] = h5py.File(h5_fpath, 'r')
+    return _open_h5_files[key][channel][hdf5tools.get_image_key(*pos_tup)][...]
+
+
+def _set_read_names(all_read_names):
+    global _all_read_names
+    _all_read_names = all_read_names
+
+
+def score_image(lda_weights, side_px, kernels, task):
+    """
+    Scores the reads in one image, in a worker process. task is the HDF5 file, results directory and image index.
+    Returns the task, along with arrays of the IDs of the reads that were scored and their scores.
+
+    """
+    h5_fpath, results_dir, image_index = task
+    channel, pos_tup = parse_image_index(image_index)
+    im = _load_image(h5_fpath, channel, pos_tup)
+    read_ids, rcs = readrcs.load_read_ids_and_rcs(results_dir, image_index, _all_read_names)
+    indexes, scores = lda_scores(im, rcs, lda_weights, side_px, kernels)
+    return task, read_ids[indexes], scores
+
+
+def image_mode(task):
+    """ The mode of the pixels of one image, in a worker process. task is the HDF5 file, channel and position. """
+    return task, mode_in_image(_load_image(*task))
+
+
+def imap(func, tasks, processes, initializer=None, initargs=()):
+    """ Yields the result of each task, in whatever order they finish, from a pool of processes. """
+    pool = multiprocessing.Pool(processes, initializer=initializer, initargs=initargs)
+    try:
+        for result in pool.imap_unordered(func, tasks):
+            yield result
+    finally:
+        pool.close()
+        pool.join()
 
 
 class IntensityScores(object):
     def __init__(self, h5_fpaths):
-        """Initialize h5_fpaths and scores. scores is a dict accessed as:
+        """Initialize h5_fpaths and scores. scores is a view of the score tables accessed as:
 
             scores[h5_fpath][channel][pos_tup][read_name]
         """
         self.h5_fpaths = h5_fpaths
-        self.raw_scores = {
-            h5_fpath: {channel: {} for channel in hdf5tools.load_channel_names(h5_fpath)}
-            for h5_fpath in h5_fpaths
-            }
-        self.scores = self.raw_scores
-
-    def _make_isimportant_function(self, important_read_names):
-        # Set cluster skip test
-        if important_read_names == 'all':
-            def isimportant(*args):
-                return True
-        else:
-            if not isinstance(important_read_names, set):
-                important_read_names = set(important_read_names)
-
-            def isimportant(read_name):
-                return read_name in important_read_names
-        return isimportant
-
+        # each file is only opened once to find its channels, and once more to find its grid if that's needed
+        self.channel_names = {h5_fpath: hdf5tools.load_channel_names(h5_fpath) for h5_fpath in h5_fpaths}
+        self._grid_dimensions = {}
+        self.store = scorestore.ScoreStore(h5_fpaths, self.channel_names, np.array([], dtype=np.str_))
+        self._score_column = 'raw_score'
+        # with incremental scoring, the saved scores of each file, and the index of each image in the results
+        self._caches = {}
+        self._image_index = {}
+
+    @property
+    def raw_scores(self):
+        return scorestore.ConcentrationsView(self.store, functools.partial(scorestore.ImageScoresView, column='raw_score'))
+
+    @property
+    def scores(self):
+        return scorestore.ConcentrationsView(self.store, functools.partial(scorestore.ImageScoresView, column=self._score_column))
+
+    @property
+    def channels(self):
+        """ Every channel in any of the files. """
+        return sorted(set(channel for channels in self.channel_names.values() for channel in channels))
+
+    def _empty_given_channel(self):
+        return {h5_fpath: {channel: {} for channel in self.channel_names[h5_fpath]} for h5_fpath in self.h5_fpaths}
+
+    def grid_dimensions(self, h5_fpath):
+        if h5_fpath not in self._grid_dimensions:
+            self._grid_dimensions[h5_fpath] = hdf5tools.calculate_grid_dimensions(h5_fpath)
+        return self._grid_dimensions[h5_fpath]
+
+    def _read_ids_in_table(self, read_names):
+        """ The IDs of the reads that are in the table of read names, ignoring any that aren't. """
+        read_names = np.array(sorted(read_names), dtype=np.str_)
+        if len(read_names) == 0 or len(self.store.read_names) == 0:
+            return np.array([], dtype=np.int32)
+        read_ids = np.minimum(np.searchsorted(self.store.read_names, read_names), len(self.store.read_names) - 1)
+        return read_ids[self.store.read_names[read_ids] == read_names].astype(np.int32)
+
+    @instrument.timed('lda_scoring')
     def get_LDA_scores(self,
                        results_dirs,
                        lda_weights_fpath,
                        side_px=3,
                        verbose=True,
-                       important_read_names='all'):
-        isimportant = self._make_isimportant_function(important_read_names)
+                       important_read_names='all',
+                       processes=1,
+                       incremental=False,
+                       subpixel_bins=None):
+        """
+        Scores every aligned read in every image, replacing any scores from before. With more than one process, the
+        images are scored by a pool of worker processes, each of which reads its images and reads itself and only
+        sends back the IDs and scores of the reads.
 
+        If incremental, the raw scores of each image are saved in its results directory, and only images that are new
+        or have been aligned again since the last time are scored. The rest are loaded.
+
+        If subpixel_bins is given, reads are scored at their sub-pixel positions, rounded to the nearest 1 / subpixel_bins
+        of a pixel, with kernels from kernel_bank. Reads within side_px + 1 pixels of the edge are skipped.
+
+        """
         # Read scores
         lda_weights = np.loadtxt(lda_weights_fpath)
-        im_loc_re = re.compile('Channel_(.+)_Pos_(\d+)_(\d+)_')
-        image_parsing_regex = re.compile(r'^(?P<channel>.+)_(?P<minor>\d+)_(?P<major>\d+)_')
+        kernels = kernel_bank(lda_weights, subpixel_bins) if subpixel_bins else None
+        read_names = readrcs.load_read_names_table(results_dirs)
+        self.store = scorestore.ScoreStore(self.h5_fpaths, self.channel_names, read_names)
+        self._score_column = 'raw_score'
+        self._caches = {}
+        self._image_index = {}
+        important_read_ids = None if important_read_names == 'all' else self._read_ids_in_table(important_read_names)
+        tasks = []
+        versions_given_h5_fpath = {}
         for h5_fpath, results_dir in zip(self.h5_fpaths, results_dirs):
-            results_fpaths = glob.glob(os.path.join(results_dir, '*_all_read_rcs.txt'))
+            if not incremental:
+                tasks.extend((h5_fpath, results_dir, image_index) for image_index in readrcs.image_indexes(results_dir))
+                continue
+            legacy = not readrcs.has_results(results_dir)
+            parameters = scorecache.parameters_key(lda_weights, side_px, subpixel_bins, read_names if legacy else None)
+            cache = self._caches[h5_fpath] = scorecache.ScoreCache(results_dir, h5_fpath, parameters)
+            versions = versions_given_h5_fpath[h5_fpath] = readrcs.alignment_versions(results_dir)
+            cache.remove([image_index for image_index in cache.versions if image_index not in versions])
+            unchanged = sorted(image_index for image_index, version in versions.items() if cache.is_current(image_index, version))
+            for image_index, read_ids, scores in cache.load(unchanged):
+                self._add_image_scores(h5_fpath, image_index, read_ids, scores, important_read_ids)
+            changed = sorted(set(versions) - set(unchanged))
+            tasks.extend((h5_fpath, results_dir, image_index) for image_index in changed)
+            if verbose:
+                print '{}: {:,d} images already scored, {:,d} to score'.format(os.path.basename(h5_fpath), len(unchanged), len(changed))
+
+        for (h5_fpath, results_dir, image_index), read_ids, scores in self._score_images(tasks, lda_weights, side_px, kernels,
+                                                                                           read_names, processes, verbose):
+            if incremental:
+                self._caches[h5_fpath].save(image_index, versions_given_h5_fpath[h5_fpath][image_index], read_ids, scores)
+            self._add_image_scores(h5_fpath, image_index, read_ids, scores, important_read_ids)
+            instrument.count('images_scored')
+            instrument.count('reads_scored', len(read_ids))
+
+    def _score_images(self, tasks, lda_weights, side_px, kernels, read_names, processes, verbose):
+        """ Yields each (h5_fpath, results_dir, image_index) task, with the IDs and scores of the reads in its image. """
+        if processes > 1:
+            if verbose:
+                print 'Scoring {:,d} images with {} processes'.format(len(tasks), processes)
+            # workers only need the table of read names for results from older versions, which have no read IDs
+            legacy = any(not readrcs.has_results(results_dir) for _, results_dir, _ in tasks)
+            for result in imap(functools.partial(score_image, lda_weights, side_px, kernels), tasks, processes, _set_read_names,
+                               (read_names if legacy else None,)):
+                yield result
+            return
+
+        for h5_fpath, h5_tasks in itertools.groupby(tasks, key=lambda task: task[0]):
             if verbose:
                 print h5_fpath
-                print 'Num results files:', len(results_fpaths)
-
-            for i, rfpath in enumerate(results_fpaths):
-                rfname = os.path.basename(rfpath)
-                try:
-                    m = im_loc_re.match(rfname)
-                    channel = m.group(1)
-                    minor, major = tuple(int(m.group(i)) for i in (2, 3))
-                except:
-                    try:
-                        m = image_parsing_regex.match(rfname)
-                        channel = m.group('channel')
-                        minor, major = int(m.group('minor')), int(m.group('major'))
-                    except:
-                        print rfname
-                        raise
-
-                pos_key = hdf5tools.get_image_key(major, minor)
-
-                self.scores[h5_fpath][channel][(major, minor)] = {}
-
-                with h5py.File(h5_fpath) as f:
-                    im = np.array(f[channel][pos_key])
-
-                for line in open(rfpath):
-                    read_name, r, c = line.strip().split()
-                    if not isimportant(read_name):
-                        continue
-                    r, c = map(misc.stoftoi, (r, c))
-                    if (side_px <= r < im.shape[0] - side_px - 1
-                        and side_px <= c < im.shape[0] - side_px - 1):
-                        x = im[r - side_px:r + side_px + 1, c - side_px:c + side_px + 1].astype(np.float)
-                        score = float(np.multiply(lda_weights, x).sum())
-                        self.scores[h5_fpath][channel][(major, minor)][read_name] = score
-
-    def normalize_scores(self, verbose=True):
+
+            num_images = 0
+            with h5py.File(h5_fpath, 'r') as h5:
+                for task in h5_tasks:
+                    _, results_dir, image_index = task
+                    num_images += 1
+                    channel, pos_tup = parse_image_index(image_index)
+                    im = h5[channel][hdf5tools.get_image_key(*pos_tup)][...]
+                    read_ids, rcs = readrcs.load_read_ids_and_rcs(results_dir, image_index, read_names)
+                    indexes, scores = lda_scores(im, rcs, lda_weights, side_px, kernels)
+                    yield task, read_ids[indexes], scores
+            if verbose:
+                print 'Num images:', num_images
+
+    def _add_image_scores(self, h5_fpath, image_index, read_ids, scores, important_read_ids):
+        channel, pos_tup = parse_image_index(image_index)
+        self._image_index[(h5_fpath, channel, pos_tup)] = image_index
+        if important_read_ids is not None:
+            important = np.in1d(read_ids, important_read_ids)
+            read_ids, scores = read_ids[important], scores[important]
+        self.store.add(h5_fpath, channel, pos_tup, read_ids, scores)
+
+    def _image_modes(self, processes):
+        """ The mode of the pixels of every scored image. Modes that were saved with incremental scores are reused. """
+        mode_given_pos_tup_given_channel = self._empty_given_channel()
+        tasks = []
+        for h5_fpath in self.h5_fpaths:
+            cached_modes = self._caches[h5_fpath].modes if h5_fpath in self._caches else {}
+            for channel in self.channel_names[h5_fpath]:
+                for pos_tup in sorted(self.raw_scores[h5_fpath][channel]):
+                    image_index = self._image_index.get((h5_fpath, channel, pos_tup))
+                    if image_index in cached_modes:
+                        mode_given_pos_tup_given_channel[h5_fpath][channel][pos_tup] = cached_modes[image_index]
+                    else:
+                        tasks.append((h5_fpath, channel, pos_tup))
+        results = imap(image_mode, tasks, processes) if processes > 1 else self._find_image_modes(tasks)
+        new_modes = defaultdict(dict)
+        for (h5_fpath, channel, pos_tup), mode in results:
+            mode_given_pos_tup_given_channel[h5_fpath][channel][pos_tup] = mode
+            if h5_fpath in self._caches:
+                new_modes[h5_fpath][self._image_index[(h5_fpath, channel, pos_tup)]] = mode
+        for h5_fpath, mode_given_image_index in new_modes.items():
+            self._caches[h5_fpath].save_modes(mode_given_image_index)
+        return mode_given_pos_tup_given_channel
+
+    @staticmethod
+    def _find_image_modes(tasks):
+        """ Yields each (h5_fpath, channel, pos_tup) task with the mode of its image, opening each file once. """
+        for h5_fpath, h5_tasks in itertools.groupby(tasks, key=lambda task: task[0]):
+            with h5py.File(h5_fpath, 'r') as h5:
+                for task in h5_tasks:
+                    _, channel, pos_tup = task
+                    yield task, mode_in_image(h5[channel][hdf5tools.get_image_key(*pos_tup)][...])
+
+    def _normalize(self):
+        """ Divides the raw scores of every image by its normalizing constant. """
+        for channel in self.channels:
+            self.store.normalize(channel, {(h5_fpath, pos_tup): Z for h5_fpath in self.h5_fpaths
+                                           for pos_tup, Z in self.normalizing_constants[h5_fpath].get(channel, {}).items()})
+        self._score_column = 'norm_score'
+
+    def normalize_scores(self, verbose=True, processes=1):
         """Normalizes scores. The normalizing constant for each image is determined by
 
             Z = mode(pixel values) / median(all modes in h5_fpath)
-        """
 
-        def get_mode_in_im(im):
-            w = 200
-            hw = w / 2
-            rmid, cmid = int(im.shape[0] / 2), int(im.shape[1] / 2)
-            vmin, vmax = im.min(), im.max()
-            # remove saturation
-            pct95 = vmin + 0.95 * (vmax - vmin)
-            vals = [v for v in im[rmid - hw:rmid + hw, cmid - hw:cmid + hw].flatten() if v < pct95]
-            return misc.get_mode(vals)
-
-        self.scores = {
-            h5_fpath: {channel: {} for channel in hdf5tools.load_channel_names(h5_fpath)}
-            for h5_fpath in self.h5_fpaths
-            }
-        self.normalizing_constants = {
-            h5_fpath: {channel: {} for channel in hdf5tools.load_channel_names(h5_fpath)}
-            for h5_fpath in self.h5_fpaths
-            }
+        With more than one process, the modes are found by a pool of worker processes.
+        """
+        self.normalizing_constants = self._empty_given_channel()
+        mode_given_pos_tup_given_channel = self._image_modes(processes)
         for h5_fpath in self.h5_fpaths:
             if verbose: print os.path.basename(h5_fpath)
-            for channel in self.scores[h5_fpath].keys():
-                mode_given_pos_tup = {}
-                for pos_tup in self.raw_scores[h5_fpath][channel].keys():
-                    pos_key = hdf5tools.get_image_key(*pos_tup)
-                    with h5py.File(h5_fpath) as f:
-                        im = np.array(f[channel][pos_key])
-
-                    mode_given_pos_tup[pos_tup] = get_mode_in_im(im)
-
+            for channel, mode_given_pos_tup in mode_given_pos_tup_given_channel[h5_fpath].items():
                 median_of_modes = np.median(mode_given_pos_tup.values())
                 for pos_tup in mode_given_pos_tup.keys():
                     Z = mode_given_pos_tup[pos_tup] / float(median_of_modes)
                     self.normalizing_constants[h5_fpath][channel][pos_tup] = Z
-                    im_scores = self.raw_scores[h5_fpath][channel][pos_tup]
-                    self.scores[h5_fpath][channel][pos_tup] = {
-                        read_name: im_scores[read_name] / Z
-                        for read_name in self.get_read_names_in_image(h5_fpath, channel, pos_tup)
-                        }
             if verbose: print
+        self._normalize()
 
     def normalize_scores_by_ref_read_names(self, ref_read_names_given_channel, verbose=True):
         """Normalizes scores. The normalizing constant for each image is determined by
 
             Z = median(reference read scores) / 100
         """
-        self.scores = {
-            h5_fpath: {channel: {} for channel in hdf5tools.load_channel_names(h5_fpath)}
-            for h5_fpath in self.h5_fpaths
-            }
-        self.normalizing_constants = {
-            h5_fpath: {channel: {} for channel in hdf5tools.load_channel_names(h5_fpath)}
-            for h5_fpath in self.h5_fpaths
-            }
+        self.normalizing_constants = self._empty_given_channel()
+        median_given_image = {}
+        for channel in self.channels:
+            # the rows of each image are contiguous, so every image's median is found at once
+            table = self.store.table(channel)
+            bounds = sorted(self.store.image_bounds(channel).items(), key=lambda item: item[1][0])
+            images = np.repeat(np.arange(len(bounds)), [end - start for _, (start, end) in bounds])
+            is_ref = np.isin(table['read_id'], self._read_ids_in_table(ref_read_names_given_channel[channel]))
+            medians, counts = misc.grouped_medians(table['raw_score'][is_ref], images[is_ref], len(bounds))
+            for ((concentration, image), _), median, count in zip(bounds, medians, counts):
+                median_given_image[(self.h5_fpaths[concentration], channel, self.store.positions[image])] = median, count
         for h5_fpath in self.h5_fpaths:
             log.debug(os.path.basename(h5_fpath))
-            for channel in self.scores[h5_fpath].keys():
-                ref_read_names = ref_read_names_given_channel[channel]
-                for pos_tup in self.raw_scores[h5_fpath][channel].keys():
-                    ref_read_names_in_image = (
-                        self.get_read_names_in_image(h5_fpath, channel, pos_tup)
-                        & ref_read_names
-                    )
-                    if len(ref_read_names_in_image) < 10:
+            for channel in self.channel_names[h5_fpath]:
+                for pos_tup in self.raw_scores[h5_fpath][channel]:
+                    median, count = median_given_image[(h5_fpath, channel, pos_tup)]
+                    if count < 10:
                         print 'Warning: 10 > {} reference reads in im_idx {}'.format(
-                            len(ref_read_names_in_image), (h5_fpath, channel, pos_tup)
+                            count, (h5_fpath, channel, pos_tup)
                         )
 
-                    med = np.median(
-                        [self.raw_scores[h5_fpath][channel][pos_tup][read_name]
-                         for read_name in ref_read_names_in_image]
-                    )
-
-                    Z = med / 100.0
+                    Z = median / 100.0
                     self.normalizing_constants[h5_fpath][channel][pos_tup] = Z
-                    im_scores = self.raw_scores[h5_fpath][channel][pos_tup]
-                    self.scores[h5_fpath][channel][pos_tup] = {
-                        read_name: im_scores[read_name] / Z
-                        for read_name in self.get_read_names_in_image(h5_fpath, channel, pos_tup)
-                        }
+        self._normalize()
 
     def get_read_names_in_image(self, h5_fpath, channel, pos_tup):
-        return set(self.raw_scores[h5_fpath][channel][pos_tup].keys())
+        return set(self.store.names(self.store.image_rows(h5_fpath, channel, pos_tup)['read_id']))
 
     def build_score_given_read_name_given_channel(self):
-        self.score_given_read_name_in_channel = {
-            h5_fpath: {channel: {} for channel in hdf5tools.load_channel_names(h5_fpath)}
-            for h5_fpath in self.h5_fpaths
-            }
-        for h5_fpath in self.h5_fpaths:
-            print h5_fpath
-            i = 0
-            for channel in self.scores[h5_fpath].keys():
-                score_given_read_name = self.score_given_read_name_in_channel[h5_fpath][channel]
-                for pos_tup in self.scores[h5_fpath][channel].keys():
-                    for read_name, score in self.scores[h5_fpath][channel][pos_tup].items():
-                        score_given_read_name[read_name] = score
-                        i += 1
+        """ A view of the latest scores accessed as score_given_read_name_in_channel[h5_fpath][channel][read_name] """
+        self.score_given_read_name_in_channel = scorestore.ConcentrationsView(
+            self.store, functools.partial(scorestore.ReadScoresView, column=self._score_column))
 
     def plot_normalization_constants(self):
         for h5_fpath in self.h5_fpaths:
-            nMajor_pos, nminor_pos = hdf5tools.calculate_grid_dimensions(h5_fpath)
+            nMajor_pos, nminor_pos = self.grid_dimensions(h5_fpath)
             for channel in sorted(self.scores[h5_fpath].keys()):
                 fig, ax = plt.subplots(figsize=(10, 1))
                 M = np.empty((nminor_pos + 1, nMajor_pos + 1))
@@ -230,34 +417,26 @@ class IntensityScores(object):
                 ax.plot(cs, rs, marker, color=color, alpha=0.4, label=channel)
 
             ax.set_title('Aligned images in {}'.format(os.path.basename(h5_fpath)))
-            nMajor_pos, nminor_pos = hdf5tools.calculate_grid_dimensions(h5_fpath)
+            nMajor_pos, nminor_pos = self.grid_dimensions(h5_fpath)
             ax.set_ylim((nminor_pos, -1))
             ax.set_xlim((-1, 1.15 * nMajor_pos))  # Add room for legend
             ax.set_aspect(1)
             ax.legend()
 
     def print_reads_per_channel(self):
-        reads_in_channel = defaultdict(set)
-        for h5_fpath in self.h5_fpaths:
-            for channel in self.scores[h5_fpath].keys():
-                for score_given_read_name in self.scores[h5_fpath][channel].values():
-                    reads_in_channel[channel].update(score_given_read_name.keys())
-        for channel, read_names in sorted(reads_in_channel.items()):
-            print 'All reads found in channel {}: {:,d}'.format(channel, len(read_names))
+        for channel in self.channels:
+            num_reads = len(np.unique(self.store.table(channel)['read_id']))
+            print 'All reads found in channel {}: {:,d}'.format(channel, num_reads)
 
     def build_good_read_names(self, good_num_ims_cutoff):
-        pos_tups_given_read_name = defaultdict(set)
-        h5_fpaths_given_read_name = defaultdict(set)
+        """ The reads that were scored in at least good_num_ims_cutoff concentrations, in any channel. """
+        num_concentrations = np.zeros(len(self.store.read_names), dtype=np.int32)
         for h5_fpath in self.h5_fpaths:
-            for channel in self.scores[h5_fpath].keys():
-                for pos_tup in self.scores[h5_fpath][channel].keys():
-                    for read_name in self.scores[h5_fpath][channel][pos_tup].keys():
-                        pos_tups_given_read_name[read_name].add(pos_tup)
-                        h5_fpaths_given_read_name[read_name].add(h5_fpath)
-        self.good_read_names = set(
-            read_name for read_name, pos_tups in pos_tups_given_read_name.items()
-            if len(h5_fpaths_given_read_name[read_name]) >= good_num_ims_cutoff
-        )
+            scored = np.zeros(len(self.store.read_names), dtype=np.bool)
+            for channel in self.channel_names[h5_fpath]:
+                scored[self.store.concentration_rows(h5_fpath, channel)['read_id']] = True
+            num_concentrations += scored
+        self.good_read_names = set(self.store.names(np.flatnonzero(num_concentrations >= good_num_ims_cutoff)))
 
     def write_values_by_seq(self,
                             course_trait_name,
@@ -270,7 +449,8 @@ class IntensityScores(object):
                             out_fpath,
                             ):
         """
-        Writes output in array-like format.
+        Writes output in array-like format. If out_fpath ends with .h5, it's written in the binary format of
+        intensity_array.save_binary instead of as text.
 
         Params:
             :str:   course_trait_name - description of defining trait for h5_fpaths
@@ -283,6 +463,12 @@ class IntensityScores(object):
             :str:   out_fpath
         """
         assert len(h5_fpaths) == len(course_trait_list), (h5_fpaths, course_trait_list)
+        if out_fpath.endswith('.h5'):
+            intensity_array.save_binary(out_fpath, course_trait_name, course_trait_list, h5_fpaths, channel_of_interest,
+                                        attrs_dict, seqs_of_interest, read_names_given_seq,
+                                        self._intensities_given_seq(h5_fpaths, channel_of_interest, seqs_of_interest,
+                                                                    read_names_given_seq))
+            return
         with open(out_fpath, 'w') as out:
             out.write('# Defining Course Trait: {}\n'.format(course_trait_name))
             out.write('\t'.join(map(str, course_trait_list)) + '\n')
@@ -291,14 +477,32 @@ class IntensityScores(object):
             out.write('# Channel: {}\n'.format(str(channel_of_interest)))
             for k, v in sorted(attrs_dict.items()):
                 out.write('# {}: {}\n'.format(k, v))
-            for seq in seqs_of_interest:
-                out.write(seq + '\n')
-                read_names = list(read_names_given_seq[seq])
-                out.write('\t'.join(read_names) + '\n')
-                for h5_fpath in h5_fpaths:
-                    score_given_read_name = self.score_given_read_name_in_channel[h5_fpath][channel_of_interest]
-                    out.write('\t'.join(str(float(score_given_read_name[read_name]))
-                                        if read_name in score_given_read_name
-                                        else '-'
-                                        for read_name in read_names)
-                              + '\n')
+            # one sequence is formatted and written at a time, so memory only depends on the largest sequence
+            for seq, read_names, intensities in self._intensities_given_seq(h5_fpaths, channel_of_interest,
+                                                                              seqs_of_interest, read_names_given_seq):
+                lines = [seq, '\t'.join(read_names)]
+                lines.extend(format_scores(intensities.T))
+                out.write('\n'.join(lines) + '\n')
+
+    def _intensities_given_seq(self, h5_fpaths, channel, seqs, read_names_given_seq):
+        """
+        Yields each seq with its read names and their scores, as a matrix of reads by h5_fpaths with NaN where a read
+        wasn't scored. Reads are looked up in the sorted arrays of read IDs and scores of score_given_read_name_in_channel
+        all at once.
+        """
+        views = [self.score_given_read_name_in_channel[h5_fpath][channel] for h5_fpath in h5_fpaths]
+        all_read_names = self.store.read_names
+        for seq in seqs:
+            read_names = list(read_names_given_seq[seq])
+            intensities = np.full((len(read_names), len(views)), np.nan)
+            if len(read_names) and len(all_read_names):
+                names = np.array(read_names, dtype=np.str_)
+                read_ids = np.minimum(np.searchsorted(all_read_names, names), len(all_read_names) - 1)
+                in_table = all_read_names[read_ids] == names
+                for column, view in enumerate(views):
+                    if len(view.read_ids) == 0:
+                        continue
+                    index = np.minimum(np.searchsorted(view.read_ids, read_ids), len(view.read_ids) - 1)
+                    scored = in_table & (view.read_ids[index] == read_ids)
+                    intensities[scored, column] = view.scores[index[scored]]
+            yield seq, read_names, intensities
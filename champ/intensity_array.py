@@ -1,3 +1,6 @@
+from collections import Mapping, Sequence
+import json
+import h5py
 import numpy as np
 import os
 import re
@@ -7,6 +10,83 @@ bases = 'ACGT'
 bases_set = set(bases)
 
 
+def save_binary(out_fpath, course_trait_name, course_trait_list, h5_fpaths, channel, attrs_dict, seqs,
+                read_names_given_seq, intensities_given_seq):
+    """
+    Writes an IntensityArray as an HDF5 file. The intensities of every read are in one float32 matrix of reads by
+    concentrations, with NaN for missing data, and the reads of the i-th sequence are rows seq_offsets[i] to
+    seq_offsets[i + 1]. None of the datasets are chunked or compressed, so that they can be memory-mapped.
+
+    intensities_given_seq yields (seq, read_names, intensities) for each seq in seqs, in order, where intensities has a
+    row for each of the sequence's reads, so only one sequence's reads need to be in memory at a time.
+    """
+    seqs = list(seqs)
+    num_reads = np.array([len(read_names_given_seq[seq]) for seq in seqs], dtype=np.int64)
+    seq_offsets = np.concatenate([[0], np.cumsum(num_reads)]).astype(np.int64)
+    name_length = max([len(name) for seq in seqs for name in read_names_given_seq[seq]] or [1])
+    with h5py.File(out_fpath, 'w') as h5:
+        h5.attrs['course_trait_name'] = course_trait_name
+        h5.attrs['course_trait_list'] = np.array(course_trait_list, dtype=np.float64)
+        h5.attrs['h5_fpaths'] = json.dumps(list(h5_fpaths))
+        h5.attrs['channel'] = str(channel)
+        h5.attrs['attributes'] = json.dumps([(str(k), str(v)) for k, v in sorted(attrs_dict.items())])
+        h5.create_dataset('seqs', data=np.array(seqs, dtype='S%d' % max(map(len, seqs) or [1])))
+        h5.create_dataset('seq_offsets', data=seq_offsets)
+        read_names = h5.create_dataset('read_names', (seq_offsets[-1],), dtype='S%d' % name_length)
+        intensities = h5.create_dataset('intensities', (seq_offsets[-1], len(course_trait_list)), dtype=np.float32)
+        for i, (seq, seq_read_names, seq_intensities) in enumerate(intensities_given_seq):
+            assert seq == seqs[i], (seq, seqs[i])
+            start, end = seq_offsets[i], seq_offsets[i + 1]
+            if end > start:
+                read_names[start:end] = np.array(seq_read_names, dtype=read_names.dtype)
+                intensities[start:end] = seq_intensities
+
+
+def _memmap(h5, name):
+    """ Maps a dataset straight from the file if it can be, and reads it otherwise. """
+    dataset = h5[name]
+    offset = dataset.id.get_offset()
+    if offset is None or dataset.chunks is not None:
+        return dataset[...]
+    return np.memmap(h5.filename, dtype=dataset.dtype, mode='r', offset=offset, shape=dataset.shape)
+
+
+class ValuesBySeq(Sequence):
+    """ Looks like a list with something for each sequence, which is made from the rows of the sequence's reads. """
+    def __init__(self, seq_offsets, make_value):
+        self._seq_offsets = seq_offsets
+        self._make_value = make_value
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return self._make_value(self._seq_offsets[i], self._seq_offsets[i + 1])
+
+    def __len__(self):
+        return len(self._seq_offsets) - 1
+
+
+class ValueGivenSeq(Mapping):
+    """ Looks like {seq: value}, for the values of a ValuesBySeq. """
+    def __init__(self, seqs, idx_given_seq, values_by_seq):
+        self._seqs = seqs
+        self._idx_given_seq = idx_given_seq
+        self._values_by_seq = values_by_seq
+
+    def __getitem__(self, seq):
+        return self._values_by_seq[self._idx_given_seq[seq]]
+
+    def __iter__(self):
+        return iter(self._seqs)
+
+    def __len__(self):
+        return len(self._seqs)
+
+
 class IntensityArray(object):
 
     def parse_intensities_file(self, fpath):
@@ -23,8 +103,10 @@ class IntensityArray(object):
                 - list of lists of lists with intensity by seq by concentration by read.
                     Value of None for missing data
 
-        build_derived_objects also called.
+        build_derived_objects also called. Binary files written by save_binary are loaded with load_binary_file.
         """
+        if h5py.is_hdf5(fpath):
+            return self.load_binary_file(fpath)
         with open(fpath) as f:
             line = next(f)
             assert line.startswith('# Defining Course Trait:'), line
@@ -68,6 +150,45 @@ class IntensityArray(object):
                     break
         self.build_derived_objects()
 
+    def load_binary_file(self, fpath):
+        """
+        Loads an IntensityArray written by save_binary. The intensities and read names are memory-mapped, and
+        read_names, intensity_lolol and the derived objects are views that only read the rows of a sequence when
+        it's used.
+        """
+        with h5py.File(fpath, 'r') as h5:
+            self.course_trait_name = str(h5.attrs['course_trait_name'])
+            self.course_trait_list = map(float, h5.attrs['course_trait_list'])
+            self.h5_fpaths = map(str, json.loads(h5.attrs['h5_fpaths']))
+            self.channel = str(h5.attrs['channel'])
+            self.attr_names = []
+            for name, value in json.loads(h5.attrs['attributes']):
+                setattr(self, str(name), str(value))
+                self.attr_names.append(str(name))
+            self.seqs = h5['seqs'][...].tolist()
+            self.seq_offsets = h5['seq_offsets'][...]
+            self.all_read_names = _memmap(h5, 'read_names')
+            self.intensities = _memmap(h5, 'intensities')
+        self.read_names = ValuesBySeq(self.seq_offsets, self._read_names_in_rows)
+        self.intensity_lolol = ValuesBySeq(self.seq_offsets, self._intensity_lol_in_rows)
+        self.course_len = len(self.course_trait_list)
+        self.intensity_loloarr = ValuesBySeq(self.seq_offsets, self._intensity_loarr_in_rows)
+        self.idx_given_seq = {seq: i for i, seq in enumerate(self.seqs)}
+        self.read_names_given_seq = ValueGivenSeq(self.seqs, self.idx_given_seq, self.read_names)
+        self.intensity_lol_given_seq = ValueGivenSeq(self.seqs, self.idx_given_seq, self.intensity_lolol)
+        self.intensity_loarr_given_seq = ValueGivenSeq(self.seqs, self.idx_given_seq, self.intensity_loloarr)
+        self.nseqs = len(self.seqs)
+
+    def _read_names_in_rows(self, start, end):
+        return self.all_read_names[start:end].tolist()
+
+    def _intensity_lol_in_rows(self, start, end):
+        return [[None if v != v else v for v in column]
+                for column in self.intensities[start:end].T.astype(np.float64).tolist()]
+
+    def _intensity_loarr_in_rows(self, start, end):
+        return [column[~np.isnan(column)] for column in self.intensities[start:end].T.astype(np.float64)]
+
     def build_derived_objects(self):
         """
         Sets derived traits, including:
@@ -145,7 +266,7 @@ class IntensityArray(object):
         return map(np.median, self.intensity_loarr_given_seq[seq])
 
     def modes_given_seq(self, seq):
-        return map(misc.get_mode, self.intensity_loarr_given_seq[seq])
+        return misc.get_modes(self.intensity_loarr_given_seq[seq]).tolist()
 
     def stdevs_given_seq(self, seq):
         return map(np.std, self.intensity_loarr_given_seq[seq])
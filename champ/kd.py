@@ -5,7 +5,7 @@ import numpy as np
 import matplotlib.pyplot as plt
 import misc
 import itertools
-from champ import seqtools
+from champ import instrument, seqtools
 
 
 class KdFitIA(object):
@@ -259,6 +259,7 @@ class KdFitIA(object):
                 self.fit_func_given_Imin_max_names[(Imin_name, Imax_name)] = self.ML_fit_Kd
                 self.Imin_max_pairs_given_names[(Imin_name, Imax_name)] = (Imin, Imax)
 
+    @instrument.timed('kd_fit')
     def fit_all_Kds(self, num_bootstraps=20):
         self.setup_for_fit()
 
@@ -1,6 +1,7 @@
 import sys
 import pysam
 import misc
+from champ import instrument
 from champ.kd import IAKdData
 from scipy.optimize import curve_fit
 from collections import defaultdict
@@ -241,6 +242,7 @@ class KdFitGenome(object):
         for rs in self.read_scores_list:
             self.read_scores_list.remove(rs)
 
+    @instrument.timed('kd_genome_fit')
     def fit_Kds_in_bam_and_write_results(self, bam_fpath, out_fpath):
         """Fit Kds at every status change in overlapping reads"""
         self.ColumnTitles = ['Pos', 'Kd_All', 'Cov']
@@ -0,0 +1,146 @@
+import logging
+import os
+import sqlite3
+import time
+from StringIO import StringIO
+from champ import stats
+
+log = logging.getLogger(__name__)
+# How long a writer waits for another process to finish its write before giving up, in seconds
+lock_timeout = 600.0
+schema = """
+CREATE TABLE IF NOT EXISTS alignments (
+    concentration TEXT NOT NULL,
+    channel TEXT NOT NULL,
+    image_row INTEGER NOT NULL,
+    image_column INTEGER NOT NULL,
+    strategy TEXT NOT NULL,
+    method TEXT,
+    score INTEGER NOT NULL,
+    exclusive_hits INTEGER,
+    good_mutual_hits INTEGER,
+    bad_mutual_hits INTEGER,
+    non_mutual_hits INTEGER,
+    stats TEXT NOT NULL,
+    seconds REAL,
+    updated REAL NOT NULL,
+    PRIMARY KEY (concentration, channel, image_row, image_column, strategy)
+)
+"""
+
+
+def concentration_name(base_name):
+    """ HDF5 files are identified by their name alone, so a ledger still works if the image directory is moved. """
+    return os.path.basename(os.path.splitext(base_name)[0])
+
+
+class AlignmentLedger(object):
+    """
+    Every alignment in an experiment, in one SQLite database.
+
+    Each image's alignment is a single row, keyed by the HDF5 file, channel, row, column and cluster strategy. It holds
+    the transform of each tile (as the same YAML that's in the legacy stats files), the hit counts, the score and how
+    long the alignment took. Checking what's already been done is one query per file instead of one YAML file per image.
+
+    Each process opens its own connection the first time it needs one, so a ledger can be passed to worker processes.
+    Every write is its own transaction, and writers wait for each other. We don't use write-ahead logging since it
+    doesn't work on network filesystems.
+
+    """
+    def __init__(self, path):
+        self.path = path
+        self._connection = None
+        self._pid = None
+
+    def __getstate__(self):
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'])
+
+    @property
+    def connection(self):
+        if self._connection is None or self._pid != os.getpid():
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+            self._connection = sqlite3.connect(self.path, timeout=lock_timeout)
+            self._pid = os.getpid()
+            with self._connection:
+                self._connection.execute(schema)
+        return self._connection
+
+    def record(self, base_name, channel, row, column, strategy, alignment_stats, method=None, seconds=None):
+        hits = alignment_stats.hits
+        with self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO alignments VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                    (concentration_name(base_name), channel, row, column, strategy, method,
+                                     alignment_stats.score, hits['exclusive'], hits['good_mutual'], hits['bad_mutual'],
+                                     hits['non_mutual'], alignment_stats.serialized, seconds, time.time()))
+
+    def score(self, base_name, channel, row, column):
+        """ The best score of any alignment of an image, or 0 if it hasn't been aligned. """
+        result = self.connection.execute("SELECT MAX(score) FROM alignments WHERE concentration = ? AND channel = ? "
+                                          "AND image_row = ? AND image_column = ?",
+                                          (concentration_name(base_name), channel, row, column)).fetchone()[0]
+        return result or 0
+
+    def stats(self, base_name, channel, row, column):
+        """ The AlignmentStats of the best alignment of an image, or None if it hasn't been aligned. """
+        result = self.connection.execute("SELECT stats FROM alignments WHERE concentration = ? AND channel = ? "
+                                         "AND image_row = ? AND image_column = ? ORDER BY score DESC LIMIT 1",
+                                         (concentration_name(base_name), channel, row, column)).fetchone()
+        if result is None:
+            return None
+        return stats.AlignmentStats().from_file(StringIO(result[0]))
+
+    def completed(self, base_name, channel):
+        """ The (row, column) of every image in a file and channel that has been aligned. """
+        return set(self.connection.execute("SELECT image_row, image_column FROM alignments WHERE concentration = ? "
+                                           "AND channel = ? AND score > 0", (concentration_name(base_name), channel)))
+
+    def images(self, base_name):
+        """ The (channel, row, column) of every image in a file that has been aligned. """
+        return set(self.connection.execute("SELECT channel, image_row, image_column FROM alignments WHERE "
+                                           "concentration = ? AND score > 0", (concentration_name(base_name),)))
+
+    def forget(self, base_name, channel, row, column):
+        """ Removes every alignment of an image, so that it will be aligned again. """
+        with self.connection:
+            self.connection.execute("DELETE FROM alignments WHERE concentration = ? AND channel = ? AND image_row = ? "
+                                    "AND image_column = ?", (concentration_name(base_name), channel, row, column))
+
+    def aligned(self, base_name, channel):
+        """ Yields the row, column and AlignmentStats of the best alignment of every aligned image in a file and channel. """
+        rows = self.connection.execute("SELECT image_row, image_column, stats FROM alignments WHERE concentration = ? "
+                                       "AND channel = ? AND score > 0 ORDER BY score",
+                                       (concentration_name(base_name), channel)).fetchall()
+        best = {}
+        for row, column, serialized in rows:
+            # rows are sorted by score, so the best alignment of each image wins
+            best[(row, column)] = serialized
+        for (row, column), serialized in sorted(best.items(), key=lambda item: (item[0][1], item[0][0])):
+            yield row, column, stats.AlignmentStats().from_file(StringIO(serialized))
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM alignments").fetchone()[0]
+
+    def export(self, results_directory, base_names=()):
+        """
+        Writes the best alignment of each image to a legacy {channel}_{row}_{column}_stats.txt file, in the results
+        directory of its HDF5 file. base_names are the names the results directories were created with.
+
+        """
+        base_name_given_concentration = {concentration_name(base_name): base_name for base_name in base_names}
+        rows = self.connection.execute("SELECT concentration, channel, image_row, image_column, stats FROM alignments "
+                                       "WHERE score > 0 ORDER BY score").fetchall()
+        count = 0
+        for concentration, channel, row, column, serialized in rows:
+            directory = os.path.join(results_directory, base_name_given_concentration.get(concentration, concentration))
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+            # lower scores are written first and overwritten by better ones
+            with open(os.path.join(directory, '%s_%.3d_%.3d_stats.txt' % (channel, row, column)), 'w') as f:
+                f.write(serialized)
+            count += 1
+        log.debug("Exported %d alignments to %s" % (count, results_directory))
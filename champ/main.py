@@ -2,11 +2,13 @@
 Chip-Hybridized Affinity Mapping Platform
 
 Usage:
-  champ map FASTQ_DIRECTORY OUTPUT_DIRECTORY [--log-p-file=LOG_P_FILE] [--target-sequence-file=TARGET_SEQUENCE_FILE] [--phix-bowtie=PHIX_BOWTIE] [--min-len=MIN_LEN] [--max-len=MAX_LEN] [--include-side-1] [-v | -vv | -vvv]
+  champ map FASTQ_DIRECTORY OUTPUT_DIRECTORY [--log-p-file=LOG_P_FILE] [--target-sequence-file=TARGET_SEQUENCE_FILE] [--phix-bowtie=PHIX_BOWTIE] [--min-len=MIN_LEN] [--max-len=MAX_LEN] [--include-side-1] [--profile=STAGES] [-v | -vv | -vvv]
   champ init IMAGE_DIRECTORY READ_NAMES_DIRECTORY [ALIGNMENT_CHANNEL] [--perfect-target-name=PERFECT_TARGET_NAME] [--neg-control-target-name=NEG_CONTROL_TARGET_NAME] [--alternate-perfect-reads=ALTERNATE_PERFECT_READS] [--alternate-good-reads=ALTERNATE_GOOD_READS] [--alternate-fiducial-reads=ALTERNATE_FIDUCIAL_READS] [--microns-per-pixel=0.266666666] [--chip=miseq] [--ports-on-right] [--flipud] [--fliplr] [-v | -vv | -vvv ]
-  champ h5 IMAGE_DIRECTORY [--min-column=MINCOL] [--max-column=MAXCOL] [-v | -vv | -vvv]
-  champ align IMAGE_DIRECTORY [--rotation-adjustment=ROTATION_ADJUSTMENT] [--min-hits=MIN_HITS] [--snr=SNR] [--process-limit=PROCESS_LIMIT] [--make-pdfs] [--fiducial-only] [-v | -vv | -vvv]
+  champ h5 IMAGE_DIRECTORY [--min-column=MINCOL] [--max-column=MAXCOL] [--profile=STAGES] [-v | -vv | -vvv]
+  champ align IMAGE_DIRECTORY [--rotation-adjustment=ROTATION_ADJUSTMENT] [--min-hits=MIN_HITS] [--snr=SNR] [--process-limit=PROCESS_LIMIT] [--image-timeout=IMAGE_TIMEOUT] [--precision-strategy=PRECISION_STRATEGY] [--reuse-alignments] [--chip-model] [--export-stats] [--make-pdfs] [--png-thumbnails] [--fiducial-only] [--profile=STAGES] [-v | -vv | -vvv]
   champ info IMAGE_DIRECTORY
+  champ migrate IMAGE_DIRECTORY [-v | -vv | -vvv]
+  champ benchmark REPORT_FILE [--chip=miseq] [--densities=DENSITIES] [--images-per-density=COUNT] [--min-hits=MIN_HITS] [--precision-strategy=PRECISION_STRATEGY] [-v | -vv | -vvv]
   champ notebooks
 
 Options:
@@ -19,16 +21,26 @@ Commands:
   h5            Looks into all directories in IMAGE_DIRECTORY and converts any valid TIFFs it finds into HDF5 files
   align         Determines the sequence of fluorescent points in the microscope data. Preprocesses images if not already done
   info          View the metadata associated with an experiment
+  migrate       Converts the aligned read text files from older versions into binary results files
+  benchmark     Times the alignment of synthetic images and checks that they align where they should
   notebooks     Creates copies of the standard Jupyter analysis notebooks in the current directory
 
+Each map, h5 and align run saves a summary of how long each stage took, and what it processed, in an instrumentation
+directory next to its data. --profile takes a comma-separated list of stages (e.g. rough_align,precision_align) to
+profile with cProfile as well.
+
 """
 import logging
 import os
+from champ import instrument
 from champ.config import CommandLineArguments
 from champ.constants import VERSION
-from champ.controller import align, initialize, h5, mapreads, info, notebooks
+from champ.controller import align, benchmark, initialize, h5, mapreads, info, migrate, notebooks
 from docopt import docopt
 
+# These commands do enough work that it's worth knowing where the time went
+instrumented_commands = ('map', 'h5', 'align')
+
 
 def main(**kwargs):
     docopt_args = docopt(__doc__, version=VERSION)
@@ -47,9 +59,16 @@ def main(**kwargs):
                 'h5': h5,
                 'map': mapreads,
                 'info': info,
+                'migrate': migrate,
+                'benchmark': benchmark,
                 'notebooks': notebooks}
 
-    commands[arguments.command].main(arguments)
+    if arguments.command in instrumented_commands:
+        instrument.start(arguments.instrumentation_directory, arguments.command, arguments.profile_stages)
+    try:
+        commands[arguments.command].main(arguments)
+    finally:
+        instrument.finish()
 
 
 if __name__ == '__main__':
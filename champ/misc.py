@@ -30,6 +30,95 @@ def right_rotation_matrix(angle, degrees=True):
                      [-sina, cosa]])
 
 
+def similarity_transform(src, dst):
+    """
+    Finds the scaling, rotation and offset that best maps src onto dst in the least squares sense.
+
+    This is the closed-form (Umeyama/Procrustes) solution without reflection. Both point sets are
+    centered, after which the optimal alpha = lambda cos(theta) and beta = lambda sin(theta) are just
+    dot products of the centered coordinates, so no design matrix is needed.
+
+    Returns:
+        :float: lbda - scaling
+        :float: theta - rotation in radians
+        :array: offset - (r, c) translation
+    """
+    src = np.asarray(src, dtype=np.float)
+    dst = np.asarray(dst, dtype=np.float)
+    src_mean = src.mean(axis=0)
+    dst_mean = dst.mean(axis=0)
+    src_centered = src - src_mean
+    dst_centered = dst - dst_mean
+    norm = (src_centered ** 2).sum()
+    alpha = (src_centered * dst_centered).sum() / norm
+    beta = (src_centered[:, 0] * dst_centered[:, 1] - src_centered[:, 1] * dst_centered[:, 0]).sum() / norm
+    theta = np.arctan2(beta, alpha)
+    lbda = np.hypot(alpha, beta)
+    offset = dst_mean - apply_similarity_transform(src_mean, lbda, theta, (0.0, 0.0))
+    return lbda, theta, offset
+
+
+def apply_similarity_transform(points, lbda, theta, offset):
+    """ Maps points by lambda * R(theta) * x + offset. Works for a single point or an N x 2 array. """
+    cost = lbda * np.cos(theta)
+    sint = lbda * np.sin(theta)
+    transform = np.array([[cost, sint],
+                          [-sint, cost]])
+    return np.dot(points, transform) + offset
+
+
+def invert_similarity_transform(points, lbda, theta, offset):
+    """ Undoes apply_similarity_transform. """
+    return apply_similarity_transform(np.asarray(points) - offset, 1.0 / lbda, -theta, 0)
+
+
+def ransac_similarity_transform(src, dst, inlier_thresh, iterations=500, random_state=None):
+    """
+    Robustly finds the similarity transform mapping src onto dst when some pairs are wrong.
+
+    Two point pairs fully determine a similarity transform. Treating points as complex numbers, a
+    hypothesis is a = (w1 - w2) / (z1 - z2), t = w1 - a * z1, and all hypotheses are scored at once
+    by counting pairs that land within inlier_thresh. The best hypothesis' inliers are then refit
+    with similarity_transform.
+
+    Returns:
+        :float: lbda - scaling
+        :float: theta - rotation in radians
+        :array: offset - (r, c) translation
+        :array: inliers - boolean mask over the point pairs
+    """
+    src = np.asarray(src, dtype=np.float)
+    dst = np.asarray(dst, dtype=np.float)
+    if len(src) < 2:
+        raise ValueError("At least two point pairs are needed to find a similarity transform")
+    src_z = src[:, 0] + 1j * src[:, 1]
+    dst_z = dst[:, 0] + 1j * dst[:, 1]
+    random_state = np.random.RandomState(random_state)
+    first = random_state.randint(0, len(src), iterations)
+    second = random_state.randint(0, len(src), iterations)
+    delta = src_z[first] - src_z[second]
+    usable = delta != 0
+    first, second, delta = first[usable], second[usable], delta[usable]
+    if len(first) == 0:
+        raise ValueError("All sampled point pairs were degenerate")
+    a = (dst_z[first] - dst_z[second]) / delta
+    t = dst_z[first] - a * src_z[first]
+
+    # Score hypotheses in blocks so memory stays bounded for images with many hits
+    inlier_counts = np.zeros(len(a), dtype=np.int)
+    block = 64
+    for start in range(0, len(a), block):
+        stop = start + block
+        residuals = np.abs(a[start:stop, np.newaxis] * src_z + t[start:stop, np.newaxis] - dst_z)
+        inlier_counts[start:stop] = (residuals < inlier_thresh).sum(axis=1)
+    best = inlier_counts.argmax()
+    inliers = np.abs(a[best] * src_z + t[best] - dst_z) < inlier_thresh
+    if inliers.sum() < 2:
+        raise ValueError("No similarity transform had enough inliers")
+    lbda, theta, offset = similarity_transform(src[inliers], dst[inliers])
+    return lbda, theta, offset, inliers
+
+
 def strisfloat(x):
     try:
         a = float(x)
@@ -87,7 +176,96 @@ def list_if_scalar(x, list_len):
         return x
 
 
+# Binned densities are evaluated at this many points per bandwidth, and the kernel is cut off this many bandwidths out
+mode_points_per_bandwidth = 10
+mode_kernel_bandwidths = 5
+# Batches bigger than this many values fall out of the cache, so they're no faster than one sample at a time
+mode_batch_values = 1 << 14
+
+
+def _binned_kde_peaks(samples, minimums, bandwidths, width):
+    # in grid points from the edge of each row, with room for the kernel on the left
+    margin = mode_kernel_bandwidths * mode_points_per_bandwidth
+    positions = np.concatenate([(vals - minimum) * (mode_points_per_bandwidth / bandwidth) + margin
+                                for vals, minimum, bandwidth in zip(samples, minimums, bandwidths)])
+    # linear binning, which puts each value between its two nearest grid points
+    low = positions.astype(np.int64)
+    fraction = positions - low
+    flat = low
+    if len(samples) > 1:
+        flat = low + np.repeat(np.arange(len(samples)) * width, [len(vals) for vals in samples])
+    counts = (np.bincount(flat, 1.0 - fraction, minlength=len(samples) * width) +
+              np.bincount(flat + 1, fraction, minlength=len(samples) * width)).reshape(len(samples), width)
+    offsets = np.arange(-margin, margin + 1)
+    kernel = np.zeros(width)
+    kernel[offsets] = np.exp(-0.5 * (offsets / float(mode_points_per_bandwidth))**2)
+    density = np.fft.irfft(np.fft.rfft(counts, axis=1) * np.fft.rfft(kernel), width, axis=1)
+    peaks = density.argmax(axis=1)
+    rows = np.arange(len(samples))
+    left, center, right = (density[rows, (peaks + shift) % width] for shift in (-1, 0, 1))
+    curvature = left - 2 * center + right
+    with np.errstate(divide='ignore', invalid='ignore'):
+        refinement = np.where(curvature < 0, 0.5 * (left - right) / curvature, 0.0)
+    return minimums + (peaks + refinement - margin) / mode_points_per_bandwidth * bandwidths
+
+
+def get_modes(samples):
+    """
+    The mode of each sample, all at once. Each sample's density is a Gaussian KDE with Silverman's bandwidth, like
+    get_kde_mode, but it's binned on a grid and smoothed with an FFT instead of being maximized point by point, and
+    the peak is refined with a parabola through the highest grid point and its neighbors. Samples are scaled by their
+    own bandwidths, so samples that need grids of the same size share one grid and one kernel.
+
+    """
+    samples = [np.asarray(vals, dtype=np.float).ravel() for vals in samples]
+    if any(len(vals) == 0 for vals in samples):
+        raise ValueError("Can't find the mode of an empty sample")
+    bandwidths = np.array([1.06 * vals.std() * len(vals)**(-1.0/5.0) for vals in samples])
+    minimums = np.array([vals.min() for vals in samples])
+    constant = bandwidths == 0
+    bandwidths[constant] = 1.0
+    spans = np.array([vals.max() for vals in samples]) - minimums
+    widths = np.array([next_power_of_2(span / bandwidth * mode_points_per_bandwidth + 2 * mode_kernel_bandwidths * mode_points_per_bandwidth + 2)
+                       for span, bandwidth in zip(spans, bandwidths)])
+    lengths = np.array([len(vals) for vals in samples])
+    modes = np.empty(len(samples))
+    for width in np.unique(widths):
+        indexes = np.flatnonzero(widths == width)
+        batches = np.cumsum(lengths[indexes]) // mode_batch_values
+        for batch in np.unique(batches):
+            batch_indexes = indexes[batches == batch]
+            modes[batch_indexes] = _binned_kde_peaks([samples[index] for index in batch_indexes], minimums[batch_indexes],
+                                                     bandwidths[batch_indexes], width)
+    modes[constant] = minimums[constant]
+    return modes
+
+
 def get_mode(vals):
+    """
+    The mode of the values, found by get_modes. This is the highest peak of the density. get_kde_mode climbs from the
+    median instead, so when the density has more than one peak, it can stop at a lower one and give another mode.
+    """
+    return float(get_modes([vals])[0])
+
+
+def grouped_medians(values, groups, num_groups):
+    """
+    The median of the values in each group, numbered from 0 to num_groups - 1, and how many values each group has.
+    Groups without any values have a median of NaN. The medians are the same as np.median gives.
+    """
+    order = np.lexsort((values, groups))
+    values = np.asarray(values, dtype=np.float)[order]
+    counts = np.bincount(groups, minlength=num_groups)
+    starts = np.cumsum(counts) - counts
+    if len(values) == 0:
+        return np.full(num_groups, np.nan), counts
+    lower = values[np.minimum(starts + (counts - 1) // 2, len(values) - 1)]
+    upper = values[np.minimum(starts + counts // 2, len(values) - 1)]
+    return np.where(counts > 0, (lower + upper) / 2.0, np.nan), counts
+
+
+def get_kde_mode(vals):
+    """ The mode found by maximizing a Gaussian KDE directly. Much slower than get_mode, which approximates it. """
     h = 1.06 * np.std(vals) * len(vals)**(-1.0/5.0)
     kdf = KernelDensity(bandwidth=h)
     kdf.fit(np.array(vals).reshape(len(vals), 1))
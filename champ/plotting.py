@@ -1,7 +1,7 @@
 import matplotlib.pyplot as plt
 import numpy as np
+from matplotlib.collections import EllipseCollection, LineCollection
 from matplotlib.lines import Line2D
-from matplotlib.patches import Ellipse
 from matplotlib import gridspec
 import matplotlib as mpl
 import flabpal
@@ -262,45 +262,75 @@ def add_sequence_labels(fig, left_grid, bottom_grid, dimension, sequence_labels,
     return left_sequence_ax, bottom_sequence_ax
 
 
+# The categories of hits, from worst to best, with the colors they're drawn in. Better hits are drawn on top.
+hit_categories = (('non_mutual', 'Non-mutual hits', 'grey'),
+                  ('bad_mutual', 'Bad mutual hits', 'blue'),
+                  ('good_mutual', 'Good mutual hits', 'magenta'),
+                  ('exclusive', 'Exclusive hits', 'red'))
+
+
+def hits_given_category(fia):
+    """ The (cluster_index, in_frame_idx) pairs of each category of hit, as N x 2 arrays. """
+    return {category: np.array(sorted(getattr(fia, category + '_hits')), dtype=np.int).reshape(-1, 2)
+            for category, _, _ in hit_categories}
+
+
+def alignment_title(fia):
+    return ('All Hits: %s vs. %s\nRot: %s deg, Fq width: %s um, Scale: %s px/fqu, Corr: %s, SNR: %s'
+            % (fia.image_data.fname,
+               ','.join(tile.key for tile in fia.hitting_tiles),
+               ','.join('%.2f' % tile.rotation_degrees for tile in fia.hitting_tiles),
+               ','.join('%.2f' % tile.width for tile in fia.hitting_tiles),
+               ','.join('%.5f' % tile.scale for tile in fia.hitting_tiles),
+               ','.join('%.1f' % tile.best_max_corr if hasattr(tile, 'best_max_corr') else '0.0' for tile in fia.hitting_tiles),
+               ','.join('%.2f' % tile.snr if hasattr(tile, 'snr') else '-' for tile in fia.hitting_tiles)))
+
+
+def hit_dists(cluster_rcs, aligned_rcs, hits):
+    return np.linalg.norm(cluster_rcs[hits[:, 0]] - aligned_rcs[hits[:, 1]], axis=1)
+
+
 def plot_hit_hists(fia, ax=None):
     """ Plots histograms of the different quality cluster alignment categories. """
+    return plot_hit_dist_hists(fia.clusters.point_rcs, fia.aligned_rcs_in_frame, hits_given_category(fia),
+                               fia.image_data.fname, ax)
+
+
+def plot_hit_dist_hists(cluster_rcs, aligned_rcs, hits, image_name, ax=None):
+    """ Plots histograms of the distances between the clusters and reads of each category of hit. """
     if ax is None:
         fig, ax = plt.subplots(figsize=(8, 8))
-    non_mut_dists = fia.hit_dists(fia.non_mutual_hits)
-    bins = np.linspace(0, max(non_mut_dists), 50)
-
-    if non_mut_dists:
-        ax.hist(non_mut_dists, bins, label='Non-mutual hits', normed=True, histtype='step')
-    if fia.bad_mutual_hits:
-        ax.hist(fia.hit_dists(fia.bad_mutual_hits), bins,
-                label='Bad mutual hits', normed=True, histtype='step')
-    if fia.good_mutual_hits:
-        ax.hist(fia.hit_dists(fia.good_mutual_hits), bins, label='Good mutual hits',
-                normed=True, histtype='step')
-    if fia.exclusive_hits:
-        ax.hist(fia.hit_dists(fia.exclusive_hits), bins, label='Exclusive hits',
-                normed=True, histtype='step')
+    dists = {category: hit_dists(cluster_rcs, aligned_rcs, hits[category]) for category, _, _ in hit_categories}
+    bins = np.linspace(0, dists['non_mutual'].max() if len(dists['non_mutual']) else 1.0, 50)
+    for category, label, _ in hit_categories:
+        if len(dists[category]):
+            ax.hist(dists[category], bins, label=label, normed=True, histtype='step')
     ax.legend()
-    ax.set_title('%s Nearest Neighbor Distance Distributions' % fia.image_data.fname)
+    ax.set_title('%s Nearest Neighbor Distance Distributions' % image_name)
     return ax
 
 
 def plot_hits(fia, hits, color, ax, kwargs={}):
-    """ Draws circles where hits are located. """
-    for i, j in hits:
-        ax.plot([fia.clusters.point_rcs[i, 1], fia.aligned_rcs_in_frame[j, 1]],
-                [fia.clusters.point_rcs[i, 0], fia.aligned_rcs_in_frame[j, 0]],
-                color=color, **kwargs)
+    """ Draws lines between the clusters and reads of each hit. """
+    hits = np.array(sorted(hits), dtype=np.int).reshape(-1, 2)
+    return plot_hit_lines(fia.clusters.point_rcs, fia.aligned_rcs_in_frame, hits, color, ax, kwargs)
+
+
+def plot_hit_lines(cluster_rcs, aligned_rcs, hits, color, ax, kwargs={}):
+    # one collection is much faster to draw than an artist for each hit
+    segments = np.stack([cluster_rcs[hits[:, 0]][:, ::-1], aligned_rcs[hits[:, 1]][:, ::-1]], axis=1)
+    ax.add_collection(LineCollection(segments, colors=color, **kwargs))
     return ax
 
 
 def plot_ellipses(fia, ax, alpha=1.0, color=(1, 0, 0)):
-    ells = [Ellipse(xy=(pt.c, pt.r), width=3, height=3, angle=0.0)
-            for pt in fia.clusters.points]
-    for e in ells:
-        ax.add_artist(e)
-        e.set_alpha(alpha)
-        e.set_facecolor(color)
+    return plot_cluster_ellipses(fia.clusters.point_rcs, ax, alpha, color)
+
+
+def plot_cluster_ellipses(cluster_rcs, ax, alpha=1.0, color=(1, 0, 0)):
+    ax.add_collection(EllipseCollection(3, 3, 0.0, units='xy', offsets=cluster_rcs[:, ::-1].reshape(-1, 2),
+                                        transOffset=ax.transData, facecolors=color, edgecolors='none', alpha=alpha))
+    return ax
 
 
 def plot_all_hits(fia, im_kwargs={}, line_kwargs={}, fqpt_kwargs={}, sext_kwargs={},
@@ -310,49 +340,39 @@ def plot_all_hits(fia, im_kwargs={}, line_kwargs={}, fqpt_kwargs={}, sext_kwargs
     hit locations drawn over them. Provides a very obvious measure of whether the alignment worked or not. 
     
     """
-    fig, ax = plt.subplots(figsize=(15, 15))
+    return plot_alignment(fia.image_data.image, fia.clusters.point_rcs, fia.aligned_rcs_in_frame, hits_given_category(fia),
+                          alignment_title(fia), im_kwargs, line_kwargs, fqpt_kwargs, sext_kwargs, title_kwargs, legend_kwargs)
+
+
+def plot_alignment(image, cluster_rcs, aligned_rcs, hits, title, im_kwargs={}, line_kwargs={}, fqpt_kwargs={},
+                   sext_kwargs={}, title_kwargs={}, legend_kwargs={}, figsize=(15, 15)):
+    """ plot_all_hits, from the saved diagnostics of an alignment instead of a FastqImageAligner. """
+    fig, ax = plt.subplots(figsize=figsize)
 
     kwargs = {'cmap': plt.get_cmap('Blues')}
     kwargs.update(im_kwargs)
-    ax.matshow(fia.image_data.image, **kwargs)
+    ax.matshow(image, **kwargs)
 
     kwargs = {'color': 'k', 'alpha': 0.3, 'linestyle': '', 'marker': 'o', 'markersize': 3}
     kwargs.update(fqpt_kwargs)
-    ax.plot(fia.aligned_rcs_in_frame[:, 1], fia.aligned_rcs_in_frame[:, 0], **kwargs)
+    ax.plot(aligned_rcs[:, 1], aligned_rcs[:, 0], **kwargs)
 
     kwargs = {'alpha': 0.6, 'color': 'darkgoldenrod'}
     kwargs.update(sext_kwargs)
-    plot_ellipses(fia, ax, **kwargs)
-
-    plot_hits(fia, fia.non_mutual_hits, 'grey', ax, line_kwargs)
-    plot_hits(fia, fia.bad_mutual_hits, 'b', ax, line_kwargs)
-    plot_hits(fia, fia.good_mutual_hits, 'magenta', ax, line_kwargs)
-    plot_hits(fia, fia.exclusive_hits, 'r', ax, line_kwargs)
-    ax.set_title('All Hits: %s vs. %s\nRot: %s deg, Fq width: %s um, Scale: %s px/fqu, Corr: %s, SNR: %s'
-            % (fia.image_data.fname,
-               ','.join(tile.key for tile in fia.hitting_tiles),
-               ','.join('%.2f' % tile.rotation_degrees for tile in fia.hitting_tiles),
-               ','.join('%.2f' % tile.width for tile in fia.hitting_tiles),
-               ','.join('%.5f' % tile.scale for tile in fia.hitting_tiles),
-               ','.join('%.1f' % tile.best_max_corr if hasattr(tile, 'best_max_corr') else '0.0' for tile in fia.hitting_tiles),
-               ','.join('%.2f' % tile.snr if hasattr(tile, 'snr') else '-' for tile in fia.hitting_tiles),
-               ), **title_kwargs)
-    ax.set_xlim([0, fia.image_data.image.shape[1]])
-    ax.set_ylim([fia.image_data.image.shape[0], 0])
-
-    grey_line = Line2D([], [], color='grey',
-            label='Non-mutual hits: %d' % (len(fia.non_mutual_hits)))
-    blue_line = Line2D([], [], color='blue',
-            label='Bad mutual hits: %d' % (len(fia.bad_mutual_hits)))
-    magenta_line = Line2D([], [], color='magenta',
-            label='Good mutual hits: %d' % (len(fia.good_mutual_hits)))
-    red_line = Line2D([], [], color='red',
-            label='Exclusive hits: %d' % (len(fia.exclusive_hits)))
-    sexcat_line = Line2D([], [], color='darkgoldenrod', alpha=0.6, marker='o', markersize=10,
-            label='Sextractor Ellipses: %d' % (len(fia.clusters.point_rcs)))
-    fastq_line = Line2D([], [], color='k', alpha=0.3, marker='o', markersize=10,
-            label='Fastq Points: %d' % (len(fia.aligned_rcs_in_frame)))
-    handles = [grey_line, blue_line, magenta_line, red_line, sexcat_line, fastq_line]
+    plot_cluster_ellipses(cluster_rcs, ax, **kwargs)
+
+    handles = []
+    for category, label, color in hit_categories:
+        plot_hit_lines(cluster_rcs, aligned_rcs, hits[category], color, ax, line_kwargs)
+        handles.append(Line2D([], [], color=color, label='%s: %d' % (label, len(hits[category]))))
+    ax.set_title(title, **title_kwargs)
+    ax.set_xlim([0, image.shape[1]])
+    ax.set_ylim([image.shape[0], 0])
+
+    handles.append(Line2D([], [], color='darkgoldenrod', alpha=0.6, marker='o', markersize=10,
+                          label='Sextractor Ellipses: %d' % len(cluster_rcs)))
+    handles.append(Line2D([], [], color='k', alpha=0.3, marker='o', markersize=10,
+                          label='Fastq Points: %d' % len(aligned_rcs)))
     legend = ax.legend(handles=handles, **legend_kwargs)
     legend.get_frame().set_color('white')
     return ax
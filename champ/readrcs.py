@@ -0,0 +1,341 @@
+from contextlib import contextmanager
+import fcntl
+import glob
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import uuid
+import h5py
+import numpy as np
+from champ import misc, scheduler
+
+log = logging.getLogger(__name__)
+# Each concentration has one HDF5 file with a group for each image, named by the image's index. Each group holds the
+# IDs of the reads in the image and their (r, c) coordinates. Read IDs index into a table of read names that's shared
+# by every concentration in the experiment, so each name is only stored once. Every time an image is written it gets
+# a new version.
+results_filename = 'read_rcs.h5'
+read_names_filename = 'read_names.npy'
+legacy_suffix = '_all_read_rcs.txt'
+# Workers write each image to its own file in a directory next to the results file, and the images are merged into
+# the results file once they're done. A worker that's killed or crashes can only lose the image it was writing.
+staging_suffix = '.images'
+corrupt_suffix = '.corrupt'
+
+
+def save_read_names(path, read_names):
+    """
+    Saves the table of read names that read IDs index into. Results files refer to it by ID, so it must never change
+    once results have been written. Returns whether the file was written.
+
+    """
+    if os.path.exists(path):
+        existing_read_names = np.load(path, mmap_mode='r')
+        if existing_read_names.shape == read_names.shape and (existing_read_names == read_names).all():
+            return False
+        raise ValueError("The reads have changed since %s was written, so the read IDs in the results would be wrong. "
+                         "Move the old results somewhere else and align again." % path)
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    np.save(path, read_names)
+    return True
+
+
+@contextmanager
+def locked(path):
+    # HDF5 files can't be written by two processes at once, so they take turns. The scheduler won't kill a worker
+    # that's holding the lock.
+    with scheduler.critical_section():
+        with open(path + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def staged_paths(path):
+    """ The file of each image that has been written but not merged into the results file yet, by image index. """
+    directory = path + staging_suffix
+    if not os.path.isdir(directory):
+        return {}
+    return {filename[:-len('.h5')]: os.path.join(directory, filename) for filename in os.listdir(directory)
+            if filename.endswith('.h5')}
+
+
+def write_image(path, read_names_path, image_index, read_ids, rcs):
+    """
+    Saves the IDs and coordinates of the reads in one image, replacing any that were already saved. The image is
+    written to a temporary file that's renamed into place when it's complete, and merge moves it into the results file.
+
+    """
+    directory = path + staging_suffix
+    try:
+        os.makedirs(directory)
+    except OSError:
+        if not os.path.isdir(directory):
+            raise
+    handle, temporary_path = tempfile.mkstemp(suffix='.tmp', dir=directory)
+    os.close(handle)
+    try:
+        with h5py.File(temporary_path, 'w') as h5:
+            # relative to the results file, so the results can be moved along with the read names
+            h5.attrs['read_names'] = os.path.relpath(os.path.abspath(read_names_path), os.path.dirname(os.path.abspath(path)))
+            h5.attrs['version'] = uuid.uuid4().hex
+            h5.create_dataset('read_ids', data=np.asarray(read_ids, dtype=np.int32))
+            h5.create_dataset('rcs', data=np.asarray(rcs, dtype=np.float32).reshape(-1, 2))
+        os.rename(temporary_path, os.path.join(directory, image_index + '.h5'))
+    finally:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+
+
+def _alignment_version(group):
+    if 'version' in group.attrs:
+        return str(group.attrs['version'])
+    # written by an older version, so the contents have to be compared
+    return hashlib.sha1(group['read_ids'][:].tostring() + group['rcs'][:].tostring()).hexdigest()
+
+
+def is_readable(path):
+    try:
+        with h5py.File(path, 'r'):
+            return True
+    except (IOError, OSError):
+        return False
+
+
+def recover(path):
+    """
+    Moves a results file that can't be read out of the way, so that a new one can be started. Results files are only
+    ever replaced whole, but older versions wrote to them in place, so a process that died could leave one corrupt.
+    Returns whether the file was corrupt.
+
+    """
+    if not os.path.exists(path) or is_readable(path):
+        return False
+    log.error("%s is corrupt, and has been moved to %s. The images that were in it will have to be aligned again."
+              % (path, path + corrupt_suffix))
+    os.rename(path, path + corrupt_suffix)
+    return True
+
+
+def merge(path):
+    """
+    Moves the images that have been written since the last merge into the results file. The images are added to a
+    copy of the results file, which then replaces it, so the results file is always complete, even if the merge is
+    interrupted. This must only be done while no process is writing images. Returns the number of images merged.
+
+    """
+    directory = path + staging_suffix
+    for temporary_path in glob.glob(os.path.join(directory, '*.tmp')):
+        # left behind by a worker that died while writing
+        os.remove(temporary_path)
+    image_paths = staged_paths(path)
+    if not image_paths:
+        return 0
+    with locked(path):
+        recover(path)
+        temporary_path = path + '.merging'
+        if os.path.exists(path):
+            shutil.copyfile(path, temporary_path)
+        elif os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        merged = []
+        with h5py.File(temporary_path, 'a') as h5:
+            for image_index, image_path in sorted(image_paths.items()):
+                try:
+                    with h5py.File(image_path, 'r') as image:
+                        read_names_path, version = image.attrs['read_names'], image.attrs['version']
+                        read_ids, rcs = image['read_ids'][:], image['rcs'][:]
+                except (IOError, OSError, KeyError) as e:
+                    log.warn("Could not read %s, so it wasn't merged: %s" % (image_path, e))
+                    continue
+                h5.attrs['read_names'] = read_names_path
+                if image_index in h5:
+                    del h5[image_index]
+                group = h5.create_group(image_index)
+                group.attrs['version'] = version
+                group.create_dataset('read_ids', data=read_ids)
+                group.create_dataset('rcs', data=rcs)
+                merged.append(image_path)
+        os.rename(temporary_path, path)
+        for image_path in merged:
+            os.remove(image_path)
+    return len(merged)
+
+
+def has_results(results_dir):
+    """ Whether a results directory has binary results, rather than results from an older version or none at all. """
+    path = os.path.join(results_dir, results_filename)
+    return os.path.exists(path) or bool(staged_paths(path))
+
+
+class ReadRCs(object):
+    """ Reads the results file of one concentration, along with any images that haven't been merged into it yet. """
+    def __init__(self, path):
+        self.path = path
+        self._read_names = None
+
+    @contextmanager
+    def _results(self):
+        """ The results file, open for reading, or None if there isn't one or it can't be read. """
+        h5 = None
+        if os.path.exists(self.path):
+            try:
+                h5 = h5py.File(self.path, 'r')
+            except (IOError, OSError) as e:
+                log.error("Could not read %s, so the images in it were skipped: %s. Run champ align or champ migrate to "
+                          "recover from this." % (self.path, e))
+        try:
+            yield h5
+        finally:
+            if h5 is not None:
+                h5.close()
+
+    @property
+    def image_indexes(self):
+        with self._results() as h5:
+            image_indexes = set(h5.keys()) if h5 is not None else set()
+        return sorted(image_indexes | set(staged_paths(self.path)))
+
+    @property
+    def read_names_path(self):
+        with self._results() as h5:
+            relative_path = h5.attrs['read_names'] if h5 is not None and 'read_names' in h5.attrs else None
+        if relative_path is None:
+            for image_path in staged_paths(self.path).values():
+                with h5py.File(image_path, 'r') as image:
+                    relative_path = image.attrs['read_names']
+                break
+        return os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(self.path)), relative_path))
+
+    @property
+    def read_names(self):
+        if self._read_names is None:
+            self._read_names = np.load(self.read_names_path, mmap_mode='r')
+        return self._read_names
+
+    @property
+    def versions(self):
+        """ The version of each image, which changes whenever it's written again. """
+        with self._results() as h5:
+            versions = {image_index: _alignment_version(h5[image_index]) for image_index in h5} if h5 is not None else {}
+        for image_index, image_path in staged_paths(self.path).items():
+            with h5py.File(image_path, 'r') as image:
+                versions[image_index] = str(image.attrs['version'])
+        return versions
+
+    def read_ids_and_rcs(self, image_index):
+        # images that haven't been merged yet are newer than the ones in the results file
+        image_path = staged_paths(self.path).get(image_index)
+        if image_path is not None:
+            with h5py.File(image_path, 'r') as image:
+                return image['read_ids'][:], image['rcs'][:]
+        with self._results() as h5:
+            if h5 is None or image_index not in h5:
+                raise KeyError(image_index)
+            group = h5[image_index]
+            return group['read_ids'][:], group['rcs'][:]
+
+    def read_names_and_rcs(self, image_index):
+        read_ids, rcs = self.read_ids_and_rcs(image_index)
+        return self.read_names[read_ids], rcs
+
+
+def iterate_results(results_dir):
+    """
+    Yields the index, read names and rcs of each aligned image in a concentration's results directory. Results from
+    older versions, with a text file for each image, are read if there are no binary results.
+
+    """
+    if has_results(results_dir):
+        read_rcs = ReadRCs(os.path.join(results_dir, results_filename))
+        for image_index in read_rcs.image_indexes:
+            read_names, rcs = read_rcs.read_names_and_rcs(image_index)
+            yield image_index, read_names, rcs
+        return
+    for text_path in sorted(glob.glob(os.path.join(results_dir, '*' + legacy_suffix))):
+        read_names, rcs = misc.read_names_and_points_given_rcs_fpath(text_path)
+        yield os.path.basename(text_path)[:-len(legacy_suffix)], read_names, rcs
+
+
+def image_indexes(results_dir):
+    """ The indexes of the aligned images in a concentration's results directory, in the order iterate_results yields them. """
+    if has_results(results_dir):
+        return ReadRCs(os.path.join(results_dir, results_filename)).image_indexes
+    return [os.path.basename(text_path)[:-len(legacy_suffix)]
+            for text_path in sorted(glob.glob(os.path.join(results_dir, '*' + legacy_suffix)))]
+
+
+def alignment_versions(results_dir):
+    """ The version of each aligned image in a concentration's results directory, which changes when it's aligned again. """
+    if has_results(results_dir):
+        return ReadRCs(os.path.join(results_dir, results_filename)).versions
+    versions = {}
+    for text_path in glob.glob(os.path.join(results_dir, '*' + legacy_suffix)):
+        stat = os.stat(text_path)
+        versions[os.path.basename(text_path)[:-len(legacy_suffix)]] = '%r-%d' % (stat.st_mtime, stat.st_size)
+    return versions
+
+
+def read_ids_given_names(all_read_names, read_names, source):
+    """ The IDs of read names in the sorted table of all read names. """
+    read_names = np.array(read_names, dtype=np.str_)
+    if len(read_names) == 0:
+        return np.array([], dtype=np.int32)
+    read_ids = np.minimum(np.searchsorted(all_read_names, read_names), len(all_read_names) - 1)
+    if not (all_read_names[read_ids] == read_names).all():
+        raise ValueError("%s has reads that aren't in the table of read names" % source)
+    return read_ids.astype(np.int32)
+
+
+def load_read_names_table(results_dirs):
+    """
+    The table of read names that the read IDs of every results directory index into. Results from older versions have
+    no IDs, so if none of the results are binary, the table is made from the reads in them.
+
+    """
+    paths = set(ReadRCs(os.path.join(results_dir, results_filename)).read_names_path for results_dir in results_dirs
+                if has_results(results_dir))
+    if len(paths) > 1:
+        raise ValueError("The results refer to more than one table of read names: %s" % ", ".join(sorted(paths)))
+    if paths:
+        return np.load(paths.pop(), mmap_mode='r')
+    return np.unique(np.concatenate([np.array(read_names, dtype=np.str_) for results_dir in results_dirs
+                                     for _, read_names, _ in iterate_results(results_dir)] or [np.array([], dtype=np.str_)]))
+
+
+def load_read_ids_and_rcs(results_dir, image_index, all_read_names):
+    """ The read IDs and rcs of one aligned image in a results directory, with IDs from the table of all read names. """
+    if has_results(results_dir):
+        return ReadRCs(os.path.join(results_dir, results_filename)).read_ids_and_rcs(image_index)
+    text_path = os.path.join(results_dir, image_index + legacy_suffix)
+    read_names, rcs = misc.read_names_and_points_given_rcs_fpath(text_path)
+    return read_ids_given_names(all_read_names, read_names, text_path), rcs
+
+
+def migrate(results_dir, read_names_path):
+    """
+    Converts the text files of aligned reads in a results directory to a binary results file. The text files are
+    left alone. Returns the number of images converted.
+
+    """
+    text_paths = sorted(glob.glob(os.path.join(results_dir, '*' + legacy_suffix)))
+    if not text_paths:
+        return 0
+    all_read_names = np.load(read_names_path, mmap_mode='r')
+    path = os.path.join(results_dir, results_filename)
+    recover(path)
+    for text_path in text_paths:
+        read_names, rcs = misc.read_names_and_points_given_rcs_fpath(text_path)
+        read_ids = read_ids_given_names(all_read_names, read_names, text_path)
+        write_image(path, read_names_path, os.path.basename(text_path)[:-len(legacy_suffix)], read_ids, rcs)
+    merge(path)
+    text_size = sum(os.path.getsize(text_path) for text_path in text_paths)
+    log.info("Converted %d images in %s from %.1f MB of text to %.1f MB" % (len(text_paths), results_dir, text_size / 1e6,
+                                                                           os.path.getsize(path) / 1e6))
+    return len(text_paths)
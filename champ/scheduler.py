@@ -0,0 +1,182 @@
+from collections import deque
+from contextlib import contextmanager
+import logging
+import multiprocessing
+import time
+import traceback
+
+log = logging.getLogger(__name__)
+# How long to wait between checks on busy workers, in seconds
+poll_interval = 0.05
+# In a worker process, how many critical sections it's in. The scheduler doesn't kill a worker in a critical section
+# for taking too long, so that it can't leave behind a file that's half written or a lock that's held.
+_critical = None
+
+
+@contextmanager
+def critical_section():
+    """ Keeps the scheduler from killing this worker until the block is over. Does nothing outside of a worker. """
+    if _critical is None:
+        yield
+        return
+    with _critical.get_lock():
+        _critical.value += 1
+    try:
+        yield
+    finally:
+        with _critical.get_lock():
+            _critical.value -= 1
+
+
+def work(connection, critical, initializer, initargs):
+    global _critical
+    _critical = critical
+    if initializer is not None:
+        initializer(*initargs)
+    while True:
+        message = connection.recv()
+        if message is None:
+            break
+        func, args = message
+        start_time = time.time()
+        try:
+            result = func(*args)
+        except Exception:
+            connection.send(('error', None, time.time() - start_time, traceback.format_exc()))
+        else:
+            connection.send(('ok', result, time.time() - start_time, None))
+
+
+class Worker(object):
+    """ A worker process, and the task it's working on, if any. """
+    def __init__(self, initializer, initargs):
+        self.connection, worker_connection = multiprocessing.Pipe()
+        self.critical = multiprocessing.Value('i', 0)
+        self.process = multiprocessing.Process(target=work, args=(worker_connection, self.critical, initializer, initargs))
+        self.process.daemon = True
+        self.process.start()
+        self.task = None
+        self.started = None
+
+    def start(self, func, task):
+        self.connection.send((func, task[1]))
+        self.task = task
+        self.started = time.time()
+
+    def finish(self):
+        task, self.task = self.task, None
+        return task
+
+    def stop(self):
+        try:
+            self.connection.send(None)
+        except IOError:
+            pass
+        self.process.join()
+
+    def kill(self):
+        self.process.terminate()
+        self.process.join()
+
+
+class Scheduler(object):
+    """
+    Runs tasks on worker processes, handing each one to the next worker that's free.
+
+    Unlike Pool.map, tasks aren't split into chunks ahead of time, so one slow task never holds up the ones behind it.
+    A task that runs for longer than `timeout` seconds has its worker killed, though not while it's in a critical
+    section, and a worker that dies takes only its own task with it. Either way, and when a task raises an exception,
+    it's retried with the next function in `funcs`, if there is one. Every task gets a result record, in the order the
+    tasks were given.
+
+    Workers are started the first time they're needed and kept until close() is called.
+
+    """
+    def __init__(self, num_processes, initializer=None, initargs=(), timeout=None):
+        self._num_processes = num_processes
+        self._initializer = initializer
+        self._initargs = initargs
+        self._timeout = timeout
+        self._workers = []
+
+    def run(self, funcs, tasks, callback=None):
+        """
+        Calls funcs[0](*task) for every task, and the later functions in funcs for retries. Returns a dict for each
+        task with the status ('ok', 'error', 'timeout' or 'crashed') of the last attempt, its result, how many
+        seconds it took, how many attempts were made, and the error, if there was one. If there's a callback, it's
+        called with the index and dict of each task as soon as its last attempt is over.
+
+        """
+        tasks = list(tasks)
+        records = [None] * len(tasks)
+        # each task is (index, args, attempt)
+        pending = deque((index, args, 0) for index, args in enumerate(tasks))
+        while len(self._workers) < min(self._num_processes, len(pending)):
+            self._workers.append(Worker(self._initializer, self._initargs))
+        while pending or any(worker.task is not None for worker in self._workers):
+            for position, worker in enumerate(self._workers):
+                if worker.task is None and pending:
+                    task = pending.popleft()
+                    self._start(position, funcs[task[2]], task)
+            time.sleep(poll_interval)
+            for position, worker in enumerate(self._workers):
+                if worker.task is None:
+                    continue
+                outcome = self._check(worker)
+                if outcome is None:
+                    continue
+                status, result, seconds, error = outcome
+                if status in ('crashed', 'timeout'):
+                    self._workers[position] = Worker(self._initializer, self._initargs)
+                index, args, attempt = worker.finish()
+                records[index] = {'status': status, 'result': result, 'seconds': seconds,
+                                  'attempts': attempt + 1, 'error': error}
+                if status != 'ok':
+                    log.warn("Attempt %d of task %s failed (%s): %s" % (attempt + 1, args, status, error))
+                    if attempt + 1 < len(funcs):
+                        pending.append((index, args, attempt + 1))
+                        continue
+                if callback is not None:
+                    callback(index, records[index])
+        return records
+
+    def _start(self, position, func, task):
+        """ Starts a task on an idle worker, replacing the worker first if it died while it was idle. """
+        worker = self._workers[position]
+        if worker.process.is_alive():
+            try:
+                worker.start(func, task)
+                return
+            except IOError:
+                # it died after we checked
+                pass
+        worker.kill()
+        log.warn("An idle worker died with exit code %s, starting a new one" % worker.process.exitcode)
+        worker = self._workers[position] = Worker(self._initializer, self._initargs)
+        worker.start(func, task)
+
+    def _check(self, worker):
+        """ Returns (status, result, seconds, error) if the worker's task is over, or None if it's still running. """
+        seconds = time.time() - worker.started
+        if worker.connection.poll():
+            try:
+                return worker.connection.recv()
+            except (EOFError, IOError):
+                # the worker died, closing its end of the pipe
+                pass
+        if not worker.process.is_alive():
+            worker.process.join()
+            return 'crashed', None, seconds, "Worker exited with code %s" % worker.process.exitcode
+        if self._timeout and seconds > self._timeout:
+            # holding the lock keeps the worker from entering a critical section while it's being killed
+            with worker.critical.get_lock():
+                if worker.critical.value:
+                    return None
+                worker.kill()
+            return 'timeout', None, seconds, "Took more than %s seconds" % self._timeout
+        return None
+
+    def close(self):
+        for worker in self._workers:
+            worker.stop()
+        self._workers = []
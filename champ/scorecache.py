@@ -0,0 +1,107 @@
+"""
+Raw LDA scores of each aligned image, saved in its concentration's results directory so that the next time scores are
+needed, only images that are new or have been aligned again are scored.
+
+Each image has a group, named by its index in the results, with the IDs of the reads that were scored, their raw
+scores and the version of the alignment they came from. Once it's been found, the mode of the image's pixels is kept
+with them. Scores are only used with the same LDA weights and HDF5 file they were made with, and the HDF5 file must
+have the same size and modification time.
+
+"""
+import hashlib
+import logging
+import os
+import h5py
+import numpy as np
+
+log = logging.getLogger(__name__)
+filename = 'lda_scores.h5'
+
+
+def parameters_key(lda_weights, side_px, subpixel_bins=None, read_names=None):
+    """
+    Identifies what scores were made with, so that scores made with other weights aren't used. Results from older
+    versions have no read IDs, so the IDs of their scores depend on the table of read names made from them, which
+    has to be given as well.
+
+    """
+    key = hashlib.sha1(np.ascontiguousarray(lda_weights, dtype=np.float64).tostring() + str(side_px))
+    if subpixel_bins:
+        key.update('subpixel_bins=%d' % subpixel_bins)
+    if read_names is not None:
+        key.update(np.ascontiguousarray(read_names).tostring())
+    return key.hexdigest()
+
+
+class ScoreCache(object):
+    def __init__(self, results_dir, h5_fpath, parameters):
+        self.path = os.path.join(results_dir, filename)
+        # the file's size and modification time tell us if its images have changed, without having to read them
+        h5_stat = os.stat(h5_fpath)
+        self._attrs = {'parameters': parameters, 'h5_filename': os.path.basename(h5_fpath), 'h5_size': h5_stat.st_size,
+                       'h5_mtime': h5_stat.st_mtime}
+        self.versions = {}
+        self.modes = {}
+        self._current = False
+        if not os.path.exists(self.path):
+            return
+        with h5py.File(self.path, 'r') as h5:
+            if any(h5.attrs.get(name) != value for name, value in self._attrs.items()):
+                log.info("The scores in %s were made with other weights or images, and will be replaced" % self.path)
+                return
+            for image_index, group in h5.items():
+                self.versions[image_index] = str(group.attrs['alignment_version'])
+                if 'mode' in group.attrs:
+                    self.modes[image_index] = float(group.attrs['mode'])
+        self._current = True
+
+    def _open(self):
+        # a file with scores that can't be used is started over
+        h5 = h5py.File(self.path, 'a' if self._current else 'w')
+        for name, value in self._attrs.items():
+            h5.attrs[name] = value
+        self._current = True
+        return h5
+
+    def is_current(self, image_index, version):
+        return self.versions.get(image_index) == version
+
+    def load(self, image_indexes):
+        """ Yields the image index, read IDs and raw scores of each image. """
+        if not image_indexes:
+            return
+        with h5py.File(self.path, 'r') as h5:
+            for image_index in image_indexes:
+                group = h5[image_index]
+                yield image_index, group['read_ids'][:], group['scores'][:]
+
+    def save(self, image_index, version, read_ids, scores):
+        """ Saves the scores of an image, replacing any that were saved before along with the image's mode. """
+        with self._open() as h5:
+            if image_index in h5:
+                del h5[image_index]
+            group = h5.create_group(image_index)
+            group.attrs['alignment_version'] = version
+            group.create_dataset('read_ids', data=np.asarray(read_ids, dtype=np.int32))
+            group.create_dataset('scores', data=np.asarray(scores, dtype=np.float64))
+        self.versions[image_index] = version
+        self.modes.pop(image_index, None)
+
+    def save_modes(self, mode_given_image_index):
+        if not mode_given_image_index:
+            return
+        with self._open() as h5:
+            for image_index, mode in mode_given_image_index.items():
+                h5[image_index].attrs['mode'] = mode
+        self.modes.update(mode_given_image_index)
+
+    def remove(self, image_indexes):
+        """ Forgets images that are no longer aligned. """
+        image_indexes = [image_index for image_index in image_indexes if image_index in self.versions]
+        if not image_indexes:
+            return
+        with self._open() as h5:
+            for image_index in image_indexes:
+                del h5[image_index]
+                del self.versions[image_index]
+                self.modes.pop(image_index, None)
@@ -0,0 +1,236 @@
+"""
+Intensity scores of every read in every image, in one table per channel.
+
+Each row is a read in an image: its ID in the sorted table of read names, the index of its concentration (the HDF5
+file), the index of the image's position, its raw score and its normalized score. Rows are sorted by concentration
+and then by the image's position, so the rows of a concentration or of an image are contiguous, and group-by
+operations are slices. Images without any scored reads have no rows, but they're still listed. The nested dicts that
+IntensityScores used to keep are provided as read-only views of the tables.
+
+"""
+from collections import Mapping
+import numpy as np
+
+table_dtype = np.dtype([('read_id', np.int32),
+                        ('concentration', np.int16),
+                        ('image', np.int32),
+                        ('raw_score', np.float64),
+                        ('norm_score', np.float64)])
+
+
+class ScoreStore(object):
+    def __init__(self, h5_fpaths, channel_names, read_names):
+        """ channel_names has the channels of each HDF5 file. read_names is the sorted table that read IDs index into. """
+        self.h5_fpaths = list(h5_fpaths)
+        self.channel_names = channel_names
+        self.read_names = read_names
+        self.positions = []
+        self._position_index = {}
+        self._concentration_index = {h5_fpath: index for index, h5_fpath in enumerate(self.h5_fpaths)}
+        self._chunks = {channel: [] for channels in channel_names.values() for channel in channels}
+        # every (concentration index, image index) that was added to each channel, including ones without any rows
+        self._images = {channel: set() for channel in self._chunks}
+        self._tables = {}
+        self._image_bounds = {}
+        self._image_dicts = {}
+
+    def add(self, h5_fpath, channel, pos_tup, read_ids, raw_scores):
+        """ Adds the scores of the reads in one image. """
+        if pos_tup not in self._position_index:
+            self._position_index[pos_tup] = len(self.positions)
+            self.positions.append(pos_tup)
+        chunk = np.empty(len(read_ids), dtype=table_dtype)
+        chunk['read_id'] = read_ids
+        chunk['concentration'] = self._concentration_index[h5_fpath]
+        chunk['image'] = self._position_index[pos_tup]
+        chunk['raw_score'] = raw_scores
+        chunk['norm_score'] = raw_scores
+        self._chunks[channel].append(chunk)
+        self._images[channel].add((self._concentration_index[h5_fpath], self._position_index[pos_tup]))
+        self._tables.pop(channel, None)
+        self._image_dicts.pop(channel, None)
+
+    def table(self, channel):
+        """ Every row of a channel, sorted by concentration and then by the position of the image. """
+        if channel not in self._tables:
+            chunks = self._chunks[channel]
+            table = np.concatenate(chunks) if chunks else np.empty(0, dtype=table_dtype)
+            # images are numbered in the order they were added, which depends on which worker finished first
+            position_rank = np.empty(len(self.positions), dtype=np.int64)
+            position_rank[sorted(range(len(self.positions)), key=self.positions.__getitem__)] = np.arange(len(self.positions))
+            # stable, so reads keep the order they were added in within each image
+            table = table[np.lexsort((position_rank[table['image']], table['concentration']))]
+            self._chunks[channel] = [table]
+            self._tables[channel] = table
+            keys = table['concentration'].astype(np.int64) << 32 | table['image']
+            starts = np.flatnonzero(np.diff(keys)) + 1
+            starts = np.concatenate([[0], starts]) if len(keys) else starts
+            ends = np.append(starts[1:], len(keys))
+            bounds = {(int(table['concentration'][start]), int(table['image'][start])): (start, end)
+                      for start, end in zip(starts, ends)}
+            # images without rows get empty bounds where their rows would be
+            sort_keys = table['concentration'].astype(np.int64) << 32 | position_rank[table['image']]
+            for concentration, image in self._images[channel] - set(bounds):
+                start = int(np.searchsorted(sort_keys, concentration << 32 | position_rank[image]))
+                bounds[(concentration, image)] = (start, start)
+            self._image_bounds[channel] = bounds
+        return self._tables[channel]
+
+    def image_bounds(self, channel):
+        """ The (start, end) rows of each (concentration index, image index) in a channel's table, even if it has none. """
+        self.table(channel)
+        return self._image_bounds[channel]
+
+    def image_rows(self, h5_fpath, channel, pos_tup):
+        """ The rows of one image, as a view of the channel's table, or None if the image wasn't scored. """
+        key = (self._concentration_index[h5_fpath], self._position_index.get(pos_tup))
+        bounds = self.image_bounds(channel).get(key)
+        if bounds is None:
+            return None
+        return self.table(channel)[bounds[0]:bounds[1]]
+
+    def concentration_rows(self, h5_fpath, channel):
+        """ The rows of one concentration, as a view of the channel's table. """
+        table = self.table(channel)
+        concentration = self._concentration_index[h5_fpath]
+        start, end = np.searchsorted(table['concentration'], [concentration, concentration + 1])
+        return table[start:end]
+
+    def positions_in_concentration(self, h5_fpath, channel):
+        concentration = self._concentration_index[h5_fpath]
+        return [self.positions[image] for c, image in sorted(self.image_bounds(channel)) if c == concentration]
+
+    def normalize(self, channel, Z_given_image):
+        """ Divides the raw scores of each image by its normalizing constant, given by (h5_fpath, pos_tup). """
+        table = self.table(channel)
+        for (concentration, image), (start, end) in self.image_bounds(channel).items():
+            Z = Z_given_image[(self.h5_fpaths[concentration], self.positions[image])]
+            table['norm_score'][start:end] = table['raw_score'][start:end] / Z
+        self._image_dicts.pop(channel, None)
+
+    def image_dict(self, h5_fpath, channel, pos_tup, column):
+        """
+        {read_name: score} for one image, or None if the image wasn't scored. The dict is kept until the channel's
+        scores change, so looking up reads one at a time doesn't make it again for each read.
+
+        """
+        key = (h5_fpath, pos_tup, column)
+        image_dicts = self._image_dicts.setdefault(channel, {})
+        if key not in image_dicts:
+            rows = self.image_rows(h5_fpath, channel, pos_tup)
+            if rows is None:
+                return None
+            image_dicts[key] = dict(zip(self.names(rows['read_id']), rows[column].tolist()))
+        return image_dicts[key]
+
+    def read_id(self, read_name):
+        """ The ID of a read in the sorted table of read names, or None if it isn't in it. """
+        index = int(np.searchsorted(self.read_names, read_name))
+        if index < len(self.read_names) and self.read_names[index] == read_name:
+            return index
+        return None
+
+    def names(self, read_ids):
+        return self.read_names[read_ids].tolist()
+
+
+class ConcentrationsView(Mapping):
+    """ Looks like {h5_fpath: {channel: view}}, where make_view makes the view of a concentration and channel. """
+    def __init__(self, store, make_view):
+        self._store = store
+        self._make_view = make_view
+
+    def __getitem__(self, h5_fpath):
+        if h5_fpath not in self._store.channel_names:
+            raise KeyError(h5_fpath)
+        return ChannelsView(self._store, h5_fpath, self._make_view)
+
+    def __iter__(self):
+        return iter(self._store.h5_fpaths)
+
+    def __len__(self):
+        return len(self._store.h5_fpaths)
+
+
+class ChannelsView(Mapping):
+    def __init__(self, store, h5_fpath, make_view):
+        self._store = store
+        self._h5_fpath = h5_fpath
+        self._make_view = make_view
+        self._views = {}
+
+    def __getitem__(self, channel):
+        if channel not in self._store.channel_names[self._h5_fpath]:
+            raise KeyError(channel)
+        if channel not in self._views:
+            self._views[channel] = self._make_view(self._store, self._h5_fpath, channel)
+        return self._views[channel]
+
+    def __iter__(self):
+        return iter(self._store.channel_names[self._h5_fpath])
+
+    def __len__(self):
+        return len(self._store.channel_names[self._h5_fpath])
+
+
+class ImageScoresView(Mapping):
+    """
+    Looks like {pos_tup: {read_name: score}} for one concentration and channel. Each image's dict is made when it's
+    needed, and kept by the store until the scores change.
+
+    """
+    def __init__(self, store, h5_fpath, channel, column):
+        self._store = store
+        self._h5_fpath = h5_fpath
+        self._channel = channel
+        self._column = column
+
+    def __getitem__(self, pos_tup):
+        image_dict = self._store.image_dict(self._h5_fpath, self._channel, pos_tup, self._column)
+        if image_dict is None:
+            raise KeyError(pos_tup)
+        return image_dict
+
+    def __iter__(self):
+        return iter(self._store.positions_in_concentration(self._h5_fpath, self._channel))
+
+    def __len__(self):
+        return len(self._store.positions_in_concentration(self._h5_fpath, self._channel))
+
+
+class ReadScoresView(Mapping):
+    """
+    Looks like {read_name: score} for one concentration and channel. If a read is in more than one image, the score
+    from the image with the last position is used.
+
+    """
+    def __init__(self, store, h5_fpath, channel, column):
+        rows = store.concentration_rows(h5_fpath, channel)[::-1]
+        # the first row of each read in reverse is its last row
+        self.read_ids, first = np.unique(rows['read_id'], return_index=True)
+        self.scores = rows[column][first]
+        self._store = store
+
+    def _index(self, read_name):
+        read_id = self._store.read_id(read_name)
+        if read_id is None:
+            return None
+        index = self.read_ids.searchsorted(read_id)
+        if index < len(self.read_ids) and self.read_ids[index] == read_id:
+            return index
+        return None
+
+    def __getitem__(self, read_name):
+        index = self._index(read_name)
+        if index is None:
+            raise KeyError(read_name)
+        return float(self.scores[index])
+
+    def __contains__(self, read_name):
+        return self._index(read_name) is not None
+
+    def __iter__(self):
+        return iter(self._store.names(self.read_ids))
+
+    def __len__(self):
+        return len(self.read_ids)
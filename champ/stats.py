@@ -20,13 +20,17 @@ class AlignmentStats(object):
         if not len(self._data['tile_keys']) == len(self._data['scalings']) == len(self._data['tile_widths']) == len(self._data['rotations']) == len(self._data['rc_offsets']):
             raise ValueError("Corrupt or invalid AlignmentStats file")
 
-    def from_data(self, tile_keys, scalings, tile_widths, rotations, rc_offsets, hits):
+    def from_data(self, tile_keys, scalings, tile_widths, rotations, rc_offsets, hits, residuals=None, iterations=None):
         self._data['tile_keys'] = tile_keys
         self._data['scalings'] = scalings
         self._data['tile_widths'] = tile_widths
         self._data['rotations'] = [rotation * np.pi / 180 for rotation in rotations]
         self._data['rc_offsets'] = rc_offsets
         self._data['hits'] = hits
+        # RMS distance in pixels between hits after precision alignment, and how many fits it took.
+        # Older stats files don't have these.
+        self._data['residuals'] = residuals or [None] * len(tile_keys)
+        self._data['iterations'] = iterations or [None] * len(tile_keys)
         self._validate_data()
         return self
 
@@ -45,6 +49,18 @@ class AlignmentStats(object):
             # change between each iteration.
             yield tile_key, scaling, tile_width, rotation, rc_offset, self._data['hits']
 
+    @property
+    def hits(self):
+        return self._data['hits']
+
+    @property
+    def residuals(self):
+        return self._data.get('residuals', [None] * len(self._data['tile_keys']))
+
+    @property
+    def iterations(self):
+        return self._data.get('iterations', [None] * len(self._data['tile_keys']))
+
     @property
     def serialized(self):
         return yaml.dump(dict(self._data))
@@ -0,0 +1,144 @@
+import os
+import numpy as np
+from champ import misc
+
+
+def parse_rcs(read_names):
+    """ Illumina read names end with the x and y coordinates of the cluster within its tile. """
+    return np.array([map(int, name.split(':')[-2:]) for name in read_names])
+
+
+class TileStore(object):
+    """
+    The read names and raw coordinates of every FastQ tile.
+
+    This is loaded once and then shared by every image, and by every worker process. It must never be
+    modified after loading. Anything that changes from one image to the next belongs in FastqTileRCs,
+    which only holds references to the arrays in here.
+
+    Reads are identified by integer IDs, which index into the sorted array of all read names in the
+    store. A store can be saved to a directory as one .npy file per array and attached to from other
+    processes, which memory-map the files instead of each holding their own copy.
+
+    The reads of each tile are sorted by their first raw coordinate, and the coordinates are stored
+    column by column, so the reads in a strip of a tile can be found with a binary search.
+
+    """
+    def __init__(self, tile_data=None, valid_keys=None):
+        self.names = np.array([], dtype=np.str_)
+        self.read_ids = {}
+        self.rcs = {}
+        self.mins = None
+        self.maxes = None
+        self._rotated_dims = {}
+        self._bounds = {}
+        if tile_data:
+            self.load(tile_data, valid_keys)
+
+    def load(self, tile_data, valid_keys=None):
+        tile_data = {tile_key: read_names for tile_key, read_names in tile_data.items()
+                     if valid_keys is None or tile_key in valid_keys}
+        # keep any tiles that were already loaded
+        for tile_key in self.rcs:
+            tile_data.setdefault(tile_key, list(self.read_names(tile_key)))
+        self.names = np.unique(np.concatenate([np.array(read_names, dtype=np.str_) for read_names in tile_data.values()]))
+        self.read_ids = {}
+        self.rcs = {}
+        for tile_key, read_names in tile_data.items():
+            read_ids = np.searchsorted(self.names, np.array(read_names, dtype=np.str_))
+            rcs = parse_rcs(read_names).astype(np.int32).reshape(-1, 2)
+            order = np.argsort(rcs[:, 0], kind='mergesort')
+            read_ids = read_ids[order]
+            rcs = np.asfortranarray(rcs[order])
+            read_ids.flags.writeable = False
+            rcs.flags.writeable = False
+            self.read_ids[tile_key] = read_ids
+            self.rcs[tile_key] = rcs
+        all_data = np.concatenate(self.rcs.values())
+        self.mins = all_data.min(axis=0)
+        self.maxes = all_data.max(axis=0)
+        self._rotated_dims = {}
+        self._bounds = {}
+        return self
+
+    def save(self, directory):
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        # remove tiles from any previous run so they aren't picked up when attaching
+        for filename in os.listdir(directory):
+            if filename.endswith('.npy'):
+                os.remove(os.path.join(directory, filename))
+        np.save(os.path.join(directory, 'names.npy'), self.names)
+        np.save(os.path.join(directory, 'bounds.npy'), np.array([self.mins, self.maxes]))
+        for tile_key in self.rcs:
+            np.save(os.path.join(directory, '%s.rcs.npy' % tile_key), self.rcs[tile_key])
+            np.save(os.path.join(directory, '%s.read_ids.npy' % tile_key), self.read_ids[tile_key])
+
+    def attach(self, directory):
+        """ Memory-maps a store that was saved to disk. The operating system shares the pages between processes. """
+        self.names = np.load(os.path.join(directory, 'names.npy'), mmap_mode='r')
+        self.mins, self.maxes = np.load(os.path.join(directory, 'bounds.npy'))
+        self.read_ids = {}
+        self.rcs = {}
+        for filename in os.listdir(directory):
+            if filename.endswith('.rcs.npy'):
+                tile_key = filename[:-len('.rcs.npy')]
+                self.rcs[tile_key] = np.load(os.path.join(directory, filename), mmap_mode='r')
+                self.read_ids[tile_key] = np.load(os.path.join(directory, '%s.read_ids.npy' % tile_key), mmap_mode='r')
+        self._rotated_dims = {}
+        self._bounds = {}
+        return self
+
+    def __contains__(self, tile_key):
+        return tile_key in self.rcs
+
+    def __len__(self):
+        return len(self.rcs)
+
+    def keys(self):
+        return self.rcs.keys()
+
+    def read_names(self, tile_key):
+        return self.names[self.read_ids[tile_key]]
+
+    def read_count(self, tile_key):
+        return len(self.read_ids[tile_key])
+
+    def bounds(self, tile_key):
+        """ The smallest and largest raw coordinates of the reads in a tile. """
+        if tile_key not in self._bounds:
+            self._bounds[tile_key] = self.rcs[tile_key].min(axis=0), self.rcs[tile_key].max(axis=0)
+        return self._bounds[tile_key]
+
+    def reads_in_box(self, tile_key, box_min, box_max):
+        """ The indexes of the reads in a tile whose raw coordinates are inside a box, inclusive. """
+        rcs = self.rcs[tile_key]
+        # the first coordinates are sorted and contiguous, so we only look at the strip the box spans
+        start = np.searchsorted(rcs[:, 0], box_min[0], side='left')
+        stop = np.searchsorted(rcs[:, 0], box_max[0], side='right')
+        second = rcs[start:stop, 1]
+        return start + np.flatnonzero((second >= box_min[1]) & (second <= box_max[1]))
+
+    def control_tile_keys(self, possible_tile_keys, count=2):
+        """ The largest tiles that can't be in the image, which are used to estimate the correlation of noise. """
+        impossible_tile_keys = [key for key in self.rcs if key not in possible_tile_keys]
+        impossible_tile_keys.sort(key=lambda key: -self.read_count(key))
+        return impossible_tile_keys[:count]
+
+    def rotated_dims(self, offset, scale, degrees):
+        """
+        The size of an image big enough to hold any tile once it's been scaled and rotated.
+
+        This only depends on the rough alignment parameters, which are the same for every image, so it's
+        calculated once per process instead of once per image.
+
+        """
+        key = (float(scale), float(degrees))
+        if key not in self._rotated_dims:
+            rotation = misc.right_rotation_matrix(degrees, degrees=True)
+            shapes = []
+            for rcs in self.rcs.values():
+                mapped_rcs = np.dot(scale * (rcs + offset), rotation)
+                shapes.append(mapped_rcs.max(axis=0) - mapped_rcs.min(axis=0) + 1)
+            self._rotated_dims[key] = np.array(shapes).max(axis=0)
+        return self._rotated_dims[key]
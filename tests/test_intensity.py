@@ -0,0 +1,123 @@
+import h5py
+import numpy as np
+from champ import hdf5tools, intensity, misc
+
+
+def loop_lda_scores(im, rcs, lda_weights, side_px=3):
+    """ How get_LDA_scores used to score reads, one at a time. """
+    indexes, scores = [], []
+    for index, (r, c) in enumerate(rcs):
+        r, c = misc.stoftoi(r), misc.stoftoi(c)
+        if (side_px <= r < im.shape[0] - side_px - 1
+                and side_px <= c < im.shape[0] - side_px - 1):
+            x = im[r - side_px:r + side_px + 1, c - side_px:c + side_px + 1].astype(np.float)
+            indexes.append(index)
+            scores.append(float(np.multiply(lda_weights, x).sum()))
+    return np.array(indexes, dtype=np.int64), np.array(scores)
+
+
+def random_image_and_rcs(random_state, size=256, num_reads=5000):
+    im = random_state.randint(0, 2 ** 16, (size, size)).astype(np.uint16)
+    rcs = random_state.uniform(-2, size + 2, (num_reads, 2))
+    # reads exactly half a pixel from where they'd be rounded into or out of bounds
+    edges = np.array([2.5, 3.5, size - 4.5, size - 3.5, -0.5, 0.5, size - 0.5])
+    rcs = np.concatenate([rcs, np.array([(r, c) for r in edges for c in edges])])
+    return im, rcs
+
+
+def test_lda_scores_match_loop():
+    random_state = np.random.RandomState(0)
+    im, rcs = random_image_and_rcs(random_state)
+    lda_weights = random_state.normal(size=(7, 7))
+    indexes, scores = intensity.lda_scores(im, rcs, lda_weights, 3)
+    expected_indexes, expected_scores = loop_lda_scores(im, rcs, lda_weights, 3)
+    assert np.array_equal(indexes, expected_indexes)
+    # each patch is summed in the same order, so the scores are identical and not just close
+    assert np.array_equal(scores, expected_scores)
+
+
+def test_lda_scores_with_other_side_px():
+    random_state = np.random.RandomState(1)
+    im, rcs = random_image_and_rcs(random_state, size=64, num_reads=500)
+    lda_weights = random_state.normal(size=(3, 3))
+    indexes, scores = intensity.lda_scores(im, rcs, lda_weights, 1)
+    expected_indexes, expected_scores = loop_lda_scores(im, rcs, lda_weights, 1)
+    assert np.array_equal(indexes, expected_indexes)
+    assert np.array_equal(scores, expected_scores)
+
+
+def test_unshifted_kernel_is_the_lda_weights():
+    lda_weights = np.random.RandomState(2).normal(size=(7, 7))
+    kernels = intensity.kernel_bank(lda_weights, 8)
+    assert kernels.shape == (9, 9, 9, 9)
+    assert np.allclose(kernels[4, 4], np.pad(lda_weights, 1, mode='constant'), rtol=0, atol=1e-12)
+
+
+def test_kernel_bank_scores_reads_on_pixels_like_the_loop():
+    random_state = np.random.RandomState(3)
+    im, _ = random_image_and_rcs(random_state)
+    lda_weights = random_state.normal(size=(7, 7))
+    # reads exactly on pixels aren't shifted at all
+    rcs = random_state.randint(0, 256, (5000, 2)).astype(np.float)
+    indexes, scores = intensity.lda_scores(im, rcs, lda_weights, 3, intensity.kernel_bank(lda_weights, 8))
+    # shifted kernels have a border of one pixel, so reads have to be one pixel further from the edge
+    expected_indexes, expected_scores = loop_lda_scores(im, rcs, np.pad(lda_weights, 1, mode='constant'), 4)
+    assert np.array_equal(indexes, expected_indexes)
+    assert np.allclose(scores, expected_scores, rtol=1e-9, atol=1e-6)
+
+
+def make_scores(directory, backgrounds, random_state):
+    """ IntensityScores for one HDF5 file with an image for each background, and no scores yet. """
+    h5_fpath = str(directory.join('c1.h5'))
+    with h5py.File(h5_fpath, 'w') as h5:
+        group = h5.create_group('blue')
+        for major, background in enumerate(backgrounds):
+            im = random_state.normal(background, 10, (256, 256)).clip(0).astype(np.uint16)
+            group.create_dataset(hdf5tools.get_image_key(major, 0), data=im)
+    scores = intensity.IntensityScores([h5_fpath])
+    scores.store.read_names = np.array(sorted('read%03d' % i for i in range(300)))
+    return h5_fpath, scores
+
+
+def test_images_without_scores_are_normalized(tmpdir):
+    random_state = np.random.RandomState(4)
+    h5_fpath, scores = make_scores(tmpdir, (1000, 2000, 4000), random_state)
+    scores._add_image_scores(h5_fpath, 'blue_000_000', np.arange(100), random_state.normal(size=100), None)
+    # every read in this image was filtered out
+    scores._add_image_scores(h5_fpath, 'blue_000_001', np.arange(100, 200), random_state.normal(size=100),
+                             np.array([], dtype=np.int32))
+    scores._add_image_scores(h5_fpath, 'blue_000_002', np.arange(200, 300), random_state.normal(size=100), None)
+    scores.normalize_scores(verbose=False)
+    Z = scores.normalizing_constants[h5_fpath]['blue']
+    assert sorted(Z) == [(0, 0), (1, 0), (2, 0)]
+    # the image without scores still counts towards the median of the modes
+    assert np.isclose(Z[(1, 0)], 1.0, rtol=0.01)
+    assert scores.scores[h5_fpath]['blue'][(1, 0)] == {}
+
+
+def test_normalize_scores_by_ref_read_names_matches_dicts(tmpdir):
+    random_state = np.random.RandomState(5)
+    h5_fpath, scores = make_scores(tmpdir, (1000, 2000, 4000, 3000), random_state)
+    read_names = scores.store.read_names
+    # images with plenty of reference reads, with too few, and with no reads at all
+    for image_index, read_ids in (('blue_000_000', np.arange(0, 150)),
+                                  ('blue_000_001', np.arange(100, 300)),
+                                  ('blue_000_002', np.arange(280, 300)),
+                                  ('blue_000_003', np.array([], dtype=np.int32))):
+        scores._add_image_scores(h5_fpath, image_index, read_ids, random_state.normal(500, 100, len(read_ids)), None)
+    ref_read_names = set(read_names[random_state.rand(len(read_names)) < 0.3]) | {'not a read'}
+    # how the constants were found when the scores were dicts
+    expected_Z = {}
+    for pos_tup, score_given_read_name in scores.raw_scores[h5_fpath]['blue'].items():
+        ref_scores = [score for read_name, score in score_given_read_name.items() if read_name in ref_read_names]
+        expected_Z[pos_tup] = np.median(ref_scores) / 100.0 if ref_scores else np.nan
+    scores.normalize_scores_by_ref_read_names({'blue': ref_read_names}, verbose=False)
+    Z = scores.normalizing_constants[h5_fpath]['blue']
+    assert sorted(Z) == sorted(expected_Z)
+    for pos_tup in expected_Z:
+        if np.isnan(expected_Z[pos_tup]):
+            assert np.isnan(Z[pos_tup])
+            continue
+        assert Z[pos_tup] == expected_Z[pos_tup]
+        for read_name, score in scores.raw_scores[h5_fpath]['blue'][pos_tup].items():
+            assert scores.scores[h5_fpath]['blue'][pos_tup][read_name] == score / expected_Z[pos_tup]
@@ -0,0 +1,122 @@
+import numpy as np
+from champ import misc
+from champ.fastqtilercs import FastqTileRCs
+from sklearn.neighbors import KernelDensity
+
+
+def lstsq_similarity_transform(src, dst):
+    """ How least_squares_mapping used to find the transform, with a 2N x 4 design matrix. """
+    A = np.zeros((2 * len(src), 4))
+    b = np.zeros((2 * len(src),))
+    for i, ((xir, yir), (xis, yis)) in enumerate(zip(src, dst)):
+        A[2*i, :] = [xir, -yir, 1, 0]
+        A[2*i+1, :] = [yir,  xir, 0, 1]
+        b[2*i] = xis
+        b[2*i+1] = yis
+    alpha, beta, x_offset, y_offset = np.linalg.lstsq(A, b, rcond=-1)[0]
+    theta = np.arctan2(beta, alpha)
+    return alpha / np.cos(theta), theta, np.array([x_offset, y_offset])
+
+
+def lstsq_aligned_rcs(rcs, lbda, theta, offset):
+    """ How set_aligned_rcs_given_transform used to place reads. """
+    A = np.zeros((2 * len(rcs), 4))
+    for i, (xir, yir) in enumerate(rcs):
+        A[2*i, :] = [xir, -yir, 1, 0]
+        A[2*i+1, :] = [yir,  xir, 0, 1]
+    x = np.array([lbda * np.cos(theta), lbda * np.sin(theta), offset[0], offset[1]])
+    return np.dot(A, x).reshape((len(rcs), 2))
+
+
+def test_similarity_transform_finds_a_known_transform():
+    random_state = np.random.RandomState(0)
+    src = random_state.uniform(0, 30000, (500, 2))
+    lbda, theta, offset = 0.0937, np.radians(179.3), np.array([-2310.5, 1270.25])
+    dst = misc.apply_similarity_transform(src, lbda, theta, offset)
+    found_lbda, found_theta, found_offset = misc.similarity_transform(src, dst)
+    assert np.isclose(found_lbda, lbda, rtol=1e-12)
+    assert np.isclose(found_theta, theta, rtol=1e-12)
+    assert np.allclose(found_offset, offset, rtol=0, atol=1e-8)
+
+
+def test_similarity_transform_matches_lstsq():
+    random_state = np.random.RandomState(1)
+    for num_points in (2, 3, 10, 1000):
+        src = random_state.uniform(0, 30000, (num_points, 2))
+        lbda, theta = random_state.uniform(0.05, 0.2), random_state.uniform(-np.pi, np.pi)
+        dst = misc.apply_similarity_transform(src, lbda, theta, random_state.uniform(-5000, 5000, 2))
+        dst += random_state.normal(scale=0.5, size=dst.shape)
+        expected_lbda, expected_theta, expected_offset = lstsq_similarity_transform(src, dst)
+        found_lbda, found_theta, found_offset = misc.similarity_transform(src, dst)
+        assert np.isclose(found_lbda, expected_lbda, rtol=1e-9)
+        assert np.isclose(found_theta, expected_theta, rtol=0, atol=1e-9)
+        assert np.allclose(found_offset, expected_offset, rtol=0, atol=1e-6)
+
+
+def test_set_aligned_rcs_given_transform_matches_lstsq():
+    random_state = np.random.RandomState(2)
+    rcs = random_state.uniform(0, 30000, (1000, 2))
+    tile = FastqTileRCs('lane1tile2101', [], 0.266666, rcs=rcs)
+    tile.set_fastq_image_data(np.zeros(2), 0.1, None, 935.0)
+    lbda, theta, offset = 0.0937, np.radians(-1.7), np.array([-2310.5, 1270.25])
+    tile.set_aligned_rcs_given_transform(lbda, theta, offset)
+    assert np.allclose(tile.aligned_rcs, lstsq_aligned_rcs(rcs, lbda, theta, offset), rtol=0, atol=1e-9)
+
+
+def kde_log_density(vals, x):
+    h = 1.06 * np.std(vals) * len(vals)**(-1.0/5.0)
+    return KernelDensity(bandwidth=h).fit(np.reshape(vals, (-1, 1))).score(np.array([[x]]))
+
+
+def test_get_mode_agrees_with_get_kde_mode():
+    random_state = np.random.RandomState(0)
+    draws = (lambda n: random_state.normal(100, 15, n),
+             lambda n: random_state.lognormal(5, 0.3, n),
+             lambda n: random_state.gamma(4, 50, n),
+             lambda n: random_state.poisson(400, n).astype(np.float))
+    for draw in draws:
+        for num_values in (50, 200, 1000, 5000):
+            for _ in range(5):
+                vals = draw(num_values)
+                bandwidth = 1.06 * vals.std() * num_values**(-1.0/5.0)
+                mode, kde_mode = misc.get_mode(vals), misc.get_kde_mode(vals)
+                if abs(mode - kde_mode) < 0.02 * bandwidth:
+                    continue
+                # the optimizer stopped at a local peak, and get_mode found a higher one
+                assert kde_log_density(vals, mode) > kde_log_density(vals, kde_mode)
+
+
+def test_get_modes_matches_get_mode():
+    random_state = np.random.RandomState(1)
+    samples = [random_state.lognormal(5, 0.3, num_values) for num_values in (1, 20, 500, 3000, 20000)]
+    assert np.array_equal(misc.get_modes(samples), [misc.get_mode(vals) for vals in samples])
+
+
+def test_get_mode_of_constant_samples():
+    assert misc.get_mode([42.0]) == 42.0
+    assert misc.get_mode([7.5] * 100) == 7.5
+    assert np.array_equal(misc.get_modes([[3.0], [1.0, 1.0], np.arange(10.0)])[:2], [3.0, 1.0])
+
+
+def test_grouped_medians_match_np_median():
+    random_state = np.random.RandomState(3)
+    num_groups = 12
+    # group 5 and the last group are empty, and the rest have odd and even numbers of values
+    sizes = [1, 2, 3, 4, 7, 0, 10, 11, 1, 2, 50, 0]
+    groups = np.repeat(np.arange(num_groups), sizes)
+    values = random_state.normal(size=len(groups))
+    values[:3] = 1.5
+    order = random_state.permutation(len(groups))
+    medians, counts = misc.grouped_medians(values[order], groups[order], num_groups)
+    assert np.array_equal(counts, sizes)
+    for group, size in enumerate(sizes):
+        if size == 0:
+            assert np.isnan(medians[group])
+        else:
+            assert medians[group] == np.median(values[groups == group])
+
+
+def test_grouped_medians_without_values():
+    medians, counts = misc.grouped_medians(np.array([]), np.array([], dtype=np.int64), 3)
+    assert np.isnan(medians).all()
+    assert np.array_equal(counts, [0, 0, 0])
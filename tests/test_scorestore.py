@@ -0,0 +1,62 @@
+import numpy as np
+from champ import scorestore
+
+read_names = np.array(sorted('read%d' % i for i in range(20)))
+
+
+def make_store():
+    store = scorestore.ScoreStore(['c1.h5', 'c2.h5'], {'c1.h5': ['blue'], 'c2.h5': ['blue']}, read_names)
+    store.add('c1.h5', 'blue', (1, 0), np.array([3, 1]), np.array([30.0, 10.0]))
+    # no reads were scored in this image, but it still has to be listed
+    store.add('c1.h5', 'blue', (0, 0), np.array([], dtype=np.int32), np.array([]))
+    store.add('c2.h5', 'blue', (0, 0), np.array([1, 2]), np.array([11.0, 21.0]))
+    store.add('c2.h5', 'blue', (2, 0), np.array([], dtype=np.int32), np.array([]))
+    return store
+
+
+def image_scores(store, column='raw_score'):
+    return scorestore.ConcentrationsView(store, lambda store, h5_fpath, channel:
+                                         scorestore.ImageScoresView(store, h5_fpath, channel, column))
+
+
+def test_images_without_reads_are_listed():
+    scores = image_scores(make_store())
+    assert sorted(scores['c1.h5']['blue']) == [(0, 0), (1, 0)]
+    assert sorted(scores['c2.h5']['blue']) == [(0, 0), (2, 0)]
+    assert scores['c1.h5']['blue'][(0, 0)] == {}
+    assert scores['c2.h5']['blue'][(2, 0)] == {}
+    assert scores['c1.h5']['blue'][(1, 0)] == {read_names[3]: 30.0, read_names[1]: 10.0}
+    assert scores['c2.h5']['blue'][(0, 0)] == {read_names[1]: 11.0, read_names[2]: 21.0}
+
+
+def test_images_without_reads_are_normalized():
+    store = make_store()
+    Z_given_image = {('c1.h5', (1, 0)): 2.0, ('c1.h5', (0, 0)): 3.0, ('c2.h5', (0, 0)): 0.5, ('c2.h5', (2, 0)): 4.0}
+    store.normalize('blue', Z_given_image)
+    scores = image_scores(store, 'norm_score')
+    assert scores['c1.h5']['blue'][(1, 0)] == {read_names[3]: 15.0, read_names[1]: 5.0}
+    assert scores['c2.h5']['blue'][(0, 0)] == {read_names[1]: 22.0, read_names[2]: 42.0}
+
+
+def test_image_dicts_are_kept_until_the_scores_change():
+    store = make_store()
+    scores = image_scores(store, 'norm_score')
+    image = scores['c1.h5']['blue'][(1, 0)]
+    assert scores['c1.h5']['blue'][(1, 0)] is image
+    store.normalize('blue', {('c1.h5', (1, 0)): 2.0, ('c1.h5', (0, 0)): 1.0, ('c2.h5', (0, 0)): 1.0,
+                             ('c2.h5', (2, 0)): 1.0})
+    assert scores['c1.h5']['blue'][(1, 0)] == {read_names[3]: 15.0, read_names[1]: 5.0}
+    store.add('c1.h5', 'blue', (3, 0), np.array([5]), np.array([50.0]))
+    assert scores['c1.h5']['blue'][(3, 0)] == {read_names[5]: 50.0}
+
+
+def test_read_scores():
+    store = make_store()
+    view = scorestore.ReadScoresView(store, 'c1.h5', 'blue', 'raw_score')
+    assert view[read_names[3]] == 30.0
+    assert read_names[1] in view
+    assert read_names[2] not in view
+    assert 'not a read' not in view
+    assert sorted(view) == sorted([read_names[1], read_names[3]])
+    assert store.read_id(read_names[7]) == 7
+    assert store.read_id('zzz') is None